@@ -0,0 +1,90 @@
+"""
+RingDelayedInterpolator (遅延0.1 s固定) とAdaptiveDelayedInterpolatorを、
+到着間隔の揺らぎが小さいネットワークと大きいネットワークで比較する。
+元の連続な軌跡に対する遅れと誤差を表示する。
+"sender time"は、目標値を到着の時刻ではなく受信側の時刻に換算した送信時刻
+(時計のずれはclock_sync.ClockSyncで推定できているとする) で補間する場合。
+"""
+import numpy as np
+
+from jaka_control.config import T_INTV
+from jaka_control.interpolate import (
+    AdaptiveDelayedInterpolator, RingDelayedInterpolator
+)
+
+
+def trajectory(t):
+    return np.stack([
+        30 * np.sin(2 * np.pi * 0.5 * t + i) for i in range(6)], axis=-1)
+
+
+def make_arrivals(duration, mean_interval, jitter, burst_prob, seed=0):
+    """
+    送信はmean_interval間隔で、到着は遅延の揺らぎjitterと、
+    確率burst_probで起きる最大80 msの詰まりを含む
+    """
+    rng = np.random.default_rng(seed)
+    t_send = np.arange(0, duration, mean_interval)
+    delay = np.abs(rng.normal(0, jitter, size=len(t_send)))
+    bursts = rng.random(len(t_send)) < burst_prob
+    delay[bursts] += rng.uniform(0.02, 0.08, size=bursts.sum())
+    t_arrive = np.maximum.accumulate(t_send + delay)
+    return t_send, t_arrive
+
+
+def run(di, duration, t_send, t_arrive, sender_time=False):
+    ts = np.arange(0, duration, T_INTV)
+    idx = np.searchsorted(t_arrive, ts, side="right") - 1
+    values = trajectory(t_send)
+    # 受信側の時刻に換算した送信時刻 (受信時刻以前)
+    t_mapped = np.minimum(t_send, t_arrive)
+    outs = np.zeros((len(ts), 6))
+    delays = np.zeros(len(ts))
+    di.reset(ts[0], values[0])
+    last = 0
+    for k, t in enumerate(ts):
+        i = max(idx[k], 0)
+        if isinstance(di, AdaptiveDelayedInterpolator):
+            t_datum = t_mapped[i] if sender_time else None
+            outs[k] = di.read(
+                t, values[i], arrived=i != last, t_datum=t_datum)
+        else:
+            outs[k] = di.read(t, values[i])
+        last = i
+        delays[k] = di.delay
+    return ts, outs, delays
+
+
+def evaluate(ts, outs):
+    """元の軌跡をずらして最も合う遅れと、そのときの誤差"""
+    lags = np.arange(0, 0.2, 0.001)
+    errors = [
+        np.sqrt(np.mean((outs - trajectory(ts - lag)) ** 2)) for lag in lags]
+    i = int(np.argmin(errors))
+    return lags[i], errors[i]
+
+
+if __name__ == '__main__':
+    duration = 60
+    cases = [
+        ("quiet LAN", 0.011, 0.0005, 0.0),
+        ("Wi-Fi", 0.016, 0.005, 0.01),
+        ("congested", 0.016, 0.015, 0.05),
+    ]
+    for name, interval, jitter, burst in cases:
+        t_send, t_arrive = make_arrivals(duration, interval, jitter, burst)
+        for label, di, sender_time in [
+            ("fixed 0.1 s", RingDelayedInterpolator(delay=0.1), False),
+            ("adaptive", AdaptiveDelayedInterpolator(), False),
+            ("sender time", AdaptiveDelayedInterpolator(), True),
+        ]:
+            ts, outs, delays = run(di, duration, t_send, t_arrive, sender_time)
+            # 遅延が落ち着いた後半で評価する
+            half = len(ts) // 2
+            lag, err = evaluate(ts[half:], outs[half:])
+            extra = ""
+            if isinstance(di, AdaptiveDelayedInterpolator):
+                extra = (f", delay {np.median(delays[half:]) * 1000:.0f} ms, "
+                         f"extrapolated {di.n_extrapolated} cycles")
+            print(f"{name:10s} {label:12s}: lag {lag * 1000:4.0f} ms, "
+                  f"rms error {err:.3f} deg{extra}")
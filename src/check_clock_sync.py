@@ -0,0 +1,76 @@
+"""
+ClockSyncの確認。
+ゴーグルの時計がロボットより進んでおり、経路の遅延が揺らぐ場合に、ping/pongから推定した時計のずれと、それを使った制御メッセージの
+片道の遅延の誤差を、すべての交換の平均を使う場合と比較する。
+時刻は実際の時刻ではなく、シミュレーションの時刻 (ns) を与える。
+"""
+import numpy as np
+
+from jaka_control.clock_sync import ClockSync
+
+MS = 1_000_000
+OFFSET = 12345 * MS + 678
+
+
+def path_delay(rng, scale, n=None):
+    """最小5 msに平均scaleの指数分布の滞留が加わる片道の遅延"""
+    return np.int64(5 * MS) + np.int64(rng.exponential(scale, size=n))
+
+
+# 滞留はゴーグルからロボットへ (Wi-Fiの上り) の方が大きい
+def to_robot(rng, n=None):
+    return path_delay(rng, 8 * MS, n)
+
+
+def to_goggles(rng, n=None):
+    return path_delay(rng, 1 * MS, n)
+
+
+def check_invalid():
+    cs = ClockSync(max_pending=2)
+    pings = [cs.make_ping(t0) for t0 in [0, 10 * MS, 20 * MS]]
+    # 捨てられた最初のping、送っていないping、t0が異なるもの
+    assert cs.on_pong(dict(pings[0], t1=1, t2=2), 30 * MS) is None
+    assert cs.on_pong(dict(seq=99, t0=0, t1=1, t2=2), 30 * MS) is None
+    assert cs.on_pong(dict(pings[1], t0=1, t1=1, t2=2), 30 * MS) is None
+    assert cs.n_invalid == 3 and cs.offset_ns is None
+    assert cs.on_pong(dict(pings[2], t1=25 * MS, t2=26 * MS), 30 * MS) \
+        == 9 * MS
+    print("ClockSync: stale, unknown and inconsistent pongs are ignored")
+
+
+def check_estimate(n_pings=200, interval=500 * MS):
+    rng = np.random.default_rng(0)
+    cs = ClockSync()
+    naive = []
+    errors = []
+    for k in range(n_pings):
+        t0 = k * interval
+        ping = cs.make_ping(t0)
+        t1 = t0 + to_goggles(rng) + OFFSET
+        t2 = t1 + int(rng.uniform(0, 2 * MS))
+        t3 = t2 - OFFSET + to_robot(rng)
+        cs.on_pong(dict(ping, t1=int(t1), t2=int(t2)), int(t3))
+        naive.append(((t1 - t0) + (t2 - t3)) / 2)
+        if k >= 16:
+            errors.append(cs.offset_ns - OFFSET)
+    errors = np.abs(np.array(errors)) / MS
+    naive_err = abs(np.mean(naive) - OFFSET) / MS
+    print(f"offset error (ms): min-RTT filter median {np.median(errors):.2f}, "
+          f"max {errors.max():.2f}; mean of all exchanges {naive_err:.2f}")
+    assert np.median(errors) < 1.0
+
+    # 制御メッセージの片道の遅延
+    t_send = np.arange(1000) * 11 * MS
+    true_one_way = to_robot(rng, 1000)
+    t_recv = t_send + true_one_way
+    measured = np.array([
+        r - cs.to_local(int(s + OFFSET)) for s, r in zip(t_send, t_recv)])
+    err = np.abs(measured - true_one_way) / MS
+    print(f"one-way latency error (ms): max {err.max():.2f}, "
+          f"min RTT {cs.delay_ns / MS:.2f}")
+
+
+if __name__ == '__main__':
+    check_invalid()
+    check_estimate()
@@ -0,0 +1,99 @@
+"""
+RCの頻繁に送るコマンドのエンコードの確認とベンチマーク。
+- servo_jのJSONが、以前のエンコード (strの連結とencode) とコントローラーから見て
+  同じ内容 (キーと値、関節の値は小数点以下6桁の丸めの範囲) であること
+- get_joint_pos、is_in_servomoveが以前と同じ内容であること
+- 相対移動で丸めの誤差が積み重なる大きさ (1時間分)
+- エンコードの時間の比較
+"""
+import json
+import time
+
+import numpy as np
+
+from jaka_control.jkrc import _GET_JOINT_POS, _IS_IN_SERVOMOVE, servo_j_format
+
+N_BENCH = 200000
+DECIMALS = 6
+
+
+def old_servo_j(joint_pos, move_mode, step_num=1):
+    """以前のservo_jのエンコード"""
+    cp = ",".join(map(str, joint_pos))
+    sn = step_num
+    send = f'{{"cmdName": "servo_j", "jointPosition": [{cp}], "relFlag": {move_mode}, "stepNum": {sn}}}'
+    return str.encode(send, 'utf-8')
+
+
+FORMATS = {(m, s): servo_j_format(m, s, DECIMALS)
+           for m in [0, 1] for s in [1, 2, 3]}
+
+
+def new_servo_j(joint_pos, move_mode, step_num=1):
+    """RC.servo_jと同じく書式は作っておく"""
+    return FORMATS[(move_mode, step_num)] % tuple(joint_pos)
+
+
+def check_semantics(n=100000):
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            joints = rng.uniform(-1.5, 1.5, 6)
+        elif kind == 1:
+            joints = rng.uniform(-360, 360, 6)
+        elif kind == 2:
+            joints = rng.normal(0, 1e-5, 6)
+        else:
+            joints = rng.integers(-5, 5, 6)
+        move_mode = int(rng.integers(0, 2))
+        step_num = int(rng.integers(1, 4))
+        for jp in [joints.tolist(), joints]:
+            old = json.loads(old_servo_j(joints.tolist(), move_mode, step_num))
+            new = json.loads(new_servo_j(jp, move_mode, step_num))
+            old_joints = old.pop("jointPosition")
+            new_joints = new.pop("jointPosition")
+            assert old == new, (old, new)
+            assert len(new_joints) == 6
+            assert all(isinstance(x, float) for x in new_joints)
+            err = np.abs(np.array(new_joints) - np.array(old_joints))
+            assert np.all(err <= 0.5 * 10 ** -DECIMALS + 1e-12), err
+    assert json.loads(_GET_JOINT_POS) == json.loads('{"cmdName":"get_joint_pos"}')
+    assert json.loads(_IS_IN_SERVOMOVE) == \
+        json.loads('{"cmdName":"is_in_servomove"}')
+    print(f"servo_j: {n} commands match the previous encoding within "
+          f"{0.5 * 10 ** -DECIMALS:g} deg")
+
+
+def check_drift(hours=1.0, t_intv=0.008):
+    # 速度が揺らぎながら動き続ける場合の相対移動の差分
+    rng = np.random.default_rng(1)
+    n = int(hours * 3600 / t_intv)
+    velocity = np.cumsum(rng.normal(0, 0.5, (n, 6)), axis=0)
+    velocity = np.clip(velocity, -90, 90)
+    diffs = velocity * t_intv
+    rounded = np.round(diffs, DECIMALS)
+    drift = np.abs(np.sum(rounded - diffs, axis=0))
+    print(f"accumulated rounding of relative moves in {hours:g} h: "
+          f"max {drift.max():.2e} deg")
+
+
+def bench():
+    joints = [-0.0123456789012, 0.25, 1.0000001, -1.4999, 0.000001234, 0.0]
+    print("servo_j encode    p50 (us)  p99 (us)")
+    for name, f in [("str + encode", old_servo_j), ("bytes format", new_servo_j)]:
+        t = np.empty(N_BENCH)
+        for i in range(N_BENCH):
+            t0 = time.perf_counter_ns()
+            f(joints, 1)
+            t[i] = time.perf_counter_ns() - t0
+        p50, p99 = np.percentile(t / 1000, [50, 99])
+        print(f"{name:16s} {p50:9.2f} {p99:9.2f}")
+    print(f"message size: {len(old_servo_j(joints, 1))} -> "
+          f"{len(new_servo_j(joints, 1))} bytes")
+
+
+if __name__ == '__main__':
+    check_semantics()
+    check_drift()
+    bench()
@@ -0,0 +1,112 @@
+"""
+Jaka-Control-Binaryの制御メッセージの確認とベンチマーク。
+- 符号化したメッセージを復号すると同じ値とフラグになること、形式が異なれば例外になること
+- JSONのメッセージの関節の値の個数や型が違えばcheck_jointsが例外にすること
+- on_messageと同じく、メッセージから共有メモリの目標値に書き込むまでの時間と
+  メッセージのバイト数を、Jaka-Control-IK (JSON) と比較する
+"""
+import json
+import time
+
+import numpy as np
+
+from jaka_control.config import SHM_DTYPE
+from jaka_control.control_message import (
+    FLAG_FLOAT64, FLAG_PUT_DOWN_BOX, FLAG_TOOL, FLAG_TOOL_CHANGE,
+    check_joints, control_message_to_dict, decode_control_message,
+    encode_control_message
+)
+from jaka_control.seqlock import PoseSeqLocks
+
+N = 100000
+JOINTS = [-270.12345678, 110.5, 90.25, 70.125, -90.0625, 45.03125]
+
+
+def check_round_trip():
+    for float64 in [False, True]:
+        payload = encode_control_message(
+            JOINTS, 2**32 + 5, 123456789, tool=3, put_down_box=True,
+            float64=float64)
+        header, joints = decode_control_message(payload)
+        dtype = np.float64 if float64 else np.float32
+        assert np.array_equal(joints, np.array(JOINTS, dtype=dtype))
+        assert header.seq == 5 and header.sender_time_ns == 123456789
+        assert header.flags & FLAG_TOOL and header.tool == 3
+        assert header.flags & FLAG_PUT_DOWN_BOX
+        assert not header.flags & FLAG_TOOL_CHANGE
+        assert bool(header.flags & FLAG_FLOAT64) == float64
+        d = control_message_to_dict(payload)
+        assert d["tool"] == 3 and d["put_down_box"] and "tool_change" not in d
+    nan_joints = JOINTS[:5] + [float("nan")]
+    for bad in [payload[:10], payload[:-1], b"XX" + payload[2:],
+                json.dumps({"joints": JOINTS}).encode(),
+                encode_control_message(nan_joints, 1, 0)]:
+        try:
+            decode_control_message(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(bad)
+    print("control message: round trip and invalid messages OK")
+
+
+def check_json_joints():
+    assert check_joints([1, 2.5, -3, 0, 0, 0]) == [1.0, 2.5, -3.0, 0.0, 0.0, 0.0]
+    for bad in [JOINTS[:5], JOINTS + [0.0], ["1"] * 6, [None] * 6,
+                [True] * 6, JOINTS[:5] + [float("inf")], "abcdef", 1.0,
+                {"j1": 0}]:
+        try:
+            check_joints(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(bad)
+    print("check_joints: invalid joints rejected")
+
+
+def bench(name, payload, decode, pose):
+    seqlocks = PoseSeqLocks(pose)
+    decode(payload, seqlocks)
+    t = np.empty(N)
+    for i in range(N):
+        t0 = time.perf_counter_ns()
+        decode(payload, seqlocks)
+        t[i] = time.perf_counter_ns() - t0
+    p50, p99 = np.percentile(t / 1000, [50, 99])
+    print(f"{name:22s} {len(payload):5d} {p50:9.2f} {p99:9.2f}")
+    return pose["target"].copy()
+
+
+def decode_json(payload, seqlocks):
+    js = json.loads(payload)
+    rot = js["joints"][:6]
+    joint_q = [x for x in rot]
+    seqlocks.target.write(joint_q, 0)
+    return js.get("tool"), js.get("tool_change"), js.get("put_down_box", False)
+
+
+def decode_binary(payload, seqlocks):
+    header, joint_q = decode_control_message(payload)
+    seqlocks.target.write(joint_q, 0)
+    flags = header.flags
+    tool = header.tool if flags & FLAG_TOOL else None
+    tool_change = header.tool_change if flags & FLAG_TOOL_CHANGE else None
+    return tool, tool_change, bool(flags & FLAG_PUT_DOWN_BOX)
+
+
+if __name__ == '__main__':
+    check_round_trip()
+    check_json_joints()
+    pose = np.zeros((), dtype=SHM_DTYPE)[()]
+    json_payload = json.dumps({
+        "joints": JOINTS + [0], "tool": 3, "time": 1760000000000,
+    }).encode()
+    print("format                 bytes  p50 (us)  p99 (us)")
+    target_json = bench("Jaka-Control-IK", json_payload, decode_json, pose)
+    for float64 in [False, True]:
+        payload = encode_control_message(
+            JOINTS, 1, time.monotonic_ns(), tool=3, float64=float64)
+        name = "Binary " + ("float64" if float64 else "float32")
+        target = bench(name, payload, decode_binary, pose)
+        err = np.abs(target - target_json).max()
+        assert err < (1e-12 if float64 else 1e-4), err
@@ -0,0 +1,128 @@
+"""
+ControlStep (control_loopの1周期の計算) が定常状態で
+メモリを確保しないことをtracemallocで確認する。
+
+1周期の間に一時的に確保されたメモリの最大 (peak) と、
+全周期を通したメモリの増加がそれぞれ予算以下でなければ失敗する。
+numpyのスカラーやfloatなど小さなオブジェクトの確保は避けられないので、
+予算は6要素の配列 (約150バイト) を数個確保すると超える程度にしている。
+AdaptiveDelayedInterpolatorが遅延の目標を更新する周期 (update_every回の到着ごと)
+は、到着間隔のソートでnumpyが一時領域 (約2.6 KB) を確保するので別の予算にする。
+"""
+import itertools
+import sys
+import tracemalloc
+
+import numpy as np
+
+from jaka_control.config import (
+    ACCEL_LIMITS, DEFAULT_JOINT, JERK_LIMITS, MAX_JOINT_LIMIT,
+    MIN_JOINT_LIMIT, SHM_DTYPE, SPEED_LIMIT, T_INTV
+)
+from jaka_control.control_step import ControlStep
+
+# 1周期の一時的な確保の上限 (バイト)
+PEAK_BUDGET = 512
+# 遅延の目標を更新する周期の一時的な確保の上限 (バイト)
+UPDATE_PEAK_BUDGET = 4096
+# 計測した全周期を通したメモリの増加の上限 (バイト)
+GROWTH_BUDGET = 1024
+
+
+def make_control_step(
+        pose, filter_kind, adaptive_delay, use_jerk_limit, joint_math="numpy"):
+    cs = ControlStep(
+        filter_kind=filter_kind,
+        n_windows=10,
+        speed_limits=0.5 * SPEED_LIMIT,
+        accel_limits=0.5 * np.array(ACCEL_LIMITS),
+        jerk_limits=0.5 * np.array(JERK_LIMITS),
+        stopped_velocity_eps=1e-4,
+        min_joint_limit=np.array(MIN_JOINT_LIMIT),
+        max_joint_limit=np.array(MAX_JOINT_LIMIT),
+        adaptive_delay=adaptive_delay,
+        one_euro_params=dict(min_cutoff=1.0, beta=0.02, d_cutoff=1.0),
+        t_intv=T_INTV,
+        n_jerk_windows=25 if use_jerk_limit else None,
+        joint_math=joint_math,
+    )
+    cs.attach(pose)
+    return cs
+
+
+def run_cycle(cs, pose, k):
+    """control_loopと同じ順序で1周期を計算する (記録とservo_jは除く)"""
+    t = k * T_INTV
+    # 目標値は60 Hz程度で更新される
+    arrived = k % 2 == 0
+    if arrived:
+        # pose["target"]はビューを作るので、SeqLockが持つビューに足す
+        cs.seqlocks.target.data += 0.01
+    cs.snapshot()
+    cs.wrap_clip()
+    cs.interpolate(t, arrived)
+    cs.pre_limit(T_INTV)
+    cs.smooth(T_INTV)
+    cs.limit(T_INTV)
+    cs.apply()
+    cs.command_diff()
+    cs.control_unchanged()
+    cs.commit()
+
+
+def measure(
+        filter_kind, adaptive_delay, use_jerk_limit, joint_math,
+        n_cycles=5000):
+    pose = np.zeros((), dtype=SHM_DTYPE)[()]
+    pose["state"] = DEFAULT_JOINT
+    pose["target"] = DEFAULT_JOINT
+    cs = make_control_step(
+        pose, filter_kind, adaptive_delay, use_jerk_limit, joint_math)
+    cs.snapshot()
+    cs.wrap_clip()
+    cs.setup(0.0)
+    # 補間の遅延の適応などが落ち着くまで回す
+    for k in range(1, 2000):
+        run_cycle(cs, pose, k)
+
+    peaks = np.zeros(n_cycles, dtype=np.int64)
+    updated = np.zeros(n_cycles, dtype=bool)
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    for i in range(n_cycles):
+        n_arrivals = getattr(cs.di, "n_arrivals", None)
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        run_cycle(cs, pose, 2000 + i)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[i] = peak - current
+        if n_arrivals is not None and cs.di.n_arrivals != n_arrivals:
+            updated[i] = cs.di.n_arrivals % cs.di.update_every == 0
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peaks, updated, end - start
+
+
+if __name__ == '__main__':
+    failed = False
+    for joint_math, filter_kind, adaptive_delay, use_jerk_limit in (
+            itertools.product(
+                ["numpy", "python"], ["original", "one_euro"],
+                [False, True], [False, True])):
+        peaks, updated, growth = measure(
+            filter_kind, adaptive_delay, use_jerk_limit, joint_math)
+        peak = peaks[~updated].max()
+        update_peak = peaks[updated].max() if updated.any() else 0
+        ok = (peak <= PEAK_BUDGET and
+              update_peak <= UPDATE_PEAK_BUDGET and
+              growth <= GROWTH_BUDGET)
+        failed |= not ok
+        print(
+            f"{joint_math:6s} {filter_kind:8s} "
+            f"adaptive_delay={adaptive_delay!s:5s} "
+            f"jerk={use_jerk_limit!s:5s}: "
+            f"peak per cycle median {int(np.median(peaks))} B, "
+            f"max {peak} B, delay update {update_peak} B, "
+            f"growth {growth} B {'OK' if ok else 'OVER BUDGET'}")
+    if failed:
+        sys.exit(1)
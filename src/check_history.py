@@ -0,0 +1,111 @@
+"""
+HistoryRingの確認。
+- 折り返しても最近の記録が連続したビュー (コピーなし) で読めること
+- 別プロセスが書き続けている間に読んでも、n_tornで除いた後の記録は
+  書き込み途中のものを含まず、欠けも重複もないこと
+- 8 ms周期で最新の値を見る場合 (以前のGUI) との取りこぼし、重複の比較
+"""
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from jaka_control.history import Histories
+
+N_WRITES = 200000
+
+
+def check_view():
+    history = Histories(create=True)
+    ring = history.control
+    cap = ring.capacity
+    v, first = ring.view(10)
+    assert len(v) == 0 and first == 0
+    joint = np.zeros(6)
+    for i in range(cap + cap // 2):
+        joint[:] = i
+        ring.append(i, joint)
+    v, first = ring.view(cap)
+    assert len(v) == cap - 1 and first == ring.count - cap + 1
+    assert np.shares_memory(v, ring.records)
+    assert np.array_equal(v["time"], np.arange(first, ring.count))
+    assert np.all(v["joint"] == v["time"][:, None])
+    assert ring.n_torn(first, len(v)) == 0
+    ring.append(ring.count, joint)
+    assert ring.n_torn(first, len(v)) == 1
+    v, first = ring.view_since(ring.count - 100)
+    assert len(v) == 100 and first == ring.count - 100
+    history.close()
+    history.unlink()
+    print(f"HistoryRing: contiguous zero-copy view of {cap - 1} records "
+          f"after wrapping")
+
+
+def writer(n, interval):
+    history = Histories()
+    joint = np.zeros(6)
+    t_next = time.perf_counter()
+    for i in range(1, n + 1):
+        joint[:] = i
+        history.state.append(i, joint)
+        if interval:
+            t_next += interval
+            while time.perf_counter() < t_next:
+                pass
+    history.close()
+
+
+def check_concurrent():
+    history = Histories(create=True)
+    ring = history.state
+    p = mp.Process(target=writer, args=(N_WRITES, 0))
+    p.start()
+    n_reads = n_torn = 0
+    while p.is_alive() or n_reads == 0:
+        v, first = ring.view(ring.capacity)
+        out = v.copy()
+        k = ring.n_torn(first, len(out))
+        n_torn += k
+        out = out[k:]
+        n_reads += 1
+        # 書き込み途中の記録があれば時刻と関節の値が食い違う
+        assert np.all(out["joint"] == out["time"][:, None].astype(float))
+        assert np.array_equal(
+            out["time"], np.arange(first + k + 1, first + k + 1 + len(out)))
+    p.join()
+    history.close()
+    history.unlink()
+    print(f"HistoryRing: {n_reads} reads during {N_WRITES} writes, "
+          f"{n_torn} overwritten records dropped, no torn records")
+
+
+def compare_sampling(seconds=3.0, rate=125.0):
+    """状態値を125 Hzで書き、8 msの周期で最新の値を見る場合と履歴を読む場合"""
+    history = Histories(create=True)
+    ring = history.state
+    n = int(seconds * rate)
+    p = mp.Process(target=writer, args=(n, 1 / rate))
+    p.start()
+    sampled = []
+    t_next = time.perf_counter()
+    while p.is_alive():
+        v, first = ring.view(1)
+        if len(v):
+            sampled.append(int(v["time"][0]))
+        t_next += 0.008
+        time.sleep(max(t_next - time.perf_counter(), 0))
+    p.join()
+    sampled = np.array(sampled)
+    n_dup = int(np.count_nonzero(np.diff(sampled) == 0))
+    n_missed = n - len(np.unique(sampled))
+    got = ring.read_since(0)
+    history.close()
+    history.unlink()
+    print(f"sampling every 8 ms: {n_missed} of {n} missed, {n_dup} duplicated")
+    print(f"history ring: {n - len(got)} of {n} missed")
+
+
+if __name__ == '__main__':
+    check_view()
+    check_concurrent()
+    compare_sampling()
@@ -0,0 +1,50 @@
+"""
+DelayedInterpolatorとRingDelayedInterpolatorの1回のreadの処理時間を比較する。
+制御周期125 Hzで読み出し、目標値は60/90/120 Hzで更新されるとする。
+両者の結果が完全に一致することも確認する。
+"""
+import time
+
+import numpy as np
+
+from jaka_control.interpolate import (
+    DelayedInterpolator, RingDelayedInterpolator
+)
+
+
+def make_targets(rate: float, n_reads: int, t_intv: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    ts = np.arange(n_reads) * t_intv
+    # 目標値の更新タイミングに揺らぎをもたせる
+    t_arrivals = np.cumsum(rng.normal(1 / rate, 0.1 / rate, size=n_reads))
+    values = np.cumsum(rng.normal(0, 0.1, size=(n_reads, 6)), axis=0)
+    idx = np.searchsorted(t_arrivals, ts, side="right")
+    return ts, values[np.maximum(idx - 1, 0)]
+
+
+def run(di, ts, targets):
+    elapsed = np.zeros(len(ts))
+    outs = np.zeros((len(ts), 6))
+    di.reset(ts[0], targets[0])
+    for k in range(len(ts)):
+        t0 = time.perf_counter_ns()
+        out = di.read(ts[k], targets[k])
+        elapsed[k] = time.perf_counter_ns() - t0
+        outs[k] = out
+    return elapsed, outs
+
+
+if __name__ == '__main__':
+    t_intv = 0.008
+    n_reads = 20000
+    for rate in [60, 90, 120]:
+        ts, targets = make_targets(rate, n_reads, t_intv)
+        e_list, o_list = run(DelayedInterpolator(delay=0.1), ts, targets)
+        e_ring, o_ring = run(RingDelayedInterpolator(delay=0.1), ts, targets)
+        assert np.array_equal(o_list, o_ring), "Results differ"
+        print(
+            f"target {rate:3d} Hz: "
+            f"list median {np.median(e_list) / 1000:.2f} us "
+            f"p99 {np.percentile(e_list, 99) / 1000:.2f} us, "
+            f"ring median {np.median(e_ring) / 1000:.2f} us "
+            f"p99 {np.percentile(e_ring, 99) / 1000:.2f} us")
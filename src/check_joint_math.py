@@ -0,0 +1,126 @@
+"""
+joint_mathのnumpy版とPython版 (ControlStepのjoint_math="numpy", "python")
+の結果がビット単位で一致することを確認し、1周期あたりのCPU時間を比較する。
+速い方をjaka_zu_control.pyのJOINT_MATHの既定値にする。
+"""
+import time
+
+import numpy as np
+
+from check_control_step_alloc import make_control_step, run_cycle
+from jaka_control.config import (
+    ACCEL_LIMITS, DEFAULT_JOINT, JERK_LIMITS, MAX_JOINT_LIMIT,
+    MIN_JOINT_LIMIT, SHM_DTYPE, SPEED_LIMIT, T_INTV
+)
+from jaka_control.joint_math import (
+    JointLimiter, PyJointLimiter, clip, clip_py, wrap, wrap_py
+)
+
+
+def same(a, b) -> bool:
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    return np.array_equal(a.view(np.int64), b.view(np.int64))
+
+
+def check_kernels(n_cycles: int = 20000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    min_limit = np.array(MIN_JOINT_LIMIT, dtype=float)
+    max_limit = np.array(MAX_JOINT_LIMIT, dtype=float)
+    out_n = np.zeros(6)
+    out_p = np.zeros(6)
+    neq = np.zeros(6, dtype=bool)
+    for _ in range(n_cycles):
+        state = rng.uniform(-400, 400, 6)
+        target = rng.uniform(-1000, 1000, 6)
+        wrap(state, target, out=out_n)
+        wrap_py(memoryview(state), memoryview(target), memoryview(out_p))
+        assert same(out_n, out_p), "wrap differs"
+        hits_n = clip(target, min_limit, max_limit, out=out_n, neq=neq)
+        hits_p = clip_py(
+            target, min_limit.tolist(), max_limit.tolist(), memoryview(out_p))
+        assert same(out_n, out_p) and hits_n == hits_p, "clip differs"
+
+    args = (0.5 * SPEED_LIMIT, 0.5 * np.array(ACCEL_LIMITS), 1e-4,
+            0.5 * np.array(JERK_LIMITS))
+    lim_n = JointLimiter(*args)
+    lim_p = PyJointLimiter(*args)
+    for k in range(n_cycles):
+        # 静止、小さい動き、制限を超える動きを混ぜる
+        scale = [0, 1e-7, 0.01, 0.5, 5][k % 5]
+        diff_n = rng.normal(0, scale, 6)
+        diff_p = diff_n.copy()
+        dt = T_INTV + rng.normal(0, 1e-4)
+        lim_n.limit(diff_n, dt, out=diff_n)
+        lim_p.limit(memoryview(diff_p), dt, out=memoryview(diff_p))
+        assert same(diff_n, diff_p), "limit differs"
+        for name in ["max_ratio", "accel_max_ratio", "jerk_max_ratio"]:
+            assert same(getattr(lim_n, name), getattr(lim_p, name)), name
+        assert same(lim_n.last_velocity, lim_p.last_velocity)
+        assert same(lim_n.last_accel, lim_p.last_accel)
+    print("joint_math kernels: numpy and python are bit-identical")
+
+
+def new_pose():
+    pose = np.zeros((), dtype=SHM_DTYPE)[()]
+    pose["state"] = DEFAULT_JOINT
+    pose["target"] = DEFAULT_JOINT
+    return pose
+
+
+def start(joint_math, filter_kind="original", use_jerk_limit=False):
+    pose = new_pose()
+    cs = make_control_step(
+        pose, filter_kind, True, use_jerk_limit, joint_math=joint_math)
+    cs.snapshot()
+    cs.wrap_clip()
+    cs.setup(0.0)
+    return pose, cs
+
+
+def check_control_step(n_cycles: int = 5000):
+    for filter_kind in ["original", "one_euro"]:
+        for use_jerk_limit in [False, True]:
+            (pose_n, cs_n), (pose_p, cs_p) = [
+                start(jm, filter_kind, use_jerk_limit)
+                for jm in ["numpy", "python"]]
+            for k in range(1, n_cycles):
+                # 状態値は制御値に少し遅れて追従するとする
+                for pose in [pose_n, pose_p]:
+                    if k > 12:
+                        pose["state"] = pose["control"]
+                run_cycle(cs_n, pose_n, k)
+                run_cycle(cs_p, pose_p, k)
+                assert same(cs_n.control, cs_p.control), (filter_kind, k)
+    print("ControlStep: joint_math numpy and python are bit-identical")
+
+
+def bench(n_cycles: int = 20000):
+    print("per-cycle CPU time (us)      numpy  python")
+    rows = []
+    stages = [
+        ("wrap_clip", lambda cs, k: cs.wrap_clip()),
+        ("pre_limit", lambda cs, k: cs.pre_limit(T_INTV)),
+        ("limit", lambda cs, k: cs.limit(T_INTV)),
+        ("whole step", lambda cs, k: run_cycle(cs, cs._pose, k)),
+    ]
+    for name, f in stages:
+        row = []
+        for joint_math in ["numpy", "python"]:
+            pose, cs = start(joint_math)
+            cs._pose = pose
+            for k in range(1, 2000):
+                run_cycle(cs, pose, k)
+            t0 = time.thread_time_ns()
+            for k in range(2000, 2000 + n_cycles):
+                f(cs, k)
+            row.append((time.thread_time_ns() - t0) / n_cycles / 1000)
+        rows.append(row)
+        print(f"{name:27s} {row[0]:6.1f}  {row[1]:6.1f}")
+    return rows
+
+
+if __name__ == '__main__':
+    check_kernels()
+    check_control_step()
+    bench()
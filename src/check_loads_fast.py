@@ -0,0 +1,224 @@
+"""
+loads_fast、loads_jaka_control_ikの確認とベンチマーク。
+- ランダムに作ったメッセージと、それを壊したもの (切り詰め、バイトの置換・挿入、
+  余分な文字、UTF-16など) について、結果 (型を含む) と例外がjson.loadsと同じこと
+- loads_jaka_control_ikが、以前のon_messageの処理 (json.loadsと辞書の参照) と
+  同じ結果と例外になること。Jaka-Control-IKの形のメッセージと、それを
+  少し変えたもの (数の書き方、空白、キーの重複や順序、想定外の値) も使う
+- Jaka-Control-IKの1メッセージあたりの処理時間の比較
+"""
+import json
+import random
+import time
+
+import numpy as np
+
+from jaka_control.control_message import loads_fast, loads_jaka_control_ik
+
+N_FUZZ = 200000
+N_FUZZ_IK = 200000
+N_BENCH = 100000
+
+
+def reference(payload):
+    """以前のon_messageのJaka-Control-IKの処理"""
+    js = json.loads(payload)
+    rot = js["joints"][:6]
+    joint_q = [x for x in rot]
+    tool = js["tool"] if "tool" in js else None
+    tool_change = js["tool_change"] if "tool_change" in js else None
+    put_down_box = js["put_down_box"] if "put_down_box" in js else False
+    return joint_q, tool, tool_change, put_down_box
+
+
+def random_value(rng, depth=0):
+    r = rng.random()
+    if r < 0.3:
+        return rng.uniform(-400, 400)
+    if r < 0.4:
+        return rng.randint(-1000, 1000)
+    if r < 0.5:
+        return rng.choice([True, False, None, float("nan"), float("inf")])
+    if r < 0.6:
+        return rng.choice(["", "abc", "日本語", "a\"b\\c\n", "\ud800"])
+    if r < 0.8 and depth < 3:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 8))]
+    if depth < 3:
+        return random_message(rng, depth + 1)
+    return 0
+
+
+def random_message(rng, depth=0):
+    keys = ["joints", "tool", "tool_change", "put_down_box", "time", "grip",
+            "ジョイント"]
+    js = {}
+    if depth == 0 and rng.random() < 0.8:
+        js["joints"] = [rng.uniform(-360, 360) for _ in range(7)]
+    for _ in range(rng.randint(0, 4)):
+        js[rng.choice(keys)] = random_value(rng, depth)
+    return js
+
+
+def random_payload(rng):
+    js = random_message(rng)
+    indent = rng.choice([None, None, 0, 2])
+    separators = rng.choice([None, (",", ":"), (" , ", " : ")])
+    s = json.dumps(js, indent=indent, separators=separators,
+                   ensure_ascii=rng.random() < 0.5)
+    r = rng.random()
+    if r < 0.05:
+        # 重複するキー (後のものが使われる)
+        s = s[:-1] + ', "joints": [1, 2, 3, 4, 5, 6, 7]}'
+    elif r < 0.1:
+        s = rng.choice([" ", "\n", "\t", "x", "{}", "　"]) + s
+    elif r < 0.15:
+        s = s + rng.choice([" ", "\r\n", "x", "{}", "　", "\0"])
+    encoding = "utf-8" if rng.random() < 0.9 else rng.choice(
+        ["utf-16-le", "utf-16", "utf-32", "utf-8-sig"])
+    b = bytearray(s.encode(encoding, "surrogatepass"))
+    r = rng.random()
+    if r < 0.1 and b:
+        del b[rng.randrange(len(b)):]
+    elif r < 0.2 and b:
+        b[rng.randrange(len(b))] = rng.randrange(256)
+    elif r < 0.3:
+        b.insert(rng.randint(0, len(b)), rng.randrange(256))
+    return bytes(b)
+
+
+def random_number(rng, clean=False):
+    r = rng.random()
+    if r < 0.5:
+        return repr(rng.uniform(-400, 400))
+    if r < 0.7 or clean:
+        return str(rng.randint(-1000, 1000))
+    return rng.choice([
+        "0", "-0", "0.0", "-0.0", "1e5", "1E+5", "-2.5e-3", "1e999", "-1e999",
+        "1" * 30, "1" * 5000, "0.1234567890123456789", "01", "1.", ".5", "+1",
+        "-", "1e", "NaN", "Infinity", "-Infinity", "true", "null", '"1"'])
+
+
+def random_ik_payload(rng):
+    """
+    Jaka-Control-IKの形のメッセージ。半分は想定する形のままで、
+    残りは空白、数の書き方、値の種類を少し変えたものや壊したもの
+    """
+    clean = rng.random() < 0.5
+    if clean:
+        ws = lambda: rng.choice(["", "", " ", "\n", "\t", "\r\n"])
+    else:
+        ws = lambda: rng.choice(["", "", " ", "\n", "\t", "\r\n", "　", "\f"])
+    n_joints = 7 if clean else rng.choice([7, 7, 7, 6, 5, 0, 8])
+    joints = (
+        "[" + ws() +
+        (ws() + "," + ws()).join(
+            random_number(rng, clean) for _ in range(n_joints)) +
+        ws() + "]")
+    values = {
+        "joints": joints,
+        "tool": rng.choice(["3", "0", "-1", "null", "true", '"a"', "[1, 2]"]),
+        "tool_change": rng.choice(["2", "null", '"x y"', "[]"]),
+        "put_down_box": rng.choice(["true", "false", "null", "1", '"yes"']),
+        "time": random_number(rng, clean),
+        "grip": rng.choice(["true", "false"]),
+    }
+    if not clean:
+        values["tool"] = rng.choice([values["tool"], "1.5", "{}"])
+        values["tool_change"] = rng.choice([values["tool_change"], '"\\u0041"'])
+        values["grip"] = rng.choice(
+            ['"日本語"', '"a\\"b"', "[1, [2]]", '{"a": 1}', "[true]"])
+    keys = ["joints"] + rng.sample(list(values)[1:], rng.randint(0, 5))
+    rng.shuffle(keys)
+    if not clean:
+        r = rng.random()
+        if r < 0.1:
+            keys.remove("joints")
+        elif r < 0.3:
+            # 重複するキー (後のものが使われる)
+            keys.append(rng.choice(list(values)))
+    members = []
+    for key in keys:
+        value = values[key]
+        if not clean and rng.random() < 0.05:
+            value = random_number(rng)
+        if not clean and key == "joints" and rng.random() < 0.05:
+            value = rng.choice(['"abcdefg"', "{}", "null", "[[1]]"])
+        members.append(f'{ws()}"{key}"{ws()}:{ws()}{value}{ws()}')
+    s = ws() + "{" + ",".join(members) + "}" + ws()
+    b = bytearray(s.encode("utf-8"))
+    if not clean:
+        r = rng.random()
+        if r < 0.05:
+            b += rng.choice([b"x", b"{}", b",", b"\0"])
+        elif r < 0.1:
+            b = b.replace(b",", b",,", 1)
+        elif r < 0.15 and b:
+            del b[rng.randrange(len(b)):]
+        elif r < 0.2 and b:
+            b[rng.randrange(len(b))] = rng.randrange(256)
+    return bytes(b)
+
+
+def outcome(f, payload):
+    try:
+        return "ok", repr(f(payload))
+    except Exception as e:
+        return "error", type(e).__name__, str(e)
+
+
+def check_fuzz():
+    rng = random.Random(0)
+    n_errors = 0
+    for i in range(N_FUZZ):
+        payload = random_payload(rng)
+        inputs = [payload]
+        try:
+            inputs.append(payload.decode("utf-8"))
+        except UnicodeDecodeError:
+            pass
+        for p in inputs:
+            expected = outcome(json.loads, p)
+            assert outcome(loads_fast, p) == expected, (p, expected)
+            n_errors += expected[0] == "error"
+        expected = outcome(reference, payload)
+        assert outcome(loads_jaka_control_ik, payload) == expected, \
+            (payload, expected)
+    print(f"loads_fast: {N_FUZZ} random messages match json.loads "
+          f"({n_errors} of them invalid)")
+
+
+def check_fuzz_ik():
+    rng = random.Random(1)
+    n_errors = 0
+    for i in range(N_FUZZ_IK):
+        payload = random_ik_payload(rng)
+        expected = outcome(reference, payload)
+        assert outcome(loads_jaka_control_ik, payload) == expected, \
+            (payload, expected)
+        n_errors += expected[0] == "error"
+    print(f"loads_jaka_control_ik: {N_FUZZ_IK} Jaka-Control-IK-like "
+          f"messages match json.loads ({n_errors} of them invalid)")
+
+
+def bench():
+    payload = json.dumps({
+        "joints": [-270.12345678, 110.5, 90.25, 70.125, -90.0625, 45.03125, 0],
+        "tool": 3,
+        "time": 1760000000000,
+    }).encode()
+    print("Jaka-Control-IK        p50 (us)  p99 (us)")
+    for name, f in [("json.loads + dict", reference),
+                    ("loads_jaka_control_ik", loads_jaka_control_ik)]:
+        t = np.empty(N_BENCH)
+        for i in range(N_BENCH):
+            t0 = time.perf_counter_ns()
+            f(payload)
+            t[i] = time.perf_counter_ns() - t0
+        p50, p99 = np.percentile(t / 1000, [50, 99])
+        print(f"{name:22s} {p50:9.2f} {p99:9.2f}")
+
+
+if __name__ == '__main__':
+    check_fuzz()
+    check_fuzz_ik()
+    bench()
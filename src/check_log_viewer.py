@@ -0,0 +1,59 @@
+"""
+log_viewer.LogLoaderの確認。
+- state.jsonlに状態値以外の行 (kind="e2e") や関節角度が取れなかった行が
+  混ざっていても、状態値の行だけを読み込めること
+- e2e.jsonlが別にあっても読み込みに影響しないこと
+"""
+import json
+import os
+import tempfile
+
+from log_viewer import LogLoader
+
+
+def write_jsonl(path, records):
+    with open(path, "w") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+
+
+def check_state_with_e2e():
+    with tempfile.TemporaryDirectory() as log_dir:
+        d = os.path.join(log_dir, "20260101", "120000")
+        os.makedirs(d)
+        e2e = dict(
+            kind="e2e", clock_offset_ms=1.5, min_rtt_ms=3.0,
+            mqtt_rtt=dict(count=10, p50_ms=3.2, p99_ms=5.0, max_ms=6.0))
+        states = []
+        for i in range(5):
+            states.append(dict(
+                time=100.0 + i, kind="state",
+                joint=[float(i + j) for j in range(6)],
+                pose=[float(10 * i + j) for j in range(6)]))
+        write_jsonl(os.path.join(d, "state.jsonl"), [
+            states[0],
+            dict(time=100.5, **e2e),
+            states[1],
+            dict(time=101.5, kind="state", joint=None, pose=None),
+            states[2],
+            dict(time=102.5, **e2e),
+            states[3],
+            states[4],
+        ])
+        write_jsonl(os.path.join(d, "e2e.jsonl"), [
+            dict(time=100.5, **e2e), dict(time=102.5, **e2e)])
+
+        loader = LogLoader(log_dir)
+        dfs = loader.load_state("20260101", "120000")
+        assert list(dfs.keys()) == ["state"], dfs.keys()
+        df = dfs["state"]
+        assert len(df) == len(states)
+        assert list(df["time"]) == [s["time"] for s in states]
+        for i in range(6):
+            assert list(df[f"J{i+1}"]) == [s["joint"][i] for s in states]
+        assert list(df["RZ"]) == [s["pose"][5] for s in states]
+    print("state.jsonl with e2e lines: OK")
+
+
+if __name__ == "__main__":
+    check_state_with_e2e()
@@ -0,0 +1,113 @@
+"""
+TargetMailboxの確認。
+- 取り出す前に置かれた目標値は最新の1件にまとめられ、まとめた数を数えること
+- 古い通し番号の目標値を捨て、飛びと遅れて届いたものを数えること、
+  大きく戻った場合は送信側の再起動として受け付けること
+- 送信時刻をClockSyncの時計のずれで換算し、受信時刻以前になること。
+  ずれを推定する前は受信時刻を使い、送信側の再起動で推定し直すこと
+- WANの途切れの後にまとめて届いた場合に、共有メモリへの書き込みが
+  まとめられること (受信スレッドと取り込みのスレッド)
+"""
+import threading
+import time
+
+import numpy as np
+
+from jaka_control.clock_sync import ClockSync
+from jaka_control.mailbox import TargetMailbox
+
+MS = 1_000_000
+
+
+def check_sequence():
+    mb = TargetMailbox(reorder_window=100)
+    for seq in [1, 2, 3]:
+        assert mb.put([seq], seq * MS, b"", seq=seq)
+    assert mb.take(0).joints == [3] and mb.n_coalesced == 2
+    assert mb.take(0) is None
+    # 5, 6が飛んで7が届き、その後に6が遅れて届く
+    assert mb.put([4], 4 * MS, b"", seq=4)
+    assert mb.put([7], 7 * MS, b"", seq=7)
+    assert mb.n_dropped == 2
+    assert not mb.put([6], 8 * MS, b"", seq=6)
+    assert not mb.put([7], 8 * MS, b"", seq=7)
+    assert mb.n_dropped == 1 and mb.n_reordered == 2
+    assert mb.take(0).joints == [7]
+    # 送信側の再起動 (reorder_windowより大きく戻る)
+    assert mb.put([1000], 9 * MS, b"", seq=1000)
+    assert mb.put([1], 10 * MS, b"", seq=1)
+    assert mb.take(0).joints == [1]
+    # 通し番号の一周
+    mb = TargetMailbox()
+    assert mb.put([0], 0, b"", seq=0xFFFFFFFF)
+    assert mb.put([1], 1, b"", seq=0)
+    assert mb.n_dropped == 0 and mb.n_reordered == 0
+    print("TargetMailbox: coalesced, reordered and dropped counts OK")
+
+
+def check_clock():
+    rng = np.random.default_rng(0)
+    clock = ClockSync()
+    mb = TargetMailbox(reorder_window=100, clock=clock)
+    # 送信側の時計は受信側より1000 s進んでおり、片道の遅延は5 ms + 揺らぎ
+    offset = 1000 * 10**9
+    t_send = np.arange(1000) * 11 * MS
+    t_recv = t_send + 5 * MS + (rng.exponential(3, size=1000) * MS).astype(int)
+    # 時計のずれを推定する前は受信時刻
+    mb.put([0], int(t_recv[0]), b"", seq=1, sender_time_ns=int(t_send[0]) + offset)
+    assert mb.take(0).t_ns == t_recv[0]
+    for k in range(16):
+        t0 = k * 500 * MS
+        ping = clock.make_ping(t0)
+        t1 = t0 + 5 * MS + int(rng.exponential(1 * MS)) + offset
+        t3 = t1 + MS - offset + 5 * MS + int(rng.exponential(3 * MS))
+        clock.on_pong(dict(ping, t1=t1, t2=t1 + MS), t3)
+    mapped = []
+    for i in range(1, 1000):
+        mb.put([i], int(t_recv[i]), b"", seq=i + 1,
+               sender_time_ns=int(t_send[i]) + offset)
+        mapped.append(mb.take(0).t_ns)
+    mapped = np.array(mapped)
+    assert np.all(mapped <= t_recv[1:])
+    err = np.abs(mapped - t_send[1:]) / MS
+    assert np.median(err) < 1.0, np.median(err)
+    # 送信側の再起動で推定を捨て、次のpongまでは受信時刻
+    mb.put([0], 10**12, b"", seq=1, sender_time_ns=0)
+    assert clock.offset_ns is None and mb.take(0).t_ns == 10**12
+    print(f"ClockSync in TargetMailbox: mapped send time error "
+          f"{np.median(err):.2f} ms (median), {err.max():.2f} ms (max)")
+
+
+def check_burst(n_burst=500, write_us=50):
+    """途切れの後にn_burst件がまとめて届き、1件の書き込みにwrite_usかかる場合"""
+    mb = TargetMailbox()
+    stop = False
+    written = []
+
+    def ingest():
+        while not stop:
+            target = mb.take(0.1)
+            if target is None:
+                continue
+            t_end = time.perf_counter() + write_us / 1e6
+            while time.perf_counter() < t_end:
+                pass
+            written.append(target.joints[0])
+
+    th = threading.Thread(target=ingest)
+    th.start()
+    for seq in range(1, n_burst + 1):
+        mb.put([seq], time.monotonic_ns(), b"", seq=seq)
+    time.sleep(0.2)
+    stop = True
+    th.join()
+    assert written[-1] == n_burst, written[-1]
+    assert mb.n_coalesced + len(written) == n_burst
+    print(f"burst of {n_burst} targets: {len(written)} written to shared "
+          f"memory, {mb.n_coalesced} coalesced")
+
+
+if __name__ == '__main__':
+    check_sequence()
+    check_clock()
+    check_burst()
@@ -0,0 +1,75 @@
+"""
+Notifierの確認。
+- 別プロセス (fork、spawn) で待っているプロセスが通知で起きること
+- 待っている間に溜まった複数の通知はまとめて1回として読み出されること
+- 通知から起きるまでの時間と待っている間のCPU時間を、
+  sleepで周期的にフラグを確認する場合と比較する
+"""
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from jaka_control.notify import Notifier
+
+N_ROUNDS = 200
+
+
+def waiter(notifier, flag, times, use_notify, interval):
+    """flagが立つのを待ち、起きた時刻を記録して折り返す"""
+    t_cpu = time.process_time()
+    for i in range(N_ROUNDS):
+        while flag.value != i + 1:
+            if use_notify:
+                notifier.wait(1)
+            else:
+                time.sleep(interval)
+        times[i] = time.perf_counter_ns()
+    times[N_ROUNDS] = int((time.process_time() - t_cpu) * 1e9)
+
+
+def measure(ctx, use_notify, interval=0.008, gap=0.02):
+    notifier = Notifier()
+    flag = ctx.Value("i", 0, lock=False)
+    times = ctx.Array("q", N_ROUNDS + 1, lock=False)
+    p = ctx.Process(
+        target=waiter, args=(notifier, flag, times, use_notify, interval))
+    p.start()
+    time.sleep(0.5)
+    sent = np.zeros(N_ROUNDS, dtype=np.int64)
+    for i in range(N_ROUNDS):
+        time.sleep(gap)
+        sent[i] = time.perf_counter_ns()
+        flag.value = i + 1
+        notifier.notify()
+    p.join()
+    notifier.close()
+    latency_us = (np.array(times[:N_ROUNDS]) - sent) / 1000
+    cpu_ms = times[N_ROUNDS] / 1e6
+    return latency_us, cpu_ms
+
+
+def check_coalesce():
+    notifier = Notifier()
+    for _ in range(5):
+        notifier.notify()
+    assert notifier.wait(0)
+    assert not notifier.wait(0)
+    t0 = time.perf_counter()
+    assert not notifier.wait(0.05)
+    assert time.perf_counter() - t0 >= 0.04
+    notifier.close()
+    print(f"Notifier ({notifier.kind}): notifications are coalesced, "
+          f"wait times out")
+
+
+if __name__ == '__main__':
+    check_coalesce()
+    print("wake latency (us)      p50     p99     max  waiter CPU (ms)")
+    for method in ["fork", "spawn"]:
+        ctx = mp.get_context(method)
+        for name, use_notify in [("notify", True), ("sleep 8 ms", False)]:
+            latency, cpu = measure(ctx, use_notify)
+            p50, p99 = np.percentile(latency, [50, 99])
+            print(f"{method:5s} {name:12s} {p50:8.0f} {p99:7.0f} "
+                  f"{latency.max():7.0f}  {cpu:10.1f}")
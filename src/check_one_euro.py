@@ -0,0 +1,74 @@
+"""
+filter_kind="original" (SMAFilter) と "one_euro" (OneEuroFilter) の
+遅延と揺れを、jaka_control.replayで同じ目標値の列に対して比較する。
+
+引数なしの場合は、VRコントローラのように60 Hzで更新され、
+手の震え程度のノイズを含む目標値を合成して使う。
+control.jsonlを指定した場合は、記録された目標値を使う。
+
+python check_one_euro.py [log/日付/時刻/control.jsonl]
+"""
+import argparse
+import itertools
+
+import numpy as np
+
+from jaka_control.config import DEFAULT_JOINT, T_INTV
+from jaka_control.replay import (
+    load_control_log, replay, snap_times, split_segments, summarize
+)
+
+
+def make_targets(duration: float = 60, t_intv: float = T_INTV, seed: int = 0):
+    """ゆっくり動く区間と速く動く区間を含む、ノイズのある目標値"""
+    rng = np.random.default_rng(seed)
+    n_times = int(duration / t_intv)
+    ts = np.arange(n_times) * t_intv
+    t_arrivals = np.cumsum(rng.normal(1 / 60, 0.002, size=n_times))
+    # 10秒ごとに速さが変わる
+    speed = np.where((t_arrivals // 10) % 2 == 0, 0.05, 0.4)
+    phase = np.cumsum(speed * np.diff(t_arrivals, prepend=0))
+    values = (
+        30 * np.sin(2 * np.pi * phase[:, None] + np.arange(6))
+        + np.array(DEFAULT_JOINT)
+        + rng.normal(0, 0.05, size=(n_times, 6))
+    )
+    idx = np.searchsorted(t_arrivals, ts, side="right")
+    return ts, values[np.maximum(idx - 1, 0)]
+
+
+def compare(ts: np.ndarray, targets: np.ndarray) -> None:
+    print("filter     params                  lag (ms)  jitter (deg/s^2)  "
+          "rmse (deg)")
+    n_windows = [5, 10, 20]
+    s = summarize(replay(
+        ts, targets, filter_kind="original", n_windows=n_windows))
+    for b, n in enumerate(n_windows):
+        print(f"original   n_windows={n:<13d} "
+              f"{s['lag'][b] * 1000:8.0f}  {s['jitter'][b]:16.1f}  "
+              f"{s['rmse'][b]:10.3f}")
+    grid = list(itertools.product([0.5, 1.0, 2.0], [0.005, 0.02, 0.05]))
+    min_cutoffs, betas = map(np.array, zip(*grid))
+    s = summarize(replay(
+        ts, targets, filter_kind="one_euro",
+        one_euro_min_cutoff=min_cutoffs, one_euro_beta=betas))
+    for b, (fc, beta) in enumerate(grid):
+        print(f"one_euro   fc={fc:<4.1f} beta={beta:<7.3f} "
+              f"{s['lag'][b] * 1000:8.0f}  {s['jitter'][b]:16.1f}  "
+              f"{s['rmse'][b]:10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", help="control.jsonl")
+    args = parser.parse_args()
+    if args.path is None:
+        compare(*make_targets())
+    else:
+        ts_all, targets_all = load_control_log(args.path)["target"]
+        for seg in split_segments(ts_all):
+            if seg.stop - seg.start < 2:
+                continue
+            print(f"Segment {ts_all[seg][0]:.3f}: "
+                  f"{seg.stop - seg.start} cycles")
+            compare(snap_times(ts_all[seg]), targets_all[seg])
@@ -0,0 +1,137 @@
+"""
+RCPoolの確認。check_servo_pipeline.MockControllerにつなぐ。
+- 別スレッドが状態を問い合わせ続けている間に8 ms周期でservo_jを送るときの
+  servo_jの呼び出しの時間を、1つの接続を共有する場合 (以前の動作) と比較する
+- 接続が切れた場合に、queryはログインし直して送り直し、
+  check_healthが切れた接続をログインし直すこと
+- 別スレッドがコマンドを送受信している間にログインし直しても
+  (RCPool.loginと確認のスレッド)、そのコマンドが失敗しないこと
+"""
+import threading
+import time
+
+import numpy as np
+
+from check_servo_pipeline import MockController, T_INTV
+from jaka_control.jkrc_reply import ReplyDesyncError
+from jaka_control.rc_pool import RCPool
+
+N_CYCLES = 500
+
+
+def run(shared, pipelined):
+    controller = MockController(delay_ms=(2.0, 4.0))
+    pool = RCPool("127.0.0.1", controller.port, shared=shared)
+    pool.login()
+    servo = pool["servo"]
+    if pipelined:
+        servo.start_servo_pipeline(max_in_flight=4)
+    stop = threading.Event()
+
+    def query():
+        # ハンドのスレッドなどからの問い合わせ
+        while not stop.is_set():
+            pool.call("query", "get_robot_state")
+            time.sleep(0.003)
+
+    th = threading.Thread(target=query)
+    th.start()
+    call_ms = np.empty(N_CYCLES)
+    t_next = time.perf_counter()
+    for i in range(N_CYCLES):
+        t_next += T_INTV
+        t0 = time.perf_counter()
+        assert servo.servo_j([0.0] * 6, 1) == (0,)
+        call_ms[i] = (time.perf_counter() - t0) * 1000
+        time.sleep(max(0.0, t_next - time.perf_counter()))
+    stop.set()
+    th.join()
+    if pipelined:
+        assert servo.stop_servo_pipeline() == (0,)
+    pool.logout()
+    return call_ms
+
+
+def bench():
+    print("servo_j while another thread queries, controller replies in 2-4 ms")
+    print("                          call p50 (ms)  p99 (ms)  max (ms)")
+    for pipelined in [False, True]:
+        for shared in [True, False]:
+            call_ms = run(shared, pipelined)
+            p50, p99 = np.percentile(call_ms, [50, 99])
+            name = ("shared" if shared else "pool") + \
+                (" + pipelined" if pipelined else "")
+            print(f"{name:26s} {p50:12.3f} {p99:9.3f} {call_ms.max():9.3f}")
+
+
+def check_relogin():
+    controller = MockController(delay_ms=(0.5, 1.0))
+    pool = RCPool("127.0.0.1", controller.port)
+    pool.login()
+    time.sleep(0.05)
+    assert controller.n_connections == 3
+    controller.drop_connections()
+    time.sleep(0.05)
+    # queryは送り直す
+    assert pool.call("query", "get_robot_state") == (0, 1, 1)
+    assert pool.n_relogins["query"] == 1
+    # motionは送り直さずにエラーにする
+    try:
+        pool.call("motion", "clear_error")
+        raise AssertionError("no error")
+    except (OSError, ReplyDesyncError):
+        pass
+    assert pool.n_relogins["motion"] == 1
+    assert pool.call("motion", "clear_error") == (0,)
+    # check_healthは切れた接続をログインし直す (servoは確かめない)
+    controller.drop_connections()
+    time.sleep(0.05)
+    health = pool.check_health()
+    assert health == {"query": False, "motion": False}, health
+    assert pool.check_health() == {"query": True, "motion": True}
+    assert pool.n_relogins == {"servo": 0, "query": 2, "motion": 2}
+    pool.logout()
+    print("RCPool: dropped connections logged in again")
+
+
+def check_login_while_busy(n_logins=30):
+    controller = MockController(delay_ms=(0.5, 2.0))
+    pool = RCPool("127.0.0.1", controller.port)
+    pool.login()
+    pool.start_health_monitor(0.005)
+    stop = threading.Event()
+    errors = []
+    n_calls = [0]
+
+    def busy(role, name):
+        # motionは送り直さないので、送受信の途中で切られれば例外になる
+        while not stop.is_set():
+            try:
+                res = pool.call(role, name)
+                assert res[0] == 0, res
+                n_calls[0] += 1
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=busy, args=args)
+               for args in [("motion", "clear_error"),
+                            ("query", "get_robot_state")]]
+    for th in threads:
+        th.start()
+    for _ in range(n_logins):
+        pool.login()
+        time.sleep(0.01)
+    stop.set()
+    for th in threads:
+        th.join()
+    assert pool._health_thread is not None
+    pool.logout()
+    assert not errors, errors[:5]
+    print(f"RCPool: {n_logins} logins while {n_calls[0]} commands were sent "
+          f"from other threads, no errors")
+
+
+if __name__ == '__main__':
+    check_relogin()
+    check_login_while_busy()
+    bench()
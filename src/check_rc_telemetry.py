@@ -0,0 +1,75 @@
+"""
+RC.command_stats (RCTelemetry) の確認。
+check_servo_pipeline.MockControllerにつなぎ、
+- 応答を待つ場合とパイプラインの場合の両方で、cmdNameごとの件数と
+  エラーコードが数えられ、往復の時間が模擬コントローラーの遅延と合うこと
+- 応答がない場合にタイムアウトとして数えられること
+- 1件の記録にかかる時間
+"""
+import socket
+import threading
+import time
+
+import numpy as np
+
+from check_servo_pipeline import MockController, connect
+from jaka_control.jkrc import RC
+from jaka_control.rc_telemetry import RCTelemetry
+
+
+def check_counts():
+    controller = MockController(delay_ms=(2.0, 4.0), error_at=10)
+    rc = connect(controller)
+    for i in range(20):
+        rc.servo_j([0.0] * 6, 1)
+    rc.get_robot_state()
+    rc.start_servo_pipeline(max_in_flight=4)
+    for i in range(50):
+        assert rc.servo_j([0.0] * 6, 1) == (0,)
+        time.sleep(0.008)
+    rc.get_robot_state()
+    assert rc.stop_servo_pipeline() == (0,)
+    stats = rc.command_stats()
+    assert stats["servo_j"]["count"] == 70
+    assert stats["servo_j"]["errors"] == {2: 1}
+    assert stats["get_robot_state"]["count"] == 2
+    assert 2.0 <= stats["servo_j"]["p50"] <= 5.0, stats
+    print(rc.telemetry.format_summary())
+    rc.logout()
+
+
+def check_timeout():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    # 接続を受け付けるが応答しない
+    conns = []
+    threading.Thread(
+        target=lambda: conns.append(server.accept()), daemon=True).start()
+    rc = RC(ip="127.0.0.1", port=server.getsockname()[1], timeout=0.1)
+    rc.login()
+    try:
+        rc.get_robot_state()
+        raise AssertionError("no timeout")
+    except TimeoutError:
+        pass
+    stats = rc.command_stats()
+    assert stats["get_robot_state"]["timeouts"] == 1
+    assert stats["get_robot_state"]["count"] == 0
+    print("timeouts are counted")
+    rc.logout()
+
+
+def bench(n=100000):
+    telemetry = RCTelemetry(log_interval=None)
+    t0 = time.perf_counter_ns()
+    for i in range(n):
+        telemetry.record("servo_j", i, i + 3_000_000, 0)
+    us = (time.perf_counter_ns() - t0) / n / 1000
+    print(f"record: {us:.2f} us per reply")
+
+
+if __name__ == '__main__':
+    check_counts()
+    check_timeout()
+    bench()
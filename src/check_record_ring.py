@@ -0,0 +1,176 @@
+"""
+RecordRingの確認。
+- 別プロセスから書き込んだ記録が欠けず順番通りに読み出せること
+- 読み出しが止まった場合は書き込み側が待たずに捨て、溢れた件数が数えられること
+- ヘッダのない以前の形式、バージョンや容量の異なる共有メモリには接続せず、
+  作成時は作り直すこと
+- 1周期分の書き込みの時間をmultiprocessing.Queueへのputと比較する
+"""
+import multiprocessing as mp
+import multiprocessing.shared_memory
+import time
+
+import numpy as np
+
+from jaka_control.config import RECORD_RING_SHM_NAME
+from jaka_control.record_ring import (
+    F_EXTRA, F_JOINT, F_KIND, F_TIME, KIND_CONTROL, KIND_TARGET,
+    KIND_TARGET_DELAYED, RECORD_SIZE, RecordRing, record_to_dict
+)
+from jaka_control.shm import ShmSchemaError
+
+
+def make_records(k: int) -> np.ndarray:
+    records = np.zeros((3, RECORD_SIZE))
+    records[:, F_TIME] = k
+    records[:, F_KIND] = [KIND_TARGET, KIND_TARGET_DELAYED, KIND_CONTROL]
+    records[:, F_JOINT] = k + np.arange(6)
+    records[:, F_EXTRA:] = k * 0.5
+    return records
+
+
+def producer(n_cycles: int, capacity: int) -> None:
+    ring = RecordRing(capacity=capacity)
+    records = make_records(0)
+    k = 0
+    while k < n_cycles:
+        records[:, F_TIME] = k
+        records[:, F_JOINT] = k + np.arange(6)
+        records[:, F_EXTRA:] = k * 0.5
+        # 溢れたら同じ周期をやり直す (確認用。制御プロセスでは捨てる)
+        if ring.push(records):
+            k += 1
+    ring.close()
+
+
+def check_order(n_cycles: int = 200000):
+    ring = RecordRing(create=True, capacity=1000)
+    try:
+        p = mp.Process(target=producer, args=(n_cycles, ring.capacity))
+        p.start()
+        buf = np.zeros((256, RECORD_SIZE))
+        n_read = 0
+        while n_read < 3 * n_cycles:
+            n = ring.drain(buf)
+            for record in buf[:n]:
+                k, j = divmod(n_read, 3)
+                assert record[F_TIME] == k and record[F_KIND] == j, (k, j)
+                assert np.array_equal(record[F_JOINT], k + np.arange(6))
+                assert np.all(record[F_EXTRA:] == k * 0.5)
+                n_read += 1
+        p.join()
+        print(f"Read {n_read} records in order from another process "
+              f"({ring.overflows} records rejected while the reader "
+              f"caught up)")
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def check_overflow():
+    ring = RecordRing(create=True, capacity=100)
+    try:
+        for k in range(50):
+            ring.push(make_records(k))
+        # 33周期 (99件) までは入り、残りは捨てられる
+        assert ring.overflows == 3 * (50 - 33), ring.overflows
+        buf = np.zeros((1000, RECORD_SIZE))
+        n = ring.drain(buf)
+        assert n == 99 and buf[n - 1, F_TIME] == 32
+        assert record_to_dict(buf[2]) == dict(
+            time=0.0, kind="control", joint=[0.0, 1, 2, 3, 4, 5],
+            max_ratio=0.0, accel_max_ratio=0.0, jerk_max_ratio=0.0)
+        # 読み出した後は再び書き込める
+        assert ring.push(make_records(50))
+        print(f"Overflow counted: {ring.overflows} records dropped")
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def check_attach():
+    # ヘッダのない以前の形式 ([件数 (4), 記録] のint64とfloat64の配列)
+    old = mp.shared_memory.SharedMemory(
+        create=True, size=8 * (8 + 100 * RECORD_SIZE),
+        name=RECORD_RING_SHM_NAME)
+    try:
+        try:
+            RecordRing(capacity=100)
+        except ShmSchemaError as e:
+            print(f"Rejected old layout: {e}")
+        else:
+            raise AssertionError("old layout was not detected")
+        ring = RecordRing(create=True, capacity=100)
+        ring2 = RecordRing(capacity=100)
+        assert ring.push(make_records(1))
+        buf = np.zeros((10, RECORD_SIZE))
+        assert ring2.drain(buf) == 3 and buf[0, F_TIME] == 1
+        # 容量が異なる
+        try:
+            RecordRing(capacity=200)
+        except ShmSchemaError as e:
+            print(f"Rejected capacity: {e}")
+        else:
+            raise AssertionError("capacity mismatch was not detected")
+        # 別のバージョンのヘッダ
+        header = np.ndarray((), dtype="<u4", buffer=ring.sm.buf)
+        header[...] += 1
+        try:
+            RecordRing(capacity=100)
+        except ShmSchemaError as e:
+            print(f"Rejected version: {e}")
+        else:
+            raise AssertionError("version mismatch was not detected")
+        del header
+        ring2.close()
+        ring.close()
+    finally:
+        old.close()
+        old.unlink()
+
+
+def consumer(q, n_cycles: int) -> None:
+    for _ in range(n_cycles):
+        q.get()
+
+
+def bench(n_cycles: int = 20000):
+    """
+    書き込み側のプロセスのCPU時間で比べる。
+    Queueはputした後にフィーダースレッドがpickleしてパイプに書くので、
+    その分も含まれるようにすべて送り終えるまで計測する
+    """
+    ring = RecordRing(create=True)
+    q = mp.Queue()
+    try:
+        records = make_records(0)
+        buf = np.zeros((ring.capacity, RECORD_SIZE))
+        t0 = time.process_time()
+        for k in range(n_cycles):
+            if not ring.push(records):
+                ring.drain(buf)
+        t_ring = (time.process_time() - t0) / n_cycles
+
+        datum = [record_to_dict(r) for r in records]
+        p = mp.Process(target=consumer, args=(q, n_cycles))
+        p.start()
+        t0 = time.process_time()
+        for k in range(n_cycles):
+            q.put(datum)
+        q.close()
+        q.join_thread()
+        t_queue = (time.process_time() - t0) / n_cycles
+        p.join()
+        print(f"Per-cycle CPU time of the writer: "
+              f"RecordRing.push {t_ring * 1e6:.1f} us, "
+              f"Queue.put {t_queue * 1e6:.1f} us")
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+if __name__ == '__main__':
+    check_attach()
+    check_overflow()
+    check_order()
+    bench()
@@ -0,0 +1,224 @@
+"""
+jaka_control.replayの確認とパラメータの探索。
+
+引数なしの場合は、合成した目標値の列に対して
+control_loopと同じ処理を1周期ずつ計算したものとバッチでの再現が
+完全に一致すること、時間方向にまとめた補間が
+RingDelayedInterpolatorと完全に一致することを確認し、
+1時間分の処理時間を計測する。
+control.jsonlを指定した場合は、記録された目標値に対して
+パラメータの組み合わせを掃引し、評価値を表示する。
+
+python check_replay.py [log/日付/時刻/control.jsonl]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from jaka_control.config import ACCEL_LIMITS, SPEED_LIMIT, T_INTV
+from jaka_control.filter import SMAFilter
+from jaka_control.interpolate import RingDelayedInterpolator
+from jaka_control.replay import (
+    delay_targets, load_control_log, replay, replay_grid, snap_times,
+    split_segments, summarize
+)
+
+
+def make_targets(n_times: int, t_intv: float = T_INTV, seed: int = 0):
+    """60 Hz程度で更新される、ときどき速度制限を超える目標値"""
+    rng = np.random.default_rng(seed)
+    ts = np.arange(n_times) * t_intv
+    t_arrivals = np.cumsum(rng.normal(1 / 60, 0.002, size=n_times))
+    phase = rng.uniform(0, 2 * np.pi, size=6)
+    values = 60 * np.sin(
+        2 * np.pi * 0.3 * t_arrivals[:, None] + phase) + np.array(
+            [-270, 110, 90, 70, -90, 45])
+    # ときどき大きく飛ぶ
+    jumps = rng.random(n_times) < 0.002
+    values[jumps] += rng.normal(0, 20, size=(jumps.sum(), 6))
+    idx = np.searchsorted(t_arrivals, ts, side="right")
+    return ts, values[np.maximum(idx - 1, 0)]
+
+
+def reference_original(
+    ts, targets, n_windows, speed_limit_ratio, accel_limit_ratio,
+    stopped_velocity_eps=1e-4,
+):
+    """control_loopのfilter_kind="original"の処理を1周期ずつ計算する"""
+    accel_limits = np.array(ACCEL_LIMITS)
+    state = targets[0]
+    di = RingDelayedInterpolator(delay=0.1)
+    di.reset(ts[0], targets[0])
+    last_target_delayed = di.read(ts[0], targets[0]).copy()
+    last_control = state
+    _filter = SMAFilter(n_windows=n_windows)
+    _filter.reset(state)
+    last_target_delayed_velocity = np.zeros(6)
+    last_control_velocity = np.zeros(6)
+    controls = [last_control]
+    for k in range(1, len(ts)):
+        dt = ts[k] - ts[k - 1]
+        target_delayed = di.read(ts[k], targets[k])
+        target_diff = target_delayed - last_target_delayed
+        v = target_diff / dt
+        max_ratio = np.max(np.abs(v) / (speed_limit_ratio * SPEED_LIMIT))
+        if max_ratio > 1:
+            v /= max_ratio
+        a = (v - last_target_delayed_velocity) / dt
+        accel_max_ratio = np.max(
+            np.abs(a) / (accel_limit_ratio * accel_limits))
+        if accel_max_ratio > 1:
+            a /= accel_max_ratio
+        v = last_target_delayed_velocity + a * dt
+        d = v * dt
+        if np.all(d / dt < stopped_velocity_eps):
+            d = np.zeros_like(d)
+            v = d / dt
+        last_target_delayed_velocity = v
+        target_delayed = last_target_delayed + d
+        last_target_delayed = target_delayed
+
+        target_filtered = _filter.predict_only(target_delayed)
+        target_diff = target_filtered - last_control
+        v = target_diff / dt
+        max_ratio = np.max(np.abs(v) / (speed_limit_ratio * SPEED_LIMIT))
+        if max_ratio > 1:
+            v /= max_ratio
+        a = (v - last_control_velocity) / dt
+        accel_max_ratio = np.max(
+            np.abs(a) / (accel_limit_ratio * accel_limits))
+        if accel_max_ratio > 1:
+            a /= accel_max_ratio
+        v = last_control_velocity + a * dt
+        d = v * dt
+        if np.all(d / dt < stopped_velocity_eps):
+            d = np.zeros_like(d)
+            v = d / dt
+        last_control_velocity = v
+        last_control = last_control + d
+        _filter.filter(last_control)
+        controls.append(last_control)
+    return np.array(controls)
+
+
+def check_reference():
+    ts, targets = make_targets(5000)
+    grid = [(5, 0.5, 0.5), (10, 0.5, 0.5), (20, 0.3, 0.8)]
+    ret = replay(
+        ts, targets,
+        n_windows=[g[0] for g in grid],
+        speed_limit_ratio=[g[1] for g in grid],
+        accel_limit_ratio=[g[2] for g in grid],
+    )
+    for b, g in enumerate(grid):
+        ref = reference_original(ts, targets, *g)
+        assert np.array_equal(ref, ret["control"][b]), f"Results differ: {g}"
+    print("Batch replay matches step-by-step control_loop")
+
+
+def check_delay_targets():
+    """
+    時間方向にまとめた補間が1周期ずつの補間と完全に一致すること。
+    目標値が遅延の2倍より長く止まってバッファが空になる場合と、
+    バッファが溢れて1周期ずつの計算に戻る場合を含む
+    """
+    ts, targets = make_targets(20000)
+    targets = targets.copy()
+    for start, length in [(1000, 300), (5000, 30), (5040, 200), (12000, 26)]:
+        targets[start:start + length] = targets[start]
+    for delay, capacity in [(0.1, 256), (0.05, 256), (0.3, 256), (1.0, 64)]:
+        di = RingDelayedInterpolator(delay=delay, capacity=capacity)
+        di.reset(ts[0], targets[0])
+        ref = np.array([di.read(t, x).copy() for t, x in zip(ts, targets)])
+        out = delay_targets(ts, targets, delay, capacity=capacity)
+        assert np.array_equal(ref, out), f"Results differ: {delay}"
+    print("Vectorized interpolation matches RingDelayedInterpolator")
+
+
+def check_speed(duration: float = 3600):
+    """1組だけのreplayと、replay_gridでまとめた場合の1組あたりの時間"""
+    ts, targets = make_targets(int(duration / T_INTV))
+    for n_batch in [1, 16, 64]:
+        t0 = time.perf_counter()
+        replay_grid(ts, targets, dict(
+            n_windows=np.linspace(5, 40, n_batch).astype(int).tolist()))
+        elapsed = time.perf_counter() - t0
+        print(
+            f"{duration:.0f} s of {1 / T_INTV:.0f} Hz data, "
+            f"{n_batch:2d} parameter sets: {elapsed:.1f} s "
+            f"({elapsed / n_batch:.2f} s per set)")
+
+
+def compare_jerk(ts, targets):
+    """
+    加加速度制限を入れて速度・加速度の比率を上げた場合と比較する。
+    加加速度の比率はロボットに送った差分 (sent) と整形前 (filter) のもの。
+    整形した場合は送った差分が制限を超えないことを確認する
+    """
+    ratios = np.array([0.5, 0.7, 0.9])
+    print("jerk_limit ratio  rmse  lag (ms)  max jerk ratio (sent/filter)  "
+          "over limit (sent/filter)")
+    for use_jerk_limit in [False, True]:
+        ret = replay(
+            ts, targets,
+            speed_limit_ratio=ratios,
+            accel_limit_ratio=ratios,
+            use_jerk_limit=use_jerk_limit,
+        )
+        s = summarize(ret)
+        filter_over = np.mean(ret["filter_jerk_max_ratio"][:, 1:] > 1, axis=1)
+        for b, r in enumerate(ratios):
+            print(f"{str(use_jerk_limit):10s} {r:5.1f}  {s['rmse'][b]:4.2f}  "
+                  f"{s['lag'][b] * 1000:8.0f}  "
+                  f"{ret['jerk_max_ratio'][b].max():13.2f} / "
+                  f"{ret['filter_jerk_max_ratio'][b].max():6.2f}  "
+                  f"{s['jerk_limited'][b]:11.3f} / {filter_over[b]:6.3f}")
+        if use_jerk_limit:
+            assert np.all(ret["jerk_max_ratio"] <= 1), \
+                ret["jerk_max_ratio"].max()
+    print("shaped commands stay within the jerk limit")
+
+
+def sweep(path: str):
+    log = load_control_log(path)
+    ts_all, targets_all = log["target"]
+    grid = dict(
+        n_windows=[5, 10, 20, 40],
+        speed_limit_ratio=[0.3, 0.5, 0.7],
+        accel_limit_ratio=[0.3, 0.5, 1.0],
+    )
+    for seg in split_segments(ts_all):
+        ts = snap_times(ts_all[seg])
+        if len(ts) < 2:
+            continue
+        targets = targets_all[seg]
+        print(f"Segment {ts_all[seg][0]:.3f}: {len(ts)} cycles")
+        t0 = time.perf_counter()
+        combos, s = replay_grid(ts, targets, grid)
+        elapsed = time.perf_counter() - t0
+        print(f"  replay: {elapsed:.1f} s for {len(combos)} parameter sets "
+              f"({elapsed / len(combos):.2f} s per set)")
+        print("  n_windows speed_ratio accel_ratio rmse max_err "
+              "speed_limited accel_limited")
+        for b, g in enumerate(combos):
+            print(
+                f"  {g['n_windows']:9d} {g['speed_limit_ratio']:11.1f} "
+                f"{g['accel_limit_ratio']:11.1f} "
+                f"{s['rmse'][b]:4.2f} {s['max_abs_error'][b]:7.2f} "
+                f"{s['speed_limited'][b]:13.3f} "
+                f"{s['accel_limited'][b]:13.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", help="control.jsonl")
+    parser.add_argument("--duration", type=float, default=3600)
+    args = parser.parse_args()
+    if args.path is None:
+        check_reference()
+        check_delay_targets()
+        compare_jerk(*make_targets(5000))
+        check_speed(args.duration)
+    else:
+        sweep(args.path)
@@ -0,0 +1,166 @@
+"""
+ReplyFramerとRCの応答の対応づけの確認。
+- ランダムな応答 (入れ子、文字列中の括弧とエスケープ、マルチバイト文字、
+  受信バッファより長いもの) の列を任意の位置で分割して与えても、
+  応答を1件ずつ元のとおりに切り出すこと
+- 応答の間に余分なデータがあればReplyDesyncErrorになること
+- RCで、タイムアウトで諦めた応答が後で届いても次のコマンドの応答にならないこと、
+  届かなくても次のコマンドの応答を捨てないこと、
+  cmdNameが異なる応答や、遅れた応答と区別できない応答をReplyDesyncErrorにすること
+- 1件の切り出しにかかる時間
+"""
+import json
+import random
+import socket
+import time
+
+from jaka_control.jkrc import RC
+from jaka_control.jkrc_reply import ReplyDesyncError, ReplyFramer
+
+N_STREAMS = 2000
+
+
+def random_reply(rng):
+    js = {"errorCode": str(rng.choice([0, 0, 0, 1, 2, -1])),
+          "errorMsg": rng.choice(["", "call servo_j failed", 'a{"}b\\', "日本語}{"]),
+          "cmdName": rng.choice(["servo_j", "get_joint_pos", "get_robot_state"])}
+    r = rng.random()
+    if r < 0.2:
+        js["joint_pos"] = [rng.uniform(-360, 360) for _ in range(6)]
+    elif r < 0.3:
+        js["nested"] = {"a": [{"b": "}"}, {}], "c": "\\\""}
+    elif r < 0.35:
+        # 受信バッファ (既定4096バイト) より長い応答
+        js["errorMsg"] = "x" * rng.randint(4000, 20000)
+    return json.dumps(js, ensure_ascii=rng.random() < 0.5,
+                      indent=rng.choice([None, None, 1]))
+
+
+def split_randomly(rng, data):
+    cuts = sorted(rng.sample(range(1, len(data)), min(len(data) - 1, rng.randint(0, 30))))
+    if rng.random() < 0.1:
+        # 1バイトずつ
+        cuts = range(1, len(data))
+    chunks = []
+    prev = 0
+    for c in list(cuts) + [len(data)]:
+        chunks.append(data[prev:c])
+        prev = c
+    return chunks
+
+
+def check_fragmentation():
+    rng = random.Random(0)
+    n_replies = 0
+    for _ in range(N_STREAMS):
+        replies = [random_reply(rng) for _ in range(rng.randint(1, 8))]
+        sep = rng.choice(["", "", "\n", " \r\n"])
+        data = sep.join(replies).encode()
+        framer = ReplyFramer(size=rng.choice([16, 4096]))
+        got = []
+        for chunk in split_randomly(rng, data):
+            framer.feed(chunk)
+            while (reply := framer.next_reply()) is not None:
+                got.append(reply)
+        assert got == replies, (got, replies)
+        assert framer.next_reply() is None
+        n_replies += len(replies)
+    print(f"ReplyFramer: {n_replies} replies in {N_STREAMS} randomly "
+          f"fragmented streams framed exactly")
+
+
+def check_garbage():
+    framer = ReplyFramer()
+    framer.feed(b'{"errorCode": "0"}x{"errorCode": "0"}')
+    assert framer.next_reply() == '{"errorCode": "0"}'
+    try:
+        framer.next_reply()
+        raise AssertionError("no desync")
+    except ReplyDesyncError:
+        pass
+    framer = ReplyFramer(size=16, max_size=64)
+    try:
+        framer.feed(b'{"a": "' + b"x" * 100)
+        raise AssertionError("no desync")
+    except ReplyDesyncError:
+        pass
+    print("ReplyFramer: data between replies and oversized replies detected")
+
+
+def reply(name):
+    return f'{{"errorCode": "0", "errorMsg": "", "cmdName": "{name}"}}'.encode()
+
+
+def check_rc():
+    a, b = socket.socketpair()
+    a.settimeout(0.1)
+    rc = RC(timeout=0.1)
+    rc._socket = a
+    # 1件目は応答が遅れてタイムアウトする
+    try:
+        rc.clear_error()
+        raise AssertionError("no timeout")
+    except TimeoutError:
+        pass
+    # 遅れた応答と次の応答が分割されて届く
+    data = reply("clear_error") + reply("power_on")
+    b.sendall(data[:50])
+    b.sendall(data[50:])
+    assert rc.power_on() == (0,)
+    # 諦めた応答が届かず、次のコマンドの応答が届く
+    try:
+        rc.enable_robot()
+        raise AssertionError("no timeout")
+    except TimeoutError:
+        pass
+    b.sendall(reply("power_on"))
+    t0 = time.perf_counter()
+    assert rc.power_on() == (0,)
+    assert time.perf_counter() - t0 < 0.05
+    # その後に遅れた応答が届けば異なるコマンドの応答になる
+    b.sendall(reply("enable_robot"))
+    try:
+        rc.power_on()
+        raise AssertionError("no desync")
+    except ReplyDesyncError:
+        pass
+    # 同じコマンドの遅れた応答とは区別できない
+    a2, b2 = socket.socketpair()
+    a2.settimeout(0.1)
+    rc._socket = a2
+    rc._framer.reset()
+    try:
+        rc.power_on()
+        raise AssertionError("no timeout")
+    except TimeoutError:
+        pass
+    b2.sendall(reply("power_on"))
+    try:
+        rc.power_on()
+        raise AssertionError("no desync")
+    except ReplyDesyncError:
+        pass
+    rc.logout()
+    a.close()
+    b.close()
+    b2.close()
+    print("RC: late reply discarded, missing late reply tolerated, "
+          "mismatched and ambiguous replies detected")
+
+
+def bench(n=100000):
+    data = reply("servo_j") * n
+    framer = ReplyFramer(size=len(data))
+    framer.feed(data)
+    t0 = time.perf_counter_ns()
+    for _ in range(n):
+        framer.next_reply()
+    us = (time.perf_counter_ns() - t0) / n / 1000
+    print(f"next_reply: {us:.2f} us per servo_j reply")
+
+
+if __name__ == '__main__':
+    check_fragmentation()
+    check_garbage()
+    check_rc()
+    bench()
@@ -0,0 +1,100 @@
+"""
+PeriodicSchedulerの確認。
+- 締め切りが開始時刻 + k * 周期の格子上にあり、処理時間で位相がずれないこと
+- 1周期以内の遅れ (オーバーラン) はすぐに実行し、次の締め切りで格子に戻ること
+- 1周期以上の遅れは過ぎた締め切りを読み飛ばし、読み飛ばした周期の数と
+  進んだ時間 (dt) が合うこと
+- statsのcyclesが格子点の番号ではなく、実行した周期の数であること
+"""
+import time
+
+from jaka_control.scheduler import PeriodicScheduler
+
+PERIOD = 0.02
+
+
+def check_grid(s: PeriodicScheduler, deadline: float) -> None:
+    """締め切りが格子上にあること (同じ式で計算しているので厳密に一致する)"""
+    assert deadline == s.t_start + s.k * s.period, (deadline, s.k)
+
+
+def check_on_time():
+    s = PeriodicScheduler(PERIOD)
+    for k in range(1, 21):
+        # 周期より短い処理時間
+        time.sleep(PERIOD * 0.3)
+        deadline = s.wait()
+        assert s.k == k
+        check_grid(s, deadline)
+        assert s.dt == PERIOD
+        assert time.perf_counter() >= deadline
+    assert s.n_overruns == 0 and s.n_skipped == 0, s.stats()
+    assert s.stats()["cycles"] == 20
+    print(f"on time: 20 cycles on the grid, "
+          f"max lateness {s.max_lateness * 1e6:.0f} us")
+
+
+def check_catch_up():
+    s = PeriodicScheduler(PERIOD)
+    s.wait()
+    # 1.5周期の処理時間。次の締め切りは過ぎているが1周期以内の遅れ
+    time.sleep(PERIOD * 1.5)
+    t0 = time.perf_counter()
+    deadline = s.wait()
+    # 待たずにすぐ実行し、締め切りは読み飛ばさない
+    assert time.perf_counter() - t0 < PERIOD * 0.25
+    assert s.k == 2 and s.dt == PERIOD
+    check_grid(s, deadline)
+    assert s.n_overruns == 1 and s.n_skipped == 0, s.stats()
+    # 次の締め切りで格子に戻る
+    deadline = s.wait()
+    assert s.k == 3 and s.dt == PERIOD
+    check_grid(s, deadline)
+    assert s.n_overruns == 1, s.stats()
+    assert s.stats()["cycles"] == 3
+    print("catch-up: a late cycle runs at once and the next one is on the grid")
+
+
+def check_skip():
+    s = PeriodicScheduler(PERIOD)
+    s.wait()
+    # 3.5周期の処理時間。締め切りを2つ読み飛ばし、3周期進む
+    time.sleep(PERIOD * 3.5)
+    deadline = s.wait()
+    assert s.k == 4, s.k
+    assert abs(s.dt - 3 * PERIOD) < 1e-12, s.dt
+    check_grid(s, deadline)
+    assert s.n_overruns == 1 and s.n_skipped == 2, s.stats()
+    deadline = s.wait()
+    assert s.k == 5 and s.dt == PERIOD
+    check_grid(s, deadline)
+    stats = s.stats()
+    # 格子点は5まで進んだが、実行したのは3周期
+    assert stats["cycles"] == 3, stats
+    assert stats["skipped"] == 2, stats
+    print("skip: overrun of 3.5 periods skips 2 deadlines, "
+          f"cycles={stats['cycles']} (grid index {s.k})")
+
+
+def check_restart():
+    s = PeriodicScheduler(PERIOD)
+    for _ in range(3):
+        s.wait()
+    t0 = time.perf_counter()
+    deadline = s.restart()
+    # 現在の時刻を締め切りにして、格子を置き直す
+    assert t0 <= deadline <= time.perf_counter()
+    assert s.k == 0 and s.t_start == deadline
+    assert s.stats()["cycles"] == 1
+    for k in range(1, 4):
+        deadline = s.wait()
+        check_grid(s, deadline)
+    assert s.stats()["cycles"] == 4
+    print("restart: the grid starts at the restart and counts that cycle")
+
+
+if __name__ == '__main__':
+    check_on_time()
+    check_catch_up()
+    check_skip()
+    check_restart()
@@ -0,0 +1,158 @@
+"""
+SeqLockのストレステスト。
+状態値、目標値、制御値のまとまりをそれぞれ別のプロセスから
+6要素すべて同じ値 (書き込みの回数) で書き続け、読み出した値に
+異なる回数の値が混ざらないこと、世代と書き込み時刻が値と対応すること、
+読めなかった場合は前回の値のままであることを確認する。
+形や型の合わない値の書き込みは世代を変えずに例外になり、その後も読めることを確認する。
+書き込み中で読めなかった場合、read_spinで書き込みの終わりを短く待って読めること、
+書き込みが終わらなければ決めた時間で諦めることを確認する。
+比較のためにseqlockを使わずに読んだ場合に混ざった回数も表示する。
+"""
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+
+from jaka_control.seqlock import POSE_GROUPS, PoseSeqLocks
+from jaka_control.shm import attach_shm, create_shm
+
+SHM_NAME = "jaka_seqlock_check"
+
+
+def writer(name: str, stop, interval: float) -> None:
+    sm, pose = attach_shm(SHM_NAME)
+    seqlock = getattr(PoseSeqLocks(pose), name)
+    values = [0.0] * 6
+    k = 0
+    while not stop.is_set():
+        k += 1
+        v = float(k)
+        for i in range(6):
+            values[i] = v
+        # 書き込み時刻の代わりに回数を書き、値と一緒に守られることを確認する
+        seqlock.write(values, k)
+        if interval > 0:
+            time.sleep(interval)
+    del seqlock, pose
+    sm.close()
+
+
+def check(interval: float, duration: float = 10.0, max_retries: int = 4):
+    """interval: 書き込みの間隔 (秒)。0で休まず書き続ける"""
+    sm, pose = create_shm(SHM_NAME)
+    try:
+        seqlocks = PoseSeqLocks(pose, max_retries=max_retries)
+        stop = mp.Event()
+        writers = [
+            mp.Process(target=writer, args=(name, stop, interval))
+            for name in POSE_GROUPS]
+        for p in writers:
+            p.start()
+        out = np.zeros(6)
+        n_reads = 0
+        n_torn_raw = 0
+        t_end = time.perf_counter() + duration
+        while time.perf_counter() < t_end:
+            for name in POSE_GROUPS:
+                seqlock = getattr(seqlocks, name)
+                last_generation = seqlock.generation
+                last = out.copy()
+                ok = seqlock.read(out)
+                n_reads += 1
+                if ok:
+                    assert np.all(out == out[0]), f"{name}: mixed {out}"
+                    # 書き込みk回目の後の世代は2kなので値は世代の半分
+                    assert out[0] == seqlock.generation / 2, name
+                    assert out[0] == seqlock.count == seqlock.time_ns, name
+                else:
+                    assert np.array_equal(out, last)
+                    assert seqlock.generation == last_generation
+                raw = pose[name].copy()
+                n_torn_raw += not np.all(raw == raw[0])
+        stop.set()
+        for p in writers:
+            p.join()
+        n_retries = sum(getattr(seqlocks, k).n_retries for k in POSE_GROUPS)
+        n_failures = sum(
+            getattr(seqlocks, k).n_failures for k in POSE_GROUPS)
+        print(f"Writers every {interval * 1000:.0f} ms: "
+              f"{n_reads} reads, no mixed values "
+              f"({n_retries} retries, {n_failures} reads kept the previous "
+              f"value after {max_retries} retries)")
+        print(f"  reads without seqlock that saw mixed values: {n_torn_raw}")
+        del seqlocks, pose
+    finally:
+        sm.close()
+        sm.unlink()
+
+
+def check_bad_write():
+    sm, pose = create_shm(SHM_NAME)
+    try:
+        seqlock = PoseSeqLocks(pose).target
+        seqlock.write([1.0] * 6, 1)
+        for bad in [[1.0] * 5, ["a"] * 6, [None] * 6]:
+            try:
+                seqlock.write(bad, 2)
+                raise AssertionError(f"no error: {bad}")
+            except (ValueError, TypeError):
+                pass
+            assert int(seqlock.seq) == 2
+        out = np.zeros(6)
+        assert seqlock.read(out) and np.all(out == 1.0) and seqlock.time_ns == 1
+        seqlock.write([2.0] * 6, 2)
+        assert seqlock.read(out) and np.all(out == 2.0) and seqlock.count == 2
+        print("Rejected writes left the seqlock readable")
+        del seqlock, pose
+    finally:
+        sm.close()
+        sm.unlink()
+
+
+def check_read_spin():
+    sm, pose = create_shm(SHM_NAME)
+    try:
+        seqlock = PoseSeqLocks(pose).state
+        seqlock.write([1.0] * 6, 1)
+        # 書き込みの途中 (世代が奇数) を作り、別スレッドで少し後に書き終える
+        seqlock.seq[...] = 3
+        seqlock.data[:] = 2.0
+
+        def finish():
+            time.sleep(0.0002)
+            seqlock.stamp[...] = 2
+            seqlock.seq[...] = 4
+
+        th = threading.Thread(target=finish)
+        out = np.zeros(6)
+        assert not seqlock.read(out) and np.all(out == 0.0)
+        th.start()
+        t0 = time.perf_counter()
+        assert seqlock.read_spin(out, 0.1)
+        elapsed = time.perf_counter() - t0
+        th.join()
+        assert np.all(out == 2.0) and seqlock.count == 2
+        assert elapsed < 0.05, elapsed
+        # 書き込みが終わらなければtimeoutで諦めて値は変えない
+        seqlock.seq[...] = 5
+        t0 = time.perf_counter()
+        assert not seqlock.read_spin(out, 0.002)
+        elapsed = time.perf_counter() - t0
+        assert 0.002 <= elapsed < 0.05, elapsed
+        assert np.all(out == 2.0) and seqlock.count == 2
+        print(f"read_spin: gave up after {elapsed * 1000:.1f} ms "
+              "on an unfinished write")
+        del seqlock, pose
+    finally:
+        sm.close()
+        sm.unlink()
+
+
+if __name__ == '__main__':
+    check_bad_write()
+    check_read_spin()
+    # 最悪の場合として休まず書き続ける場合と、実際に近い周期の場合
+    check(0.0)
+    check(0.008)
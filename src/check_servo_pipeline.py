@@ -0,0 +1,197 @@
+"""
+RC.start_servo_pipelineの確認。ロボットの代わりに、応答を遅らせて返す
+模擬コントローラーにつなぐ。
+- 応答が分割されたりまとめて届いたりしても、送信順に対応づけられること
+- パイプラインの動作中の他のコマンドが自分の応答を受け取ること
+- servo_jのエラーが次のservo_jの返り値で届き、stop_servo_pipelineでも返ること
+- 8 ms周期でservo_jを送るときの呼び出しの時間 (制御ループが止まる時間) を、
+  応答を待つ場合と比較する
+"""
+import random
+import socket
+import threading
+import time
+
+import numpy as np
+
+from jaka_control.jkrc import RC
+from jaka_control.jkrc_reply import ReplyFramer
+
+N_CYCLES = 500
+T_INTV = 0.008
+
+
+class MockController:
+    """
+    応答をdelay_ms (最小, 最大) の一様分布だけ遅らせて送信順に返す。
+    error_at番目 (1始まり) のservo_jにはエラーを返す。
+    応答は分割して送ったりまとめて送ったりする。複数の接続を受け付け、
+    接続ごとに独立に応答する
+    """
+    def __init__(self, delay_ms=(2.0, 6.0), error_at=None, seed=0):
+        self.delay_ms = delay_ms
+        self.error_at = error_at
+        self.rng = random.Random(seed)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(8)
+        self.port = self.server.getsockname()[1]
+        self.n_servo = 0
+        self.n_connections = 0
+        self.conns = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _reply(self, cmd):
+        name = cmd.split('"cmdName":')[1].split('"')[1]
+        if name == "servo_j":
+            self.n_servo += 1
+            if self.n_servo == self.error_at:
+                return ('{"errorCode": "2", "errorMsg": "call servo_j failed", '
+                        '"cmdName": "servo_j"}')
+            return '{"errorCode": "0", "errorMsg": "", "cmdName": "servo_j"}'
+        if name == "get_robot_state":
+            return ('{"enable": "robot_enabled", "power": "powered_on", '
+                    '"errorCode": "0", "errorMsg": "", '
+                    '"cmdName": "get_robot_state"}')
+        return f'{{"errorCode": "0", "errorMsg": "", "cmdName": "{name}"}}'
+
+    def drop_connections(self):
+        """受け付けた接続をすべて切る (コントローラーの再起動など)"""
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.conns = []
+
+    def _accept(self):
+        while True:
+            conn, _ = self.server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conns.append(conn)
+            self.n_connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        replies = []
+        cond = threading.Condition()
+        closed = [False]
+        threading.Thread(
+            target=self._send, args=(conn, replies, cond, closed),
+            daemon=True).start()
+        # コマンドもJSONのオブジェクトが続くストリーム
+        framer = ReplyFramer()
+        t_last = 0.0
+        try:
+            while framer.recv_from(conn) > 0:
+                while True:
+                    cmd = framer.next_reply()
+                    if cmd is None:
+                        break
+                    lo, hi = self.delay_ms
+                    t = time.perf_counter() + self.rng.uniform(lo, hi) / 1000
+                    # 応答は送信順
+                    t_last = max(t_last, t)
+                    with cond:
+                        replies.append((t_last, self._reply(cmd)))
+                        cond.notify()
+        except OSError:
+            pass
+        with cond:
+            closed[0] = True
+            cond.notify()
+
+    def _send(self, conn, replies, cond, closed):
+        while True:
+            with cond:
+                while not replies and not closed[0]:
+                    cond.wait()
+                if closed[0]:
+                    return
+                t, reply = replies.pop(0)
+                # 同じ時刻までの応答はまとめて送る
+                while replies and replies[0][0] <= t + 0.0005:
+                    reply += replies.pop(0)[1]
+            while time.perf_counter() < t:
+                time.sleep(0.0002)
+            data = reply.encode()
+            try:
+                if self.rng.random() < 0.3:
+                    # 分割して送る
+                    k = self.rng.randrange(1, len(data))
+                    conn.sendall(data[:k])
+                    time.sleep(0.0005)
+                    conn.sendall(data[k:])
+                else:
+                    conn.sendall(data)
+            except OSError:
+                return
+
+
+def connect(controller):
+    rc = RC(ip="127.0.0.1", port=controller.port, timeout=5)
+    rc.login()
+    return rc
+
+
+def run_loop(rc, n_cycles=N_CYCLES):
+    """8 ms周期でservo_jを送り、呼び出しの時間 (ms) を返す"""
+    call_ms = np.empty(n_cycles)
+    t_next = time.perf_counter()
+    for i in range(n_cycles):
+        t_next += T_INTV
+        t0 = time.perf_counter()
+        res = rc.servo_j([0.001 * i] * 6, 1)
+        call_ms[i] = (time.perf_counter() - t0) * 1000
+        assert res == (0,), res
+        time.sleep(max(0.0, t_next - time.perf_counter()))
+    return call_ms
+
+
+def check_matching():
+    controller = MockController(delay_ms=(0.5, 20.0), error_at=150)
+    rc = connect(controller)
+    replies = []
+    rc.start_servo_pipeline(
+        max_in_flight=8, on_reply=lambda ec, ns: replies.append(ec))
+    # エラーが返るまで送る (制御ループはそこで止まる)
+    for i in range(300):
+        res = rc.servo_j([0.0] * 6, 1)
+        if res[0] != 0:
+            break
+        if i % 50 == 25:
+            # パイプラインの動作中の他のコマンド
+            assert rc.get_robot_state() == (0, 1, 1)
+        time.sleep(0.002)
+    assert res[0] == 2 and "servo_j" in res[1], res
+    assert i >= 150
+    assert rc.stop_servo_pipeline() == res
+    assert len(replies) == rc.servo_stats["sent"] == i
+    assert replies.count(2) == 1 and replies.index(2) == 149
+    # 止めた後は通常の送受信に戻る
+    assert rc.get_robot_state() == (0, 1, 1)
+    print(f"replies matched in order, error of cycle 149 reported in cycle "
+          f"{i}, max {rc.servo_stats['max_in_flight']} in flight")
+    rc.logout()
+
+
+def bench():
+    print(f"servo_j every {T_INTV * 1000:.0f} ms, controller replies in 2-6 ms")
+    print("                call p50 (ms)  p99 (ms)  max (ms)")
+    for pipelined in [False, True]:
+        controller = MockController()
+        rc = connect(controller)
+        if pipelined:
+            rc.start_servo_pipeline(max_in_flight=4)
+        call_ms = run_loop(rc)
+        if pipelined:
+            assert rc.stop_servo_pipeline() == (0,)
+        p50, p99 = np.percentile(call_ms, [50, 99])
+        name = "pipelined" if pipelined else "wait reply"
+        print(f"{name:16s} {p50:12.3f} {p99:9.3f} {call_ms.max():9.3f}")
+        rc.logout()
+
+
+if __name__ == '__main__':
+    check_matching()
+    bench()
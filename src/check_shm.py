@@ -0,0 +1,128 @@
+"""
+共有メモリの形式の確認。
+- 作成した共有メモリに別の形式 (バージョン、サイズ) で接続すると
+  ShmSchemaErrorになること
+- フィールドへの書き込みが他の接続からも見えること
+- 古い形式の小さい共有メモリが残っていても作り直せること
+- 処理時間のヒストグラム (LatencyHistograms) の共有メモリも、ヘッダのない
+  以前の形式やバージョンの異なるものには接続せず、作成時は作り直すこと
+"""
+import multiprocessing as mp
+import multiprocessing.shared_memory
+
+import numpy as np
+
+from jaka_control.config import (
+    LATENCY_SHM_NAME, LATENCY_SHM_VERSION, SHM_DTYPE, SHM_VERSION
+)
+from jaka_control.latency import (
+    LATENCY_PHASES, LATENCY_SHM_DTYPE, N_BUCKETS, LatencyHistograms
+)
+from jaka_control.shm import ShmSchemaError, attach_shm, create_shm
+
+SHM_NAME = "jaka_shm_check"
+
+
+def check_schema():
+    sm, pose = create_shm(SHM_NAME)
+    try:
+        assert pose["version"] == SHM_VERSION
+        assert pose["size"] == SHM_DTYPE.itemsize
+        for version, dtype in [
+                (SHM_VERSION + 1, SHM_DTYPE),
+                (SHM_VERSION, np.dtype([("version", "<u4"), ("size", "<u4"),
+                                        ("state", "<f8", (6,))]))]:
+            try:
+                attach_shm(SHM_NAME, dtype, version)
+            except ShmSchemaError as e:
+                print(f"Rejected: {e}")
+            else:
+                raise AssertionError("schema mismatch was not detected")
+        del pose
+    finally:
+        sm.close()
+        sm.unlink()
+
+
+def check_fields():
+    sm, pose = create_shm(SHM_NAME)
+    sm2, pose2 = attach_shm(SHM_NAME)
+    try:
+        # 配列のフィールドはビュー、スカラーのフィールドは書き込みが反映される
+        pose["target"][:] = np.arange(6) + 0.5
+        pose["target_count"] += 1
+        pose["emergency_stop"] = 1
+        assert np.array_equal(pose2["target"], np.arange(6) + 0.5)
+        assert pose2["target_count"] == 1
+        assert pose2["emergency_stop"] == 1
+        # 読んだスカラーはコピーなので後の書き込みで変わらない
+        count = pose2["target_count"]
+        pose["target_count"] += 1
+        assert count == 1 and pose2["target_count"] == 2
+        print("Field writes are visible from another attachment")
+        del pose, pose2
+    finally:
+        sm2.close()
+        sm.close()
+        sm.unlink()
+
+
+def check_recreate():
+    old = mp.shared_memory.SharedMemory(
+        create=True, size=37 * 4, name=SHM_NAME)
+    try:
+        try:
+            attach_shm(SHM_NAME)
+        except ShmSchemaError as e:
+            print(f"Rejected old layout: {e}")
+        else:
+            raise AssertionError("old layout was not detected")
+        sm, pose = create_shm(SHM_NAME)
+        assert sm.size >= SHM_DTYPE.itemsize
+        sm2, pose2 = attach_shm(SHM_NAME)
+        del pose, pose2
+        sm2.close()
+        sm.close()
+    finally:
+        old.close()
+        old.unlink()
+
+
+def check_latency():
+    # ヘッダのない以前の形式 (int64の配列のみ)
+    old = mp.shared_memory.SharedMemory(
+        create=True, size=8 * len(LATENCY_PHASES) * (N_BUCKETS + 3),
+        name=LATENCY_SHM_NAME)
+    try:
+        try:
+            LatencyHistograms()
+        except ShmSchemaError as e:
+            print(f"Rejected old latency layout: {e}")
+        else:
+            raise AssertionError("old latency layout was not detected")
+        lh = LatencyHistograms(create=True)
+        lh2 = LatencyHistograms()
+        lh.record(LATENCY_PHASES.index("cycle"), 5000)
+        assert lh2.summary(phases=["cycle"])["cycle"]["count"] == 1
+        # 別のバージョンのヘッダ
+        header = np.ndarray((), dtype=LATENCY_SHM_DTYPE, buffer=lh.sm.buf)
+        header["version"] = LATENCY_SHM_VERSION + 1
+        try:
+            LatencyHistograms()
+        except ShmSchemaError as e:
+            print(f"Rejected latency version: {e}")
+        else:
+            raise AssertionError("latency version mismatch was not detected")
+        del header
+        lh2.close()
+        lh.close()
+    finally:
+        old.close()
+        old.unlink()
+
+
+if __name__ == '__main__':
+    check_schema()
+    check_fields()
+    check_recreate()
+    check_latency()
@@ -0,0 +1,172 @@
+"""
+SnapshotSlotの確認。
+- 別プロセスが書き続けている間に読んでも、途中まで書かれたメッセージを返さないこと
+  (書き込み側のプロセスの複数のスレッドが書く場合も)
+- 更新がなければNoneを返し、大きすぎるメッセージは書かないこと
+- 書き込みと読み出しの時間を、Managerの辞書 (clear+updateとcopy) と比較する
+"""
+import json
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+
+from jaka_control.snapshot import Snapshots
+
+N_WRITES = 20000
+
+
+def message(i):
+    # モニタプロセスが書くメッセージと同程度の大きさ
+    return {
+        "time": time.time(),
+        "joints": [i * 0.001 + j for j in range(6)],
+        "poses": [i * 0.001 + j for j in range(6)],
+        "i": i,
+        "pad": "x" * (i % 200),
+    }
+
+
+def writer(n):
+    snapshots = Snapshots()
+    for i in range(1, n + 1):
+        snapshots.mqtt_control.write(
+            "control", f"topic/{i}", json.dumps(message(i)).encode())
+    snapshots.close()
+
+
+def thread_writer(n, n_threads):
+    # MQTTの受信プロセスのように複数のスレッドが同じスロットに書く
+    snapshots = Snapshots()
+
+    def write(k):
+        for i in range(k, n + 1, n_threads):
+            snapshots.mqtt_control.write(
+                "control", f"topic/{i}", json.dumps(message(i)).encode())
+
+    threads = [threading.Thread(target=write, args=(k,))
+               for k in range(1, n_threads + 1)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    snapshots.close()
+
+
+def check_consistency():
+    snapshots = Snapshots(create=True)
+    slot = snapshots.mqtt_control
+    assert slot.read() is None
+    p = mp.Process(target=writer, args=(N_WRITES,))
+    p.start()
+    n_read = 0
+    last = 0
+    while True:
+        alive = p.is_alive()
+        js = slot.read()
+        if js is not None:
+            i = js["i"]
+            # 途中まで書かれたメッセージを読めばここで食い違う
+            assert js["topic"] == f"topic/{i}", js
+            assert js["joints"][0] == i * 0.001 and len(js["pad"]) == i % 200
+            assert i > last
+            last = i
+            n_read += 1
+        if last == N_WRITES:
+            break
+        if not alive and js is None:
+            # 書き込み側の終了後に読んでも新しいものがない
+            break
+    p.join()
+    assert last == N_WRITES, last
+    assert slot.read() is None
+    assert not slot.write("control", "big", b"0" * (slot.capacity + 1))
+    assert slot.n_oversize == 1 and slot.read() is None
+    snapshots.close()
+    snapshots.unlink()
+    print(f"SnapshotSlot: read {n_read} consistent snapshots "
+          f"of {N_WRITES} writes")
+
+
+def check_threads(n_threads=3):
+    snapshots = Snapshots(create=True)
+    slot = snapshots.mqtt_control
+    p = mp.Process(target=thread_writer, args=(N_WRITES, n_threads))
+    p.start()
+    n_read = 0
+    while True:
+        alive = p.is_alive()
+        js = slot.read()
+        if js is not None:
+            i = js["i"]
+            assert js["topic"] == f"topic/{i}", js
+            assert js["joints"][0] == i * 0.001 and len(js["pad"]) == i % 200
+            n_read += 1
+        elif not alive:
+            break
+    p.join()
+    assert p.exitcode == 0
+    # 書き込みごとに世代が2つ進む
+    assert slot.generation == 2 * N_WRITES, slot.generation
+    snapshots.close()
+    snapshots.unlink()
+    print(f"SnapshotSlot: read {n_read} consistent snapshots "
+          f"of {N_WRITES} writes from {n_threads} threads")
+
+
+def timeit(f, n=2000):
+    t = np.empty(n)
+    for i in range(n):
+        t0 = time.perf_counter_ns()
+        f(i)
+        t[i] = time.perf_counter_ns() - t0
+    return np.percentile(t / 1000, [50, 99])
+
+
+def compare():
+    snapshots = Snapshots(create=True)
+    slot = snapshots.monitor
+    manager = mp.Manager()
+    d = manager.dict()
+    lock = manager.Lock()
+
+    def write_slot(i):
+        slot.write("robot", "topic", json.dumps(message(i)).encode())
+
+    def write_dict(i):
+        js = message(i)
+        with lock:
+            js["topic_type"] = "robot"
+            js["topic"] = "topic"
+            d.clear()
+            d.update(js)
+
+    def read_slot(i):
+        write_slot(i)
+        t0 = time.perf_counter_ns()
+        slot.read()
+        return time.perf_counter_ns() - t0
+
+    def read_dict(i):
+        with lock:
+            d.copy()
+
+    print("                 p50 (us)  p99 (us)")
+    for name, f in [("write snapshot", write_slot),
+                    ("write Manager", write_dict),
+                    ("read Manager", read_dict)]:
+        p50, p99 = timeit(f)
+        print(f"{name:16s} {p50:9.1f} {p99:9.1f}")
+    t = np.array([read_slot(i) for i in range(2000)]) / 1000
+    p50, p99 = np.percentile(t, [50, 99])
+    print(f"{'read snapshot':16s} {p50:9.1f} {p99:9.1f}")
+    manager.shutdown()
+    snapshots.close()
+    snapshots.unlink()
+
+
+if __name__ == '__main__':
+    check_consistency()
+    check_threads()
+    compare()
@@ -0,0 +1,94 @@
+"""
+stream_timingの確認。
+- StaleWatchが途切れと再開のときだけ状態を変え、回数と最長の時間を数えること
+- MotionLatencyが静止からの動き出しだけを測り、動いている間や
+  状態値が動かない場合は測らないこと
+時刻は実際の時刻ではなく、シミュレーションの時刻 (ns) を与える。
+"""
+import logging
+
+import numpy as np
+
+from jaka_control.stream_timing import MotionLatency, StaleWatch
+
+MS = 1_000_000
+
+
+def check_stale_watch():
+    logger = logging.getLogger("check_stream_timing")
+    watch = StaleWatch("state", 0.2, logger)
+    # 30 ms間隔で届き、1 sから0.5 s途切れる
+    stamps = [t for t in range(0, 3000 * MS, 30 * MS)
+              if not 1000 * MS < t < 1500 * MS]
+    stamp = 0
+    n_stale_cycles = 0
+    for now in range(0, 3000 * MS, 8 * MS):
+        while stamps and stamps[0] <= now:
+            stamp = stamps.pop(0)
+        n_stale_cycles += watch.update(now, stamp)
+    assert watch.n_stale == 1 and not watch.stale
+    # 最後の受信 (990 ms) から再開 (1500 ms) まで
+    assert watch.max_gap_ns == 510 * MS, watch.max_gap_ns
+    print(f"StaleWatch: 1 gap of {watch.max_gap_ns / 1e9:.3f} seconds, "
+          f"stale for {n_stale_cycles} cycles")
+
+
+def simulate(target_at, move_at, state_delay, n_cycles=500):
+    """
+    target_at(t): 時刻tに受信する目標値 (60 Hzで受信)
+    move_at: この時刻以降の送信で差分が0でなくなる
+    state_delay: 送信から状態値 (30 ms間隔) に現れるまでの時間 (ns)
+    """
+    ml = MotionLatency()
+    state = np.zeros(6)
+    results = []
+    t_first_send = None
+    for k in range(n_cycles):
+        now = k * 8 * MS
+        if now % (16 * MS) == 0:
+            ml.on_target(target_at(now), now, state)
+        if now % (30 * MS) < 8 * MS:
+            # 最初に差分を送ってからstate_delay後に状態値が動く
+            moved = (t_first_send is not None and
+                     now - t_first_send >= state_delay)
+            state[:] = 1.0 if moved else 0.0
+            r = ml.on_state(state, now, now)
+            if r is not None:
+                results.append(r)
+        command = np.full(6, 0.1 if now >= move_at else 0.0)
+        ml.on_send(command, now)
+        if now >= move_at and t_first_send is None:
+            t_first_send = now
+    return ml, results
+
+
+def check_motion_latency():
+    # 静止していた目標値が1 s以降の最初の受信 (1008 ms) で動き出し、
+    # 1104 msに送信、その100 ms後に状態値が動く
+    ml, results = simulate(
+        lambda t: np.full(6, 0.0 if t < 1000 * MS else t / 1e9),
+        move_at=1104 * MS, state_delay=100 * MS)
+    assert len(results) == 1, results
+    ns_to_send, ns_to_motion = results[0]
+    assert ns_to_send == 96 * MS, ns_to_send
+    # 状態値は30 ms間隔なので送信から100 ms以上後の最初の受信
+    assert 100 * MS <= ns_to_motion < 130 * MS, ns_to_motion
+    print(f"MotionLatency: target to servo_j {ns_to_send / MS:.0f} ms, "
+          f"servo_j to motion {ns_to_motion / MS:.0f} ms")
+
+    # 最初から動き続けている目標値は測らない
+    ml, results = simulate(
+        lambda t: np.full(6, t / 1e9), move_at=0, state_delay=100 * MS)
+    assert not results and ml.phase == ml.IDLE
+
+    # 状態値が動かなければタイムアウトして次の動き出しを待つ
+    ml, results = simulate(
+        lambda t: np.full(6, 0.0 if t < 1000 * MS else 1.0),
+        move_at=1104 * MS, state_delay=10**12)
+    assert not results and ml.n_timeouts == 1
+    print("MotionLatency: no measurement while moving or without motion")
+
+
+if __name__ == '__main__':
+    check_stale_watch()
+    check_motion_latency()
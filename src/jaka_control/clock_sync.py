@@ -0,0 +1,75 @@
+"""
+VRのゴーグルとの時計のずれと経路の遅延の推定 (NTPと同じ方式)。
+ロボット側が送信時刻t0を含むpingを送り、ゴーグル側がその受信時刻t1と
+返信の送信時刻t2 (ゴーグルの時計、制御メッセージの送信時刻と同じ時計) を加えて
+pongを返し、ロボット側がその受信時刻t3を記録する。
+    往復の遅延 = (t3 - t0) - (t2 - t1)
+    時計のずれ = ((t1 - t0) + (t2 - t3)) / 2  (ゴーグルの時計 - ロボットの時計)
+ずれの推定の誤差は往復の経路の非対称さで決まり、往復の遅延が小さいほど小さいので、
+最近の交換のうち往復の遅延が最小のものを使う。
+ロボット側の時刻はtime.monotonic_ns。
+"""
+import time
+from collections import OrderedDict, deque
+from typing import Dict
+
+
+class ClockSync:
+    def __init__(self, n_windows: int = 16, max_pending: int = 16) -> None:
+        """
+        n_windows: 往復の遅延の最小値を選ぶ最近の交換の数
+        max_pending: 返信を待つpingの数。古いものから捨てる
+        """
+        self.samples = deque(maxlen=n_windows)
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self.seq = 0
+        # 推定値 (ns)。まだ交換できていなければNone
+        self.offset_ns = None
+        self.delay_ns = None
+        self.n_pongs = 0
+        self.n_invalid = 0
+
+    def reset(self) -> None:
+        """
+        ゴーグル側の再起動などで時計が変わった場合に、それまでの交換を捨てる。
+        次のpongまで推定値はNoneになる
+        """
+        self.samples.clear()
+        self.offset_ns = None
+        self.delay_ns = None
+
+    def make_ping(self, t0: int | None = None) -> Dict[str, int]:
+        """送るpingのメッセージ"""
+        if t0 is None:
+            t0 = time.monotonic_ns()
+        self.seq += 1
+        self._pending[self.seq] = t0
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+        return {"seq": self.seq, "t0": t0}
+
+    def on_pong(self, pong: Dict[str, int], t3: int) -> int | None:
+        """
+        受信したpongから往復の遅延 (ns) を返し、推定値を更新する。
+        送っていないか古すぎるping、時刻が矛盾するものは無視してNoneを返す
+        """
+        t0 = self._pending.pop(pong.get("seq"), None)
+        if t0 is None or pong.get("t0") != t0:
+            self.n_invalid += 1
+            return None
+        t1 = int(pong["t1"])
+        t2 = int(pong["t2"])
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0 or t2 < t1:
+            self.n_invalid += 1
+            return None
+        offset = ((t1 - t0) + (t2 - t3)) // 2
+        self.samples.append((delay, offset))
+        self.delay_ns, self.offset_ns = min(self.samples)
+        self.n_pongs += 1
+        return delay
+
+    def to_local(self, sender_ns: int) -> int:
+        """ゴーグルの時計の時刻をロボット側の時刻に換算する"""
+        return sender_ns - self.offset_ns
@@ -1,7 +1,157 @@
+import numpy as np
+
+
 SHM_NAME = "jaka"
-SHM_SIZE = 48
+# 共有メモリの先頭に置くヘッダ。形式が異なるプロセスが接続したら止める
+SHM_HEADER_FIELDS = [
+    # 形式のバージョン。形式を変えたら上げる
+    ("version", "<u4"),
+    # 全体のバイト数
+    ("size", "<u4"),
+]
+SHM_VERSION = 4
+# プロセス間で共有する状態。要素は0次元の構造化配列のフィールドとして読み書きする
+# 0に意味がある値は、0を未設定として扱うために100のオフセットをもたせている
+SHM_DTYPE = np.dtype(SHM_HEADER_FIELDS + [
+    # 関節の状態値
+    ("state", "<f8", (6,)),
+    # 関節の目標値
+    ("target", "<f8", (6,)),
+    # 関節の制御値
+    ("control", "<f8", (6,)),
+    # ハンドの状態値 (開き幅 + 100)
+    ("hand_state", "<i4"),
+    # ハンドの目標値 (開き幅 + 100)
+    ("hand_target", "<f8"),
+    # ハンドの把持の有無 + 100。0: 把持していない。1: 把持している。-1: 不明
+    ("hand_caught", "<i4"),
+    # 現在のツール番号
+    ("tool_id", "<i4"),
+    # ツールチェンジの実行フラグ。0: 終了。0以外: 開始。次のツール番号
+    ("tool_change", "<i4"),
+    # ツールチェンジ完了状態。0: 未定義。1: 成功。2: 失敗
+    ("tool_change_status", "u1"),
+    # 0: 必ず通常モード。1: 基本的にスレーブモード（通常モードになっている場合もある）
+    ("slave_mode", "u1"),
+    # 0: mqtt_control実行中でない。1: mqtt_control実行中
+    ("mqtt_control", "u1"),
+    # 1: リアルタイム制御停止命令（mqtt_control停止命令ではないことに注意）
+    ("stop_control", "u1"),
+    # 制御開始後の状態値の受信フラグ
+    ("state_received", "u1"),
+    # 制御開始後の目標値の受信フラグ
+    ("target_received", "u1"),
+    # 棚の上の箱を作業台に置くデモの実行フラグ。0: 終了。1: 開始
+    ("put_down_box", "u1"),
+    # 棚の上の箱を作業台に置くデモの完了状態。0: 未定義。1: 成功。2: 失敗
+    ("put_down_box_status", "u1"),
+    # 緊急停止フラグ。0: 停止でない。1: 停止
+    ("emergency_stop", "u1"),
+    # プロセス終了フラグ
+    ("exit", "u1"),
+    # ログ出力先の変更フラグ (control用、monitor用、control-archiver用)
+    ("change_log_control", "u1"),
+    ("change_log_monitor", "u1"),
+    ("change_log_archiver", "u1"),
+    # 目標値の受信カウンタ。共有メモリに書くごとに1増える
+    ("target_count", "<i8"),
+    # 目標値のメッセージのうち、次のメッセージでまとめられた数、
+    # 順序が入れ替わって捨てた数、通し番号の飛びから数えた届かなかった数
+    # (mailbox.TargetMailbox)
+    ("target_coalesced", "<i8"),
+    ("target_reordered", "<i8"),
+    ("target_dropped", "<i8"),
+    # ゴーグルとの時計のずれ (ゴーグル - ロボット) と最小の往復の遅延 (ns)
+    # (clock_sync.ClockSync)。まだ推定できていなければ0
+    ("clock_offset", "<i8"),
+    ("clock_rtt", "<i8"),
+    # 関節の状態値、目標値、制御値のseqlockの世代
+    ("state_seq", "<i8"),
+    ("target_seq", "<i8"),
+    ("control_seq", "<i8"),
+    # 関節の状態値、目標値、制御値を得た時刻 (time.monotonic_ns)
+    # 状態値はフィードバックの受信、目標値はMQTTの受信、制御値は送信の時刻
+    ("state_time", "<i8"),
+    ("target_time", "<i8"),
+    ("control_time", "<i8"),
+], align=True)
 MIN_JOINT_LIMIT = [-360, -85, -175, -85, -360, -360]
 MAX_JOINT_LIMIT = [360, 265, 175, 265, 360, 360]
 T_INTV = 0.008
 N_JOINTS = 6
 DEFAULT_JOINT = [-270, 110, 90, 70, -90, 45]
+# 速度制限 (deg/s)。スペック上の制限
+SPEED_LIMIT = 180
+# 加速度制限 (deg/s^2)。
+# JakaのMoveJでの推奨の制限値
+# NOTE: 適切に利用しないと、そのままの値ではかなり制限が小さいと思われる
+# ACCEL_LIMITS = [720] * 6
+# NOTE: とりあえず十分大きい値としてCobotta Proの制限値を利用するが要検討
+ACCEL_LIMITS = [4040, 4033.33, 4040, 5050, 5050, 4860]
+# 加加速度制限 (deg/s^3)。
+# NOTE: スペック上の値は不明なので、静止から0.1秒で加速度制限に達する値としている。要検討
+JERK_LIMITS = [40400, 40333.3, 40400, 50500, 50500, 48600]
+LATENCY_SHM_NAME = "jaka_latency"
+# 処理区間 (latency.LATENCY_PHASES) の名前や順序を変えた場合も上げる
+LATENCY_SHM_VERSION = 1
+RECORD_RING_SHM_NAME = "jaka_records"
+# 記録の形式 (record_ring.RECORD_KINDSなど) を変えた場合も上げる
+RECORD_RING_SHM_VERSION = 1
+MOCK_SHM_NAME = "mock_jaka"
+MOCK_SHM_VERSION = 1
+# テスト用のモックのロボットの状態
+MOCK_SHM_DTYPE = np.dtype(SHM_HEADER_FIELDS + [
+    # 関節の状態値
+    ("joint", "<f8", (6,)),
+    # 位置の状態値
+    ("tcp_pose", "<f8", (6,)),
+    # ロボットの電源
+    ("powered_on", "u1"),
+    # モーターの電源
+    ("enabled", "u1"),
+    # スレーブモードの状態
+    ("servo_mode", "u1"),
+], align=True)
+SNAPSHOT_SHM_NAME = "jaka_snapshots"
+SNAPSHOT_SHM_VERSION = 1
+# 1件のメッセージ (JSON) の最大のバイト数
+SNAPSHOT_PAYLOAD_SIZE = 16384
+# GUIに表示する最新のメッセージ1件分
+SNAPSHOT_SLOT_DTYPE = np.dtype([
+    # 書き込み中は奇数、書き終えたら偶数になる世代
+    ("seq", "<i8"),
+    # 表示先のトピックの種類 (robot, control, dev, mgr/register) とトピック
+    ("topic_type", "S16"),
+    ("topic", "S256"),
+    # メッセージ (JSONのオブジェクト) のバイト数と中身
+    ("length", "<i4"),
+    ("payload", "u1", (SNAPSHOT_PAYLOAD_SIZE,)),
+], align=True)
+# モニタプロセスとMQTTの受信プロセスの最新のメッセージ
+SNAPSHOT_SHM_DTYPE = np.dtype(SHM_HEADER_FIELDS + [
+    ("monitor", SNAPSHOT_SLOT_DTYPE),
+    ("mqtt_control", SNAPSHOT_SLOT_DTYPE),
+], align=True)
+HISTORY_SHM_NAME = "jaka_history"
+HISTORY_SHM_VERSION = 1
+# 関節の値の履歴の件数。制御周期 (8 ms) で約30秒分
+HISTORY_CAPACITY = 4096
+# 履歴の1件
+HISTORY_RECORD_DTYPE = np.dtype([
+    # 値を得た時刻 (time.monotonic_ns)。state_timeなどと同じ
+    ("time", "<i8"),
+    ("joint", "<f8", (N_JOINTS,)),
+])
+# 関節の値の種類ごとの履歴のリングバッファ。
+# 連続したビューで読めるように、同じ記録を2か所 (i, i + 容量) に書く
+HISTORY_RING_DTYPE = np.dtype([
+    # 書き込み済みの件数
+    ("count", "<i8"),
+    ("records", HISTORY_RECORD_DTYPE, (2 * HISTORY_CAPACITY,)),
+], align=True)
+# 状態値 (モニタプロセス)、目標値 (MQTTの受信プロセス)、制御値 (制御プロセス)
+HISTORY_SHM_DTYPE = np.dtype(SHM_HEADER_FIELDS + [
+    ("state", HISTORY_RING_DTYPE),
+    ("target", HISTORY_RING_DTYPE),
+    ("control", HISTORY_RING_DTYPE),
+], align=True)
@@ -0,0 +1,330 @@
+"""
+control_loopの1周期の計算 (共有メモリの状態値・目標値から制御値まで) を、
+あらかじめ確保した作業領域上で行う。
+定常状態の周期では配列を確保しない (check_control_step_alloc.pyで確認する)。
+"""
+from typing import Tuple
+
+import numpy as np
+
+from .filter import BufferedSMAFilter, JerkShaper, OneEuroFilter
+from .interpolate import AdaptiveDelayedInterpolator, RingDelayedInterpolator
+from .joint_math import (
+    JerkMeter, JointLimiter, PyJointLimiter, clip, clip_py, wrap, wrap_py
+)
+from .seqlock import PoseSeqLocks
+
+
+class ControlStep:
+    """
+    各段階の結果は作業領域の配列 (state, target, target_delayed,
+    target_diff, control など) に書き込まれ、次の周期で上書きされる。
+    control_loopは段階の間で処理時間を記録するので、段階ごとにメソッドを分けている。
+    """
+    def __init__(
+        self,
+        filter_kind: str,
+        n_windows: int,
+        speed_limits: float | np.ndarray,
+        accel_limits: np.ndarray,
+        jerk_limits: np.ndarray,
+        stopped_velocity_eps: float,
+        min_joint_limit: np.ndarray,
+        max_joint_limit: np.ndarray,
+        use_interp: bool = True,
+        adaptive_delay: bool = True,
+        delay: float = 0.1,
+        one_euro_params: dict | None = None,
+        t_intv: float = 0.008,
+        n_jerk_windows: int | None = None,
+        joint_math: str = "numpy",
+        n_dims: int = 6,
+    ) -> None:
+        """
+        speed_limits, accel_limits, jerk_limits: 比率を掛けた後の制限
+        n_jerk_windows: JerkShaperの移動平均の長さ。Noneで整形しない
+        joint_math: 規格化、ソフトリミット、速度・加速度制限の実装。
+            "numpy"または"python" (結果はビット単位で同じ)
+        """
+        self.filter_kind = filter_kind
+        self.n_windows = n_windows
+        self.min_joint_limit = np.asarray(min_joint_limit, dtype=float)
+        self.max_joint_limit = np.asarray(max_joint_limit, dtype=float)
+        self.use_interp = use_interp
+        self.adaptive_delay = adaptive_delay
+        self.delay = delay
+        self.one_euro_params = one_euro_params or {}
+        self.t_intv = t_intv
+        self.n_dims = n_dims
+
+        # 作業領域
+        z = lambda: np.zeros(n_dims)  # noqa: E731
+        self.state = z()
+        self.target_raw = z()
+        self.target = z()
+        self.target_stop = z()
+        self.target_delayed = z()
+        self.last_target_delayed = z()
+        self.target_aligned = z()
+        self.last_target_filtered = z()
+        self.target_diff = z()
+        self.control = z()
+        self.last_control = z()
+        self._wrapped = z()
+        self._neq = np.zeros(n_dims, dtype=bool)
+        self.holding = False
+
+        if joint_math == "python":
+            Limiter = PyJointLimiter
+            # 要素ごとにPythonのfloatで読み書きするためのビュー
+            self._m_state = memoryview(self.state)
+            self._m_target_raw = memoryview(self.target_raw)
+            self._m_wrapped = memoryview(self._wrapped)
+            self._m_target = memoryview(self.target)
+            self._m_target_diff = memoryview(self.target_diff)
+            self._min_list = self.min_joint_limit.tolist()
+            self._max_list = self.max_joint_limit.tolist()
+        elif joint_math == "numpy":
+            Limiter = JointLimiter
+            self._m_target_diff = self.target_diff
+        else:
+            raise ValueError(f"Unknown joint_math: {joint_math}")
+        self.joint_math = joint_math
+
+        # 速度制限をフィルタの手前にも入れる
+        self.pre_limiter = Limiter(
+            speed_limits, accel_limits, stopped_velocity_eps, n_dims=n_dims)
+        self.limiter = Limiter(
+            speed_limits, accel_limits, stopped_velocity_eps, n_dims=n_dims)
+        # 加加速度の比率は整形後のロボットに送る差分で計る
+        self.jerk_meter = JerkMeter(jerk_limits, t_intv, n_dims=n_dims)
+        self.shaper = None
+        if n_jerk_windows is not None:
+            self.shaper = JerkShaper(n_windows=n_jerk_windows, n_dims=n_dims)
+
+        if filter_kind == "one_euro":
+            self._filter = OneEuroFilter(dt=t_intv, **self.one_euro_params)
+        else:
+            self._filter = BufferedSMAFilter(n_windows=n_windows, n_dims=n_dims)
+        self.di = None
+        if use_interp:
+            if adaptive_delay:
+                self.di = AdaptiveDelayedInterpolator(delay=delay, n_dims=n_dims)
+            else:
+                self.di = RingDelayedInterpolator(delay=delay, n_dims=n_dims)
+
+    def attach(self, pose: np.void) -> None:
+        """共有メモリの状態値、目標値、制御値のSeqLockを先に作っておく"""
+        self.seqlocks = PoseSeqLocks(pose)
+
+    def snapshot(self, spin: float = 0.0) -> bool:
+        """
+        共有メモリから状態値、目標値を取り出す。
+        書き込み中で一貫した値が読めなければ前の周期の値を使う。
+        spin: 0より大きければ読めるまでspin秒まで読み直す
+        両方とも読めたかを返す (まだ一度も読めていなければ作業領域は0のまま)
+        """
+        if spin > 0:
+            ok_state = self.seqlocks.state.read_spin(self.state, spin)
+            ok_target = self.seqlocks.target.read_spin(self.target_raw, spin)
+        else:
+            ok_state = self.seqlocks.state.read(self.state)
+            ok_target = self.seqlocks.target.read(self.target_raw)
+        return ok_state and ok_target
+
+    def wrap_clip(self) -> Tuple[bool, bool]:
+        """
+        目標値を状態値に最も近い角度に規格化し、ソフトリミットで制限する。
+        下限、上限で制限されたかを返す
+        """
+        if self.joint_math == "python":
+            wrap_py(self._m_state, self._m_target_raw, self._m_wrapped)
+            return clip_py(
+                self._m_wrapped, self._min_list, self._max_list,
+                self._m_target)
+        wrap(self.state, self.target_raw, out=self._wrapped)
+        return clip(
+            self._wrapped, self.min_joint_limit, self.max_joint_limit,
+            out=self.target, neq=self._neq)
+
+    def setup(self, t: float) -> None:
+        """制御の最初の周期の初期化。制御値は送らない"""
+        self.holding = False
+        if self.di is not None:
+            self.di.reset(t, self.target)
+            np.copyto(self.last_target_delayed, self.di.read(t, self.target))
+        else:
+            np.copyto(self.last_target_delayed, self.target)
+        np.copyto(self.target_delayed, self.last_target_delayed)
+        np.copyto(self.last_control, self.state)
+        np.copyto(self.control, self.state)
+        # 移動平均フィルタのセットアップ（t_intv秒間隔）
+        if self.filter_kind == "target":
+            self._filter.reset(self.target)
+        else:
+            self._filter.reset(self.state)
+        self.pre_limiter.reset()
+        self.limiter.reset()
+        self.jerk_meter.reset()
+        if self.shaper is not None:
+            self.shaper.reset()
+
+    def hold(self) -> None:
+        """
+        目標値を最初に呼ばれたときの状態値に固定する。
+        ロボットを静止させてから止めるため
+        """
+        if not self.holding:
+            np.copyto(self.target_stop, self.state)
+            self.holding = True
+        np.copyto(self.target, self.target_stop)
+
+    def interpolate(
+        self, t: float, arrived: bool, t_target: float | None = None,
+    ) -> None:
+        """
+        target_delayedは、delay秒前の目標値を前後の値を使って線形補間したもの。
+        t_target: 目標値の時刻 (tと同じ時計)。Noneでt (到着の時刻)
+        """
+        if self.di is None:
+            np.copyto(self.target_delayed, self.target)
+        elif self.adaptive_delay:
+            np.copyto(
+                self.target_delayed,
+                self.di.read(t, self.target, arrived, t_target))
+        else:
+            np.copyto(self.target_delayed, self.di.read(t, self.target))
+
+    def pre_limit(self, dt: float) -> None:
+        """フィルタ手前の速度・加速度制限"""
+        diff = self.target_diff
+        np.subtract(self.target_delayed, self.last_target_delayed, out=diff)
+        m = self._m_target_diff
+        self.pre_limiter.limit(m, dt, out=m)
+        np.add(self.last_target_delayed, diff, out=self.target_delayed)
+        np.copyto(self.last_target_delayed, self.target_delayed)
+
+    def smooth(self, dt: float) -> None:
+        """平滑化し、制限前の制御値の差分をtarget_diffに書き込む"""
+        kind = self.filter_kind
+        _filter = self._filter
+        diff = self.target_diff
+        if kind == "original":
+            # 成功している方法
+            # 速度制限済みの制御値で平滑化をしており、
+            # moveit servoなどでは見られない処理
+            np.subtract(
+                _filter.predict_only(self.target_delayed), self.last_control,
+                out=diff)
+        elif kind == "one_euro":
+            # 速度に応じて平滑化の強さを変える
+            # 速く動くときは遅延が小さくなる
+            np.subtract(
+                _filter.filter(self.target_delayed, dt), self.last_control,
+                out=diff)
+        elif kind == "target":
+            # 成功することもあるが平滑化窓を増やす必要あり
+            # 状態値を無視した目標値の値をロボットに送る
+            np.copyto(
+                self.last_target_filtered,
+                _filter.previous_filtered_measurement)
+            np.subtract(
+                _filter.filter(self.target_delayed), self.last_target_filtered,
+                out=diff)
+        elif kind in [
+            "state_and_target_diff",
+            "moveit_servo_humble",
+            "control_and_target_diff",
+        ]:
+            # state_and_target_diff: 失敗する
+            # 状態値に目標値の差分を足したものを平滑化する
+            # moveit servo (少なくともhumble版)ではこのようにしているが、
+            # 速度がどんどん大きくなっていって（正のフィードバック）
+            # 制限に引っかかる
+            # stateを含む移動平均を取ると、stateが速度を持つと
+            # その速度を保持し続けようとするので、そこに差分を足すと
+            # どんどん加速していくのでは。
+            # 遅延があることも影響しているかも。
+            # NOTE(20250813): targetがstateのフィードバックを受けていない場合は
+            # target_alignedは、stateとtargetが乖離するので不適切
+            # moveit_servo_humble: 失敗する
+            # 停止はしないがかなりゆっくり動き、目標軌跡も追従しなくなる
+            # v = (target_filtered - state) / t_intv
+            # target_filteredとstateの差は、
+            # - 制御値を送ってからその値にstateがなるまで0.1s程度の遅延があること
+            # - テストなどであらかじめ決まっているtargetを逐次送り、
+            #   targetの速度がロボットの速度制限より大きいとき、
+            #   targetがstateからどんどん離れていくこと
+            # などの理由からt_intv秒で移動できる距離以上になってしまうため
+            # control_and_target_diff: 失敗する
+            # 速度制限にひっかかり途中停止する
+            # 制御値に目標値の差分を足したものを平滑化する
+            # 上記と同様に正のフィードバック的になっている
+            # moveit_servo_mainの処理に近い
+            # NOTE: last_target_delayedはpre_limitで更新済みなので
+            # 目標値の差分は0になる (以前のcontrol_loopと同じ)
+            base = self.last_control if kind == "control_and_target_diff" \
+                else self.state
+            np.subtract(
+                self.target_delayed, self.last_target_delayed, out=diff)
+            np.add(base, diff, out=self.target_aligned)
+            np.copyto(
+                self.last_target_filtered,
+                _filter.previous_filtered_measurement)
+            target_filtered = _filter.filter(self.target_aligned)
+            if kind == "moveit_servo_humble":
+                np.subtract(target_filtered, self.state, out=diff)
+            else:
+                np.subtract(target_filtered, self.last_target_filtered, out=diff)
+        else:
+            raise ValueError
+
+    def limit(self, dt: float) -> None:
+        """フィルタ後の速度・加速度制限。target_diffを上書きする"""
+        m = self._m_target_diff
+        self.limiter.limit(m, dt, out=m)
+
+    def apply(self, t_ns: int | None = None) -> None:
+        """
+        制限後の差分から制御値を計算する。
+        t_ns: 共有メモリの制御値に書き込む送信の時刻 (time.monotonic_ns)
+        """
+        kind = self.filter_kind
+        diff = self.target_diff
+        if kind in ["original", "one_euro"]:
+            np.add(self.last_control, diff, out=self.control)
+            if kind == "original":
+                # 登録するだけ
+                self._filter.filter(self.control)
+        elif kind == "moveit_servo_humble":
+            np.add(self.state, diff, out=self.control)
+        else:
+            np.add(self.last_target_filtered, diff, out=self.control)
+        self.seqlocks.control.write(self.control, t_ns)
+
+    def command_diff(self) -> np.ndarray:
+        """
+        ロボットに送る差分。加加速度を整形する場合は整形した値。
+        その加加速度の制限に対する比率をjerk_meter.jerk_max_ratioに残す。
+        周期ごとに1回呼ぶ。返り値は作業領域で、次の周期で上書きされる
+        """
+        if self.shaper is not None:
+            diff = self.shaper.shape(self.target_diff)
+        else:
+            diff = self.target_diff
+        self.jerk_meter.measure(diff)
+        return diff
+
+    def control_unchanged(self) -> bool:
+        """
+        制御値が前の周期から変わっていないか。
+        加加速度を整形する場合は整形前の差分を送り切ったかも含める
+        """
+        if np.count_nonzero(
+                np.not_equal(self.control, self.last_control, out=self._neq)):
+            return False
+        return self.shaper is None or self.shaper.flushed()
+
+    def commit(self) -> None:
+        """周期の終わりに制御値を次の周期の基準にする"""
+        np.copyto(self.last_control, self.control)
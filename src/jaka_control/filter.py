@@ -32,6 +32,48 @@ class SMAFilter:
         )
 
 
+class BufferedSMAFilter:
+    """
+    SMAFilterと同じ結果を返す、あらかじめ確保した配列上の移動平均。
+    履歴は固定長のリングバッファに持つ。
+    previous_filtered_measurementと返り値は内部のバッファで、
+    filterで上書きされる。保持する場合はコピーすること
+    """
+    def __init__(self, n_windows: int = 10, n_dims: int = 6) -> None:
+        self.n_windows = n_windows
+        self.previous_measurements = np.zeros((n_windows, n_dims))
+        # 行のビューを先に作っておき、周期ごとのビューの生成を避ける
+        self._rows = [self.previous_measurements[i] for i in range(n_windows)]
+        self.previous_filtered_measurement = np.zeros(n_dims)
+        self.pos = 0
+        self._tmp = np.zeros(n_dims)
+        self._out = np.zeros(n_dims)
+
+    def reset(self, data: np.ndarray) -> None:
+        self.previous_measurements[:] = data
+        np.copyto(self.previous_filtered_measurement, data)
+        self.pos = 0
+
+    def _update(self, new_measurement: np.ndarray, out: np.ndarray) -> None:
+        # SMAFilterと同じ順序で計算する
+        # previous - oldest / n + new / n
+        tmp = self._tmp
+        np.divide(self._rows[self.pos], self.n_windows, out=tmp)
+        np.subtract(self.previous_filtered_measurement, tmp, out=out)
+        np.divide(new_measurement, self.n_windows, out=tmp)
+        np.add(out, tmp, out=out)
+
+    def filter(self, new_measurement: np.ndarray) -> np.ndarray:
+        self._update(new_measurement, self.previous_filtered_measurement)
+        np.copyto(self._rows[self.pos], new_measurement)
+        self.pos = (self.pos + 1) % self.n_windows
+        return self.previous_filtered_measurement
+
+    def predict_only(self, new_measurement: np.ndarray) -> np.ndarray:
+        self._update(new_measurement, self._out)
+        return self._out
+
+
 class ButterworthFilter:
     def __init__(self, low_pass_filter_coeff: float = 1.5):
         self.scale_term = 1 / (1 + low_pass_filter_coeff)
@@ -50,3 +92,130 @@ class ButterworthFilter:
             - self.feedback_term * self.previous_filtered_measurement
         )
         return self.previous_filtered_measurement
+
+
+class OneEuroFilter:
+    """
+    速度に応じてカットオフ周波数を変える1次のローパスフィルタ (One Euro Filter)。
+    ゆっくり動くときは強く平滑化し、速く動くときは遅延を小さくする。
+    Casiez et al., "1€ Filter: A Simple Speed-based Low-pass Filter
+    for Noisy Input in Interactive Systems", CHI 2012.
+
+    要素ごとに独立に計算するので、6関節のベクトルでも
+    (B, 6) のようなバッチでもよい。パラメータは要素の形に
+    ブロードキャストできる配列でもよい。
+    作業領域はresetで確保し、filterでは配列を確保しない。
+    """
+    def __init__(
+        self,
+        min_cutoff: float | np.ndarray = 1.0,
+        beta: float | np.ndarray = 0.02,
+        d_cutoff: float | np.ndarray = 1.0,
+        dt: float = 0.008,
+    ) -> None:
+        """
+        min_cutoff: 静止時のカットオフ周波数 (Hz)
+        beta: 速度 (単位/s) あたりのカットオフ周波数の増分 (Hz)
+        d_cutoff: 速度の推定に使うローパスフィルタのカットオフ周波数 (Hz)
+        dt: filterでdtを省略したときの周期 (s)
+        """
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.dt = dt
+
+    def reset(self, data: np.ndarray) -> None:
+        data = np.asarray(data, dtype=float)
+        self.previous_filtered_measurement = data.copy()
+        self.previous_filtered_velocity = np.zeros_like(data)
+        self._velocity = np.zeros_like(data)
+        self._alpha = np.zeros_like(data)
+        # 速度のフィルタの係数は速度によらないのでdtごとに1回だけ計算する
+        self._d_alpha_dt = None
+        self._d_alpha = None
+
+    @staticmethod
+    def _alpha_from_cutoff(cutoff, dt: float):
+        # tau = 1 / (2 pi fc), alpha = 1 / (1 + tau / dt)
+        return 1.0 / (1.0 + 1.0 / (2 * np.pi * cutoff * dt))
+
+    def filter(
+        self,
+        new_measurement: np.ndarray,
+        dt: float | None = None,
+    ) -> np.ndarray:
+        """
+        返り値は内部のバッファで、次のfilterで上書きされる。
+        保持する場合はコピーすること
+        """
+        if dt is None:
+            dt = self.dt
+        x_hat = self.previous_filtered_measurement
+        dx_hat = self.previous_filtered_velocity
+        dx = self._velocity
+        alpha = self._alpha
+        if dt != self._d_alpha_dt:
+            self._d_alpha = self._alpha_from_cutoff(self.d_cutoff, dt)
+            self._d_alpha_dt = dt
+
+        # 速度の推定 (前回の出力からの差分をローパスする)
+        np.subtract(new_measurement, x_hat, out=dx)
+        np.divide(dx, dt, out=dx)
+        np.subtract(dx, dx_hat, out=dx)
+        np.multiply(dx, self._d_alpha, out=dx)
+        np.add(dx_hat, dx, out=dx_hat)
+
+        # 速度に応じたカットオフ周波数からalphaを求める
+        # alpha = 1 / (1 + 1 / (2 pi fc dt))
+        np.abs(dx_hat, out=alpha)
+        np.multiply(alpha, self.beta, out=alpha)
+        np.add(alpha, self.min_cutoff, out=alpha)
+        np.multiply(alpha, 2 * np.pi * dt, out=alpha)
+        np.reciprocal(alpha, out=alpha)
+        np.add(alpha, 1.0, out=alpha)
+        np.reciprocal(alpha, out=alpha)
+
+        # x_hat += alpha * (x - x_hat)
+        np.subtract(new_measurement, x_hat, out=dx)
+        np.multiply(dx, alpha, out=dx)
+        np.add(x_hat, dx, out=x_hat)
+        return x_hat
+
+
+class JerkShaper:
+    """
+    制御値の差分 (速度) の移動平均で加加速度を制限する (FIR型のS字加減速)。
+    入力の加速度が制限内なら、出力の加加速度は
+    2 * 加速度の制限 / (n_windows * 周期) 以下になり、
+    速度と加速度の制限も保たれる。
+    全関節に同じ移動平均をかけるので関節間の時間の同期は保たれる。
+    フィードバックループの外側にかけるので発散しない代わりに、
+    (n_windows - 1) / 2周期の遅延が加わる。
+    """
+    def __init__(self, n_windows: int, n_dims: int = 6) -> None:
+        self.n_windows = n_windows
+        self.previous_diffs = np.zeros((n_windows, n_dims))
+        self._rows = [self.previous_diffs[i] for i in range(n_windows)]
+        self._weights = np.full(n_windows, 1 / n_windows)
+        self._out = np.zeros(n_dims)
+        self.pos = 0
+
+    def reset(self) -> None:
+        self.previous_diffs.fill(0)
+        self.pos = 0
+
+    def shape(self, diff: np.ndarray) -> np.ndarray:
+        """
+        返り値は内部のバッファで、次のshapeで上書きされる。
+        保持する場合はコピーすること
+        """
+        np.copyto(self._rows[self.pos], diff)
+        self.pos = (self.pos + 1) % self.n_windows
+        # 移動和を差分で更新すると丸め誤差で静止時に0にならないので毎回足し直す
+        # np.meanは縮約の一時領域を確保するので重みとの内積で計算する
+        np.dot(self._weights, self.previous_diffs, out=self._out)
+        return self._out
+
+    def flushed(self) -> bool:
+        """入力済みの差分をすべて出力し終えたか"""
+        return np.count_nonzero(self.previous_diffs) == 0
@@ -0,0 +1,106 @@
+"""
+関節の状態値、目標値、制御値の履歴を共有メモリ上のリングバッファに置く。
+書き込む側はそれぞれの値を得たとき (状態値はフィードバックの受信、
+目標値はMQTTの受信、制御値は送信) に時刻とともに追記するので、
+読み出す側 (GUI、診断、分析) は周期的に共有メモリを見る場合のように
+取りこぼしたり重複したりせずに、最近の値をNumPyのビューとして読める。
+形式はconfig.HISTORY_RING_DTYPEを参照。
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from .shm import attach_history_shm, create_history_shm
+
+
+HISTORY_KINDS: List[str] = ["state", "target", "control"]
+
+
+class HistoryRing:
+    """
+    1種類の値の履歴。書き込むプロセスは1つとし、ロックは使わない。
+    件数は単調に増やし、i件目は位置i % 容量とi % 容量 + 容量の両方に書くので、
+    最近の容量分までは折り返さずに連続したビューで読める。
+    書き込み側は記録を書いてから件数を更新する。
+    読み出し側はビューを使い終わってからn_tornで上書きされた件数を確認する
+    (seqlockと同じく、読んだ後に件数を見て読み直すか捨てるかを決める)
+    """
+    def __init__(self, ring: np.ndarray) -> None:
+        """ring: HISTORY_RING_DTYPEの0次元の配列 (共有メモリのビュー)"""
+        self._count = ring["count"]
+        self.records = ring["records"]
+        self._time = self.records["time"]
+        self._joint = self.records["joint"]
+        self.capacity = len(self.records) // 2
+
+    @property
+    def count(self) -> int:
+        """書き込み済みの件数"""
+        return int(self._count)
+
+    def append(self, t_ns: int, joint: np.ndarray) -> None:
+        """書き込み側のプロセスからのみ呼ぶ。配列を確保しない"""
+        w = int(self._count)
+        i = w % self.capacity
+        j = i + self.capacity
+        self._time[i] = t_ns
+        self._joint[i] = joint
+        self._time[j] = t_ns
+        self._joint[j] = joint
+        self._count[...] = w + 1
+
+    def view(self, n: int) -> Tuple[np.ndarray, int]:
+        """
+        最近n件 (書き込み中の位置を除き最大で容量 - 1件) の記録のビューと、
+        その先頭の記録が何件目かを返す。ビューはコピーせず、その後の書き込みで
+        上書きされうるので、使い終わったらn_tornで確認する
+        """
+        w = int(self._count)
+        n = min(n, w, self.capacity - 1)
+        first = w - n
+        i = first % self.capacity
+        return self.records[i:i + n], first
+
+    def view_since(self, t_ns: int) -> Tuple[np.ndarray, int]:
+        """時刻t_ns以降の記録のビューと、その先頭の記録が何件目かを返す"""
+        v, first = self.view(self.capacity)
+        k = int(np.searchsorted(v["time"], t_ns))
+        return v[k:], first + k
+
+    def n_torn(self, first: int, n: int) -> int:
+        """
+        first件目からのn件のうち、書き込みで上書きされた (されている途中の)
+        先頭の件数
+        """
+        w = int(self._count)
+        return min(max(w - self.capacity + 1 - first, 0), n)
+
+    def read_since(self, t_ns: int) -> np.ndarray:
+        """時刻t_ns以降の記録のコピー。上書きされた先頭の記録は除く"""
+        v, first = self.view_since(t_ns)
+        out = v.copy()
+        return out[self.n_torn(first, len(out)):]
+
+    def release(self) -> None:
+        self._count = self.records = self._time = self._joint = None
+
+
+class Histories:
+    """HISTORY_KINDSの種類ごとの履歴"""
+    def __init__(self, create: bool = False) -> None:
+        if create:
+            self.sm, record = create_history_shm()
+        else:
+            self.sm, record = attach_history_shm()
+        ar = record.base
+        for kind in HISTORY_KINDS:
+            setattr(self, kind, HistoryRing(ar[kind]))
+
+    def close(self) -> None:
+        # 共有メモリのビューを先に手放す
+        for kind in HISTORY_KINDS:
+            getattr(self, kind).release()
+        self.sm.close()
+
+    def unlink(self) -> None:
+        self.sm.unlink()
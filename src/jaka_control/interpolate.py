@@ -1,3 +1,5 @@
+import bisect
+
 import numpy as np
 
 
@@ -72,3 +74,295 @@ class DelayedInterpolator:
             else:
                 self.ts = self.ts[i:]
                 self.data = self.data[i:]
+
+
+class RingDelayedInterpolator:
+    """
+    DelayedInterpolatorと同じ結果を返す固定長リングバッファ版。
+    時刻の列の二分探索で前後のデータを探し、
+    周期ごとの配列の確保をしない。
+    """
+    def __init__(
+        self,
+        delay: float = 0.1,
+        capacity: int = 256,
+        n_dims: int = 6,
+    ) -> None:
+        self.delay = delay
+        self.capacity = capacity
+        # 論理的な範囲[head, head + size)が常に連続するように
+        # 時刻は2周分の長さに2重に書き込む
+        # 二分探索の要素アクセスを速くするためfloatのリストで持つ
+        self.ts = [0.0] * (2 * capacity)
+        self.data = np.zeros((capacity, n_dims))
+        # 行のビューを先に作っておき、周期ごとのビューの生成を避ける
+        self._rows = [self.data[i] for i in range(capacity)]
+        self.head = 0
+        self.size = 0
+        self._last = np.zeros(n_dims)
+        self._neq = np.zeros(n_dims, dtype=bool)
+        self._tmp = np.zeros(n_dims)
+        self._out = np.zeros(n_dims)
+
+    def reset(self, t: float, datum: np.ndarray) -> None:
+        self.head = 0
+        self.size = 0
+        self._append(t, datum)
+
+    def read(self, t: float, datum: np.ndarray) -> np.ndarray:
+        """
+        返り値は内部のバッファで、次のreadで上書きされる。
+        保持する場合はコピーすること
+        """
+        self.create(t, datum)
+        out = self._out
+        head = self.head
+        # 現在の時間 - 遅延以降の最初のデータ
+        i = bisect.bisect_left(
+            self.ts, t - self.delay, head, head + self.size) - head
+        if i > 0:
+            # 現在の時間 - 遅延の直前のデータ
+            j1 = head + i - 1
+            if i < self.size:
+                # 現在の時間 - 遅延の直後のデータ
+                j2 = j1 + 1
+                t1 = self.ts[j1]
+                t2 = self.ts[j2]
+                d1 = self._rows[j1 % self.capacity]
+                d2 = self._rows[j2 % self.capacity]
+                # 線形補間
+                tmp = self._tmp
+                np.subtract(d2, d1, out=tmp)
+                np.divide(tmp, t2 - t1, out=tmp)
+                np.multiply(tmp, t - self.delay - t1, out=tmp)
+                np.add(d1, tmp, out=out)
+            else:
+                np.copyto(out, self._rows[j1 % self.capacity])
+        else:
+            np.copyto(out, self._rows[head % self.capacity])
+        return out
+
+    def create(self, t: float, datum: np.ndarray) -> None:
+        self.update(t)
+        if (self.size == 0 or
+                np.count_nonzero(
+                    np.not_equal(self._last, datum, out=self._neq))):
+            self._append(t, datum)
+
+    def update(self, t: float) -> None:
+        if self.size == 0:
+            return
+        head = self.head
+        # 現在の時間 - 遅延より古いデータの中で最新のもの
+        i = bisect.bisect_left(
+            self.ts, t - self.delay, head, head + self.size) - head - 1
+        if i >= 0:
+            # 古いデータがあればその中で最新のものが古すぎれば全部捨てる
+            if self.ts[head + i] < t - self.delay * 2:
+                n_drop = i + 1
+            # 古いデータがあればその中で最新のものだけ残す
+            else:
+                n_drop = i
+            self.head = (head + n_drop) % self.capacity
+            self.size -= n_drop
+
+    def _append(self, t: float, datum: np.ndarray) -> None:
+        if self.size == self.capacity:
+            # 満杯の場合は最も古いデータを捨てる
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+        j = (self.head + self.size) % self.capacity
+        t = float(t)
+        self.ts[j] = t
+        self.ts[j + self.capacity] = t
+        np.copyto(self._rows[j], datum)
+        np.copyto(self._last, datum)
+        self.size += 1
+
+
+class AdaptiveDelayedInterpolator(RingDelayedInterpolator):
+    """
+    目標値の到着間隔の分布から遅延を決めるRingDelayedInterpolator。
+
+    到着間隔のpercentileパーセンタイルにmarginを足した値を遅延の目標とし、
+    [min_delay, max_delay]に収める。遅延を急に変えると読み出す時刻が
+    飛んで目標値が急に動くので、遅延の変化の速さを制限する。
+    読み出す時刻 (現在時刻 - 遅延) が逆戻りしないように、増やす速さは1未満とする。
+    遅延を過ぎても次の目標値が届かない場合は、直前の2点から
+    最大max_extrapolation秒まで線形に外挿する。
+    """
+    def __init__(
+        self,
+        delay: float = 0.1,
+        min_delay: float = 0.03,
+        max_delay: float = 0.2,
+        percentile: float = 99,
+        margin: float = 0.008,
+        max_delay_rate_up: float = 0.5,
+        max_delay_rate_down: float = 0.05,
+        max_extrapolation: float = 0.03,
+        n_intervals: int = 512,
+        min_intervals: int = 64,
+        update_every: int = 16,
+        capacity: int = 256,
+        n_dims: int = 6,
+    ) -> None:
+        """
+        delay: 到着間隔が十分に集まるまでの遅延 (s)
+        min_delay, max_delay: 遅延の範囲 (s)
+        percentile: 遅延の目標に使う到着間隔のパーセンタイル
+        margin: 到着間隔のパーセンタイルに足す余裕 (s)。
+        目標値は制御周期ごとにしか読まれないので制御周期程度とする
+        max_delay_rate_up, max_delay_rate_down: 遅延を増やす、減らす速さ (s/s)
+        max_extrapolation: 外挿する最大の時間 (s)。0で外挿しない
+        n_intervals: 到着間隔を保持する数
+        min_intervals: 遅延を変え始めるのに必要な到着間隔の数
+        update_every: 遅延の目標を計算し直す到着の間隔 (回)
+        """
+        super().__init__(delay=delay, capacity=capacity, n_dims=n_dims)
+        self.initial_delay = delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.percentile = percentile
+        self.margin = margin
+        self.max_delay_rate_up = max_delay_rate_up
+        self.max_delay_rate_down = max_delay_rate_down
+        self.max_extrapolation = max_extrapolation
+        self.min_intervals = min_intervals
+        self.update_every = update_every
+        self.intervals = np.zeros(n_intervals)
+        # パーセンタイルの計算で配列を確保しないための作業領域
+        self._sorted = np.zeros(n_intervals)
+        self._prev = np.zeros(n_dims)
+        self._reset_adaptation()
+
+    def _reset_adaptation(self) -> None:
+        self.delay = self.initial_delay
+        self.target_delay = self.initial_delay
+        self.n_arrivals = 0
+        self.n_extrapolated = 0
+        self._t_arrival = None
+        self._t_read = None
+        self._t_prev = None
+
+    def reset(self, t: float, datum: np.ndarray) -> None:
+        self._reset_adaptation()
+        super().reset(t, datum)
+        self._t_arrival = t
+
+    def read(
+        self,
+        t: float,
+        datum: np.ndarray,
+        arrived: bool | None = None,
+        t_datum: float | None = None,
+    ) -> np.ndarray:
+        """
+        arrived: 前回のreadから目標値が届いたか。
+        Noneの場合は目標値が変わったかどうかで判定するが、
+        静止している目標値を到着として扱えないので外挿が行き過ぎることがある。
+        t_datum: 目標値の時刻 (送信時刻など、tと同じ時計)。Noneでt。
+        まとめて届いた目標値も送られた間隔で補間するため。遅延の調整には到着の時刻を使う
+        返り値は内部のバッファで、次のreadで上書きされる
+        """
+        self._update_delay(t)
+        self.create(t, datum, arrived, t_datum)
+        out = self._out
+        head = self.head
+        # 現在の時間 - 遅延以降の最初のデータ
+        t_read = t - self.delay
+        i = bisect.bisect_left(
+            self.ts, t_read, head, head + self.size) - head
+        if i > 0:
+            j1 = head + i - 1
+            d1 = self._rows[j1 % self.capacity]
+            t1 = self.ts[j1]
+            tmp = self._tmp
+            if i < self.size:
+                # 線形補間
+                j2 = j1 + 1
+                t2 = self.ts[j2]
+                d2 = self._rows[j2 % self.capacity]
+                np.subtract(d2, d1, out=tmp)
+                np.divide(tmp, t2 - t1, out=tmp)
+                np.multiply(tmp, t_read - t1, out=tmp)
+                np.add(d1, tmp, out=out)
+            elif (self.max_extrapolation > 0 and self._t_prev is not None
+                    and t1 > self._t_prev):
+                # 次のデータが遅れているので直前の2点から外挿する
+                t_ex = min(t_read - t1, self.max_extrapolation)
+                np.subtract(d1, self._prev, out=tmp)
+                np.divide(tmp, t1 - self._t_prev, out=tmp)
+                np.multiply(tmp, t_ex, out=tmp)
+                np.add(d1, tmp, out=out)
+                self.n_extrapolated += 1
+            else:
+                np.copyto(out, d1)
+        else:
+            np.copyto(out, self._rows[head % self.capacity])
+        return out
+
+    def create(
+        self,
+        t: float,
+        datum: np.ndarray,
+        arrived: bool | None = None,
+        t_datum: float | None = None,
+    ) -> None:
+        self.update(t)
+        changed = (self.size == 0 or np.count_nonzero(
+            np.not_equal(self._last, datum, out=self._neq)))
+        if arrived is None:
+            arrived = bool(changed)
+        if arrived:
+            self._record_arrival(t)
+        # 到着の判定と目標値の書き込みは競合しうるので、値が変わった場合も追加する
+        if arrived or changed:
+            if t_datum is None or t_datum > t:
+                t_datum = t
+            elif self.size > 0:
+                # 二分探索のため時刻は直前のデータより戻さない
+                t_last = self.ts[(self.head + self.size - 1) % self.capacity]
+                if t_datum < t_last:
+                    t_datum = t_last
+            self._append(t_datum, datum)
+
+    def _append(self, t: float, datum: np.ndarray) -> None:
+        # 外挿用に直前のデータを残しておく
+        if self.size > 0:
+            np.copyto(self._prev, self._last)
+            self._t_prev = self.ts[(self.head + self.size - 1) % self.capacity]
+        super()._append(t, datum)
+
+    def _record_arrival(self, t: float) -> None:
+        if self._t_arrival is not None:
+            n = len(self.intervals)
+            self.intervals[self.n_arrivals % n] = t - self._t_arrival
+            self.n_arrivals += 1
+            if (self.n_arrivals >= self.min_intervals and
+                    self.n_arrivals % self.update_every == 0):
+                target = self._percentile(min(self.n_arrivals, n)) + self.margin
+                self.target_delay = float(
+                    min(max(target, self.min_delay), self.max_delay))
+        self._t_arrival = t
+
+    def _percentile(self, n: int) -> float:
+        """到着間隔のパーセンタイル (np.percentileの線形補間と同じ)"""
+        buf = self._sorted[:n]
+        np.copyto(buf, self.intervals[:n])
+        buf.sort()
+        h = (n - 1) * self.percentile / 100
+        i = int(h)
+        if i + 1 >= n:
+            return float(buf[n - 1])
+        lo = float(buf[i])
+        return lo + (float(buf[i + 1]) - lo) * (h - i)
+
+    def _update_delay(self, t: float) -> None:
+        if self._t_read is not None:
+            dt = t - self._t_read
+            diff = self.target_delay - self.delay
+            diff = min(max(diff, -self.max_delay_rate_down * dt),
+                       self.max_delay_rate_up * dt)
+            self.delay += diff
+        self._t_read = t
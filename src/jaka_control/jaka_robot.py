@@ -4,12 +4,12 @@ import logging
 import threading
 import time
 import traceback
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 
 import numpy as np
 
-from .jkrc import RC
 from .jkrc_feedback import RCFeedBack
+from .rc_pool import RCPool
 
 
 class JakaRobotError(Exception):
@@ -23,13 +23,26 @@ class JakaRobot:
         ip_move: str = "10.5.5.100",
         port_move: int = 10001,
         logger: Optional[logging.Logger] = None,
+        use_pool: bool = True,
+        health_interval: Optional[float] = 5.0,
     ) -> None:
+        """
+        use_pool: servo_j、問い合わせ、通常の移動で別の接続を使う (RCPool)。
+        Falseで1つの接続を共有する
+        health_interval: 接続を確かめて必要ならログインし直す間隔 (秒)。
+        Noneで確かめない
+        """
         if logger is None:
             self.logger = logging.getLogger(__name__)
         else:
             self.logger = logger
         self.name = name
-        self.client_move = RC(ip=ip_move, port=port_move)
+        self.health_interval = health_interval
+        self.clients = RCPool(
+            ip_move, port_move, shared=not use_pool, logger=self.logger)
+        self.client_servo = self.clients["servo"]
+        self.client_query = self.clients["query"]
+        self.client_move = self.clients["motion"]
 
     def __del__(self) -> None:
         self.leave_servo_mode()
@@ -38,18 +51,21 @@ class JakaRobot:
         self.logger.info("Robot deleted")
 
     def power_on(self) -> None:
-        res = self.client_move.power_on()
+        res = self.clients.call("motion", "power_on")
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def enable_robot(self) -> None:
-        res = self.client_move.enable_robot()
+        res = self.clients.call("motion", "enable_robot")
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def start(self) -> None:
         self.logger.info("start")
-        self.client_move.login()
+        # 再接続の場合も含め、すべての接続でログインし直す
+        self.clients.login()
+        if self.health_interval is not None:
+            self.clients.start_health_monitor(self.health_interval)
         # res = self.client_move.set_torsenosr_brand(1)
         # if res[0] != 0:
         #     raise JakaRobotError(res[1])
@@ -138,24 +154,26 @@ class JakaRobot:
 
     def move_pose(self, pose) -> None:
         # absolute pose move
-        res = self.client_move.end_move(pose, speed=10, accel=10)
+        res = self.clients.call(
+            "motion", "end_move", pose, speed=10, accel=10)
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def move_joint(self, joint) -> None:
         # absolute joint move
-        res = self.client_move.joint_move_with_acc(joint, 0, speed=10, accel=10)
+        res = self.clients.call(
+            "motion", "joint_move_with_acc", joint, 0, speed=10, accel=10)
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def get_current_pose(self) -> List[float]:
-        res = self.client_move.get_tcp_position()
+        res = self.clients.call("query", "get_tcp_position")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[1]
 
     def get_current_joint(self) -> List[float]:
-        res = self.client_move.get_joint_position()
+        res = self.clients.call("query", "get_joint_position")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[1]
@@ -173,18 +191,49 @@ class JakaRobot:
                         "Failed to enter servo mode in 30 seconds.")
 
     def servo_move_enable(self, enable: bool) -> None:
-        res = self.client_move.servo_move_enable(enable)
+        res = self.clients.call("servo", "servo_move_enable", enable)
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def move_joint_servo(self, pose) -> None:
         """differential joint servo move"""
-        res = self.client_move.servo_j(pose, 1)
+        res = self.client_servo.servo_j(pose, 1)
+        if res[0] != 0:
+            raise JakaRobotError(res[1])
+
+    def start_servo_stream(
+        self,
+        max_in_flight: int,
+        on_reply: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        """move_joint_servoで応答を待たずに送る (RC.start_servo_pipeline)"""
+        self.logger.info(f"start_servo_stream (max in flight {max_in_flight})")
+        self.client_servo.start_servo_pipeline(max_in_flight, on_reply)
+
+    def stop_servo_stream(self) -> None:
+        """送ったservo_jの応答をすべて受けてから止める"""
+        if not self.client_servo.servo_pipelined:
+            return
+        res = self.client_servo.stop_servo_pipeline()
+        stats = self.client_servo.servo_stats
+        self.logger.info(
+            f"stop_servo_stream: {stats['sent']} sent, "
+            f"{stats['replied']} replied, {stats['errors']} errors, "
+            f"max {stats['max_in_flight']} in flight, "
+            f"max round trip {stats['max_rtt_ns'] / 1e6:.3f} ms")
+        self.logger.info(
+            f"Controller commands: "
+            f"{self.client_servo.telemetry.format_summary()}")
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def leave_servo_mode(self) -> None:
         self.logger.info("leave_servo_mode")
+        # 送ったservo_jの応答を受け切ってから通常の送受信に戻す
+        try:
+            self.stop_servo_stream()
+        except JakaRobotError as e:
+            self.logger.error(f"Error in servo stream: {e}")
         cnt = 0
         if self.is_in_servomove():
             self.servo_move_enable(False)
@@ -196,35 +245,35 @@ class JakaRobot:
                         "Failed to leave servo mode in 30 seconds.")
 
     def disable(self) -> None:
-        res = self.client_move.disable_robot()
+        res = self.clients.call("motion", "disable_robot")
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def stop(self) -> None:
-        res = self.client_move.power_off()
+        res = self.clients.call("motion", "power_off")
         if res[0] != 0:
             raise JakaRobotError(res[1])
-        self.client_move.logout()
+        self.clients.logout()
 
     def clear_error(self) -> None:
-        res = self.client_move.clear_error()
+        res = self.clients.call("motion", "clear_error")
         if res[0] != 0:
             raise JakaRobotError(res[1])
 
     def is_powered_on(self) -> bool:
-        res = self.client_move.get_robot_state()
+        res = self.clients.call("query", "get_robot_state")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[1] == 1
 
     def is_enabled(self) -> bool:
-        res = self.client_move.get_robot_state()
+        res = self.clients.call("query", "get_robot_state")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[2] == 1
 
     def is_in_servomove(self) -> bool:
-        res = self.client_move.is_in_servomove()
+        res = self.clients.call("query", "is_in_servomove")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[1]
@@ -260,7 +309,7 @@ class JakaRobot:
         self.move_pose(poses.tolist())
 
     def emergency_stop_status(self) -> bool:
-        res = self.client_move.get_robot_state()
+        res = self.clients.call("query", "get_robot_state")
         if res[0] != 0:
             raise JakaRobotError(res[1])
         return res[1] == 1
@@ -366,6 +415,12 @@ class JakaRobotFeedback:
         with self.__Lock:
             return self.latest_feed["joint_actual_position"]
 
+    def get_current_joint_feed_stamped(self) -> Tuple[List[float], int]:
+        """関節の状態値と、そのフィードバックの受信時刻 (time.monotonic_ns)"""
+        with self.__Lock:
+            return (self.latest_feed["joint_actual_position"],
+                    self.latest_feed["timestamp_ns"])
+
     def ForceValue_feed(self) -> List[float]:
         """トルクセンサの実際の力 (6次元)"""
         with self.__Lock:
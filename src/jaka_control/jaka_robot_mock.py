@@ -1,38 +1,22 @@
 import datetime
 import json
 import logging
-import multiprocessing as mp
-import multiprocessing.shared_memory
 import threading
 import time
 import traceback
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 
 from .config import DEFAULT_JOINT
-
-
-SHM_NAME = "mock_jaka"
-SHM_SIZE = 32
+from .shm import attach_mock_shm, create_mock_shm
 
 
 class MockJakaRobotSharedMemoryManager:
     def __init__(self):
-        sz = SHM_SIZE * np.dtype('float32').itemsize
-        try:
-            self.sm = mp.shared_memory.SharedMemory(create=True,size = sz, name=SHM_NAME)
-        except FileExistsError:
-            self.sm = mp.shared_memory.SharedMemory(size = sz, name=SHM_NAME)
-        # self.arの要素の説明
-        # [0:6]: 関節の状態値
-        # [6:12]: 位置の状態値
-        # [12]: ロボットの電源
-        # [13]: モーターの電源
-        # [14]: スレーブモードの状態
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
-        self.pose[:] = 0
-        self.pose[0:6] = DEFAULT_JOINT  # 初期関節値を設定
+        # 共有メモリの形式はconfig.MOCK_SHM_DTYPEを参照
+        self.sm, self.pose = create_mock_shm()
+        self.pose["joint"] = DEFAULT_JOINT  # 初期関節値を設定
 
     def _del_sm(self):
         self.sm.close()
@@ -49,6 +33,8 @@ class MockJakaRobot:
         ip_move: str = "10.5.5.100",
         port_move: int = 10001,
         logger: Optional[logging.Logger] = None,
+        use_pool: bool = True,
+        health_interval: Optional[float] = 5.0,
     ):
         if logger is None:
             self.logger = logging.getLogger(__name__)
@@ -58,8 +44,7 @@ class MockJakaRobot:
         self._init_sm()
 
     def _init_sm(self):
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
+        self.sm, self.pose = attach_mock_shm()
 
     def _del_sm(self):
         self.sm.close()
@@ -73,11 +58,11 @@ class MockJakaRobot:
         self._del_sm()
 
     def power_on(self) -> None:
-        self.pose[12] = 1
+        self.pose["powered_on"] = 1
         self.logger.info("Mock: power_on called")
 
     def enable_robot(self) -> None:
-        self.pose[13] = 1
+        self.pose["enabled"] = 1
         self.logger.info("Mock: enable_robot called")
 
     def start(self) -> None:
@@ -111,40 +96,46 @@ class MockJakaRobot:
         return True
 
     def move_pose(self, pose) -> None:
-        self.pose[6:12] = pose
+        self.pose["tcp_pose"] = pose
         self.logger.info(f"Mock: move_pose called with {pose}")
 
     def move_joint(self, joint) -> None:
-        self.pose[0:6] = joint
+        self.pose["joint"] = joint
         self.logger.info(f"Mock: move_joint called with {joint}")
 
     def get_current_pose(self) -> List[float]:
         self.logger.info("Mock: get_current_pose called")
-        return self.pose[6:12].tolist()
+        return self.pose["tcp_pose"].tolist()
 
     def get_current_joint(self) -> List[float]:
         self.logger.info("Mock: get_current_joint called")
-        return self.pose[0:6].tolist()
+        return self.pose["joint"].tolist()
 
     def enter_servo_mode(self) -> None:
-        self.pose[14] = 1
+        self.pose["servo_mode"] = 1
         self.logger.info("Mock: enter_servo_mode called")
 
     def move_joint_servo(self, pose) -> None:
-        self.pose[0:6] = (np.array(self.pose[0:6]) + np.array(pose)).tolist()
+        self.pose["joint"] = (np.array(self.pose["joint"]) + np.array(pose)).tolist()
         # Stop logging because often called too frequently
         # self.logger.info(f"Mock: move_joint_servo called with {pose}")
 
+    def start_servo_stream(self, max_in_flight, on_reply=None) -> None:
+        self.logger.info("Mock: start_servo_stream called")
+
+    def stop_servo_stream(self) -> None:
+        self.logger.info("Mock: stop_servo_stream called")
+
     def leave_servo_mode(self) -> None:
-        self.pose[14] = 0
+        self.pose["servo_mode"] = 0
         self.logger.info("Mock: leave_servo_mode called")
 
     def disable(self) -> None:
-        self.pose[13] = 0
+        self.pose["enabled"] = 0
         self.logger.info("Mock: disable called")
 
     def stop(self) -> None:
-        self.pose[12] = 0
+        self.pose["powered_on"] = 0
         self.logger.info("Mock: stop called")
 
     def clear_error(self) -> None:
@@ -152,15 +143,15 @@ class MockJakaRobot:
 
     def is_powered_on(self) -> bool:
         self.logger.info("Mock: is_powered_on called")
-        return bool(self.pose[12] == 1)
+        return bool(self.pose["powered_on"] == 1)
 
     def is_enabled(self) -> bool:
         self.logger.info("Mock: is_enabled called")
-        return bool(self.pose[13] == 1) 
+        return bool(self.pose["enabled"] == 1) 
 
     def is_in_servomove(self) -> bool:
         self.logger.info("Mock: is_in_servomove called")
-        return bool(self.pose[14] == 1)
+        return bool(self.pose["servo_mode"] == 1)
 
     def format_error(self, e: Exception) -> str:
         s = "\n"
@@ -230,8 +221,7 @@ class MockJakaRobotFeedback:
         self._init_sm()
 
     def _init_sm(self):
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
+        self.sm, self.pose = attach_mock_shm()
 
     def _del_sm(self):
         self.sm.close()
@@ -249,17 +239,18 @@ class MockJakaRobotFeedback:
             feed_data = {
                 "errcode": 0,
                 "errmsg": "",
-                "powered_on": bool(self.pose[12] == 1),
-                "enabled": bool(self.pose[13] == 1),
+                "powered_on": bool(self.pose["powered_on"] == 1),
+                "enabled": bool(self.pose["enabled"] == 1),
                 "paused": False,
                 "on_soft_limit": False,
                 "emergency_stop": False,
                 "protective_stop": False,
-                "actual_position": self.pose[6:12].tolist(),
-                "joint_actual_position": self.pose[0:6].tolist(),
+                "actual_position": self.pose["tcp_pose"].tolist(),
+                "joint_actual_position": self.pose["joint"].tolist(),
                 "torqsensor": [[0]*6, [0]*6, [0]*6],
             }
             feed_data["timestamp"] = time.perf_counter()
+            feed_data["timestamp_ns"] = time.monotonic_ns()
             self._on_feed(feed_data)
 
     def start(self):
@@ -324,6 +315,12 @@ class MockJakaRobotFeedback:
         with self.__Lock:
             return self.latest_feed["joint_actual_position"]
 
+    def get_current_joint_feed_stamped(self) -> Tuple[List[float], int]:
+        """関節の状態値と、そのフィードバックの受信時刻 (time.monotonic_ns)"""
+        with self.__Lock:
+            return (self.latest_feed["joint_actual_position"],
+                    self.latest_feed["timestamp_ns"])
+
     def ForceValue_feed(self) -> List[float]:
         with self.__Lock:
             torqsensor = self.latest_feed["torqsensor"]
@@ -1,7 +1,6 @@
 # Jakaを制御する
 
 import logging
-import queue
 import traceback
 from typing import Any, Dict, List, Literal, TextIO, Tuple
 import datetime
@@ -13,6 +12,7 @@ import json
 import psutil
 
 import multiprocessing as mp
+import multiprocessing.connection
 import threading
 
 import numpy as np
@@ -23,10 +23,20 @@ from .ag95_mock import MockAG95
 from .jaka_robot import JakaRobot
 # from .jaka_robot_mock import MockJakaRobot
 from .config import (
-    DEFAULT_JOINT, MIN_JOINT_LIMIT, MAX_JOINT_LIMIT, SHM_NAME, SHM_SIZE, T_INTV
+    ACCEL_LIMITS, DEFAULT_JOINT, JERK_LIMITS, MIN_JOINT_LIMIT, MAX_JOINT_LIMIT,
+    SPEED_LIMIT, T_INTV
 )
-from .filter import SMAFilter
-from .interpolate import DelayedInterpolator
+from .control_step import ControlStep
+from .history import Histories
+from .latency import LATENCY_PHASES, LatencyHistograms
+from .notify import Notifiers
+from .record_ring import (
+    F_EXTRA, F_JOINT, F_KIND, F_TIME, KIND_CONTROL, KIND_TARGET,
+    KIND_TARGET_DELAYED, RECORD_SIZE, RecordRing, record_to_dict
+)
+from .scheduler import PeriodicScheduler
+from .shm import attach_shm
+from .stream_timing import MotionLatency, StaleWatch
 from .tools import tool_infos, tool_classes, tool_base
 
 
@@ -36,6 +46,19 @@ ROBOT_IP = os.getenv("ROBOT_IP", "10.5.5.100")
 SAVE = os.getenv("SAVE", "true") == "true"
 MOVE = os.getenv("MOVE", "true") == "true"
 MOCK = os.getenv("MOCK", "false") == "true"
+# 規格化、ソフトリミット、速度・加速度制限の実装 ("python"または"numpy")
+# 結果はビット単位で同じ。6関節ではPython版の方が速い (check_joint_math.py)
+JOINT_MATH = os.getenv("JOINT_MATH", "python")
+# servo_jを応答を待たずに送り、応答は別スレッドで受ける
+# 制御周期がコントローラーの応答時間に左右されなくなる
+SERVO_PIPELINE = os.getenv("SERVO_PIPELINE", "true") == "true"
+# 応答を待つservo_jの上限。超えると応答を待ってから送る
+SERVO_MAX_IN_FLIGHT = int(os.getenv("SERVO_MAX_IN_FLIGHT", "4"))
+# 最初の読み出しで書き込み中だった場合に読み直す時間 (秒)
+FIRST_READ_SPIN = 0.001
+# servo_j、問い合わせ、通常の移動でコントローラーへの接続を分ける
+# 別スレッドの問い合わせでservo_jが止まらない
+RC_POOL = os.getenv("RC_POOL", "true") == "true"
 
 # 基本的に運用時には固定するパラメータ
 # 実際にロボットを制御するかしないか (VRとの結合時のデバッグ用)
@@ -50,22 +73,31 @@ filter_kind: Literal[
     "state_and_target_diff",
     "moveit_servo_humble",
     "control_and_target_diff",
+    "one_euro",
 ] = "original"
 
-# 速度制限 (deg/s)。スペック上の制限
-speed_limits = 180
+# 速度制限 (deg/s)
+speed_limits = SPEED_LIMIT
 speed_limit_ratio = 0.5
 
-# 加速度制限 (deg/s^2)。
-# JakaのMoveJでの推奨の制限値
-# NOTE: 適切に利用しないと、そのままの値ではかなり制限が小さいと思われる
-# accel_limits = 720
-# NOTE: とりあえず十分大きい値としてCobotta Proの制限値を利用するが要検討
-accel_limits = np.array([4040, 4033.33, 4040, 5050, 5050, 4860])
+# 加速度制限 (deg/s^2)
+accel_limits = np.array(ACCEL_LIMITS)
 accel_limit_ratio = 0.5
 
+# 加加速度制限 (deg/s^3)。フィルタ後の制限のみ
+# ロボットに送る差分の比率は常に記録し、use_jerk_limitがTrueのときだけ
+# ロボットに送る差分をJerkShaperで整形する
+# NOTE: 有効にする場合はreplayで追従性を確認してから
+# speed_limit_ratio, accel_limit_ratioを上げること
+jerk_limits = np.array(JERK_LIMITS)
+jerk_limit_ratio = 0.5
+use_jerk_limit = False
+
 stopped_velocity_eps = 1e-4
 use_interp = True
+# 補間の遅延を目標値の到着間隔の分布から決める
+# Falseの場合は0.1秒固定
+adaptive_delay = True
 n_windows = 10
 if filter_kind == "original":
     n_windows = 10
@@ -73,6 +105,13 @@ elif filter_kind == "target":
     n_windows = 100
 t_intv = T_INTV
 n_windows *= int(0.008 / t_intv)
+# filter_kind == "one_euro"のパラメータ
+# 静止時のカットオフ周波数 (Hz)
+one_euro_min_cutoff = 1.0
+# 速度 (deg/s) あたりのカットオフ周波数の増分 (Hz)
+one_euro_beta = 0.02
+# 速度の推定のカットオフ周波数 (Hz)
+one_euro_d_cutoff = 1.0
 reset_default_state = True
 default_joint = DEFAULT_JOINT
 min_joint_limit = MIN_JOINT_LIMIT
@@ -91,7 +130,28 @@ speed_tool_change = 2
 # 設定値は典型的なVRコントローラの動きから決定した
 target_state_abs_joint_diff_limit = [30, 30, 40, 40, 40, 60]
 
+# 状態値 (フィードバック、約30ms間隔)、目標値 (VR) がこの秒数より古ければ
+# 途切れたとして警告する
+state_stale_timeout = 0.2
+target_stale_timeout = 0.5
+
 save_control = SAVE
+# 制御の記録を共有メモリから読み出す間隔 (秒)
+archive_interval = 0.1
+
+# JerkShaperの移動平均の長さ
+# 加速度が正負の制限値の間で切り替わっても加加速度の制限を超えない長さとする
+n_jerk_windows = int(np.ceil(np.max(
+    2 * accel_limit_ratio * accel_limits
+    / (jerk_limit_ratio * jerk_limits)) / t_intv))
+
+# 処理時間の記録区間のインデックス
+(
+    P_WAKEUP, P_SNAPSHOT, P_WRAP_CLIP, P_INTERP, P_PRE_LIMITER,
+    P_FILTER, P_LIMITER, P_ARCHIVE_PUT, P_SERVO_J, P_SERVO_J_REPLY, P_CYCLE,
+    P_SEND_INTERVAL, P_TARGET_TO_SERVO_J, P_SERVO_J_TO_MOTION, P_TARGET_TO_MOTION,
+    P_MQTT_RTT, P_MQTT_ONE_WAY, P_MQTT_BROKER,
+) = range(len(LATENCY_PHASES))
 
 
 class Jaka_CON:
@@ -109,6 +169,7 @@ class Jaka_CON:
             self.robot = robot(
                 ip_move=ROBOT_IP,
                 logger=self.robot_logger,
+                use_pool=RC_POOL,
             )
             self.robot.start()
             self.robot.clear_error()
@@ -160,8 +221,8 @@ class Jaka_CON:
         state = correct_map[state_corrected]
         # 0に意味があるのでオフセットをもたせる
         state += 100
-        self.pose[12] = read_tool
-        self.pose[31] = state
+        self.pose["hand_state"] = read_tool
+        self.pose["hand_caught"] = state
 
     def find_and_setup_hand(self, tool_id):
         connected = False
@@ -177,7 +238,7 @@ class Jaka_CON:
         self.hand_name = name
         self.hand = hand
         self.tool_id = tool_id
-        self.pose[23] = tool_id
+        self.pose["tool_id"] = tool_id
         # if tool_id != -1:
         #     self.robot.SetToolDef(
         #         tool_info["id_in_robot"], tool_info["tool_def"])
@@ -212,16 +273,16 @@ class Jaka_CON:
             if stop_event.is_set():
                 break
             # 現在情報を取得しているかを確認
-            if self.pose[19] != 1:
+            if self.pose["state_received"] != 1:
                 time.sleep(t_intv_hand)
                 continue
             # 目標値を取得しているかを確認
-            if self.pose[20] != 1:
+            if self.pose["target_received"] != 1:
                 time.sleep(t_intv_hand)
                 continue
             # ツールの値を取得
             # 値0が意味を持つので共有メモリではオフセットをかけている
-            tool = int(self.pose[13])
+            tool = int(self.pose["hand_target"])
             if tool == 0:
                 time.sleep(t_intv_hand)
                 continue
@@ -263,13 +324,49 @@ class Jaka_CON:
             if t_wait > 0:
                 time.sleep(t_wait)
 
+    def make_control_step(self) -> ControlStep:
+        # 速度制限をフィルタの手前にも入れているのでそれに対応した方法のみ
+        assert filter_kind in ["original", "one_euro"]
+        cs = ControlStep(
+            filter_kind=filter_kind,
+            n_windows=n_windows,
+            speed_limits=speed_limit_ratio * speed_limits,
+            accel_limits=accel_limit_ratio * accel_limits,
+            jerk_limits=jerk_limit_ratio * jerk_limits,
+            stopped_velocity_eps=stopped_velocity_eps,
+            min_joint_limit=min_joint_soft_limit,
+            max_joint_limit=max_joint_soft_limit,
+            use_interp=use_interp,
+            adaptive_delay=adaptive_delay,
+            delay=0.1,
+            one_euro_params=dict(
+                min_cutoff=one_euro_min_cutoff,
+                beta=one_euro_beta,
+                d_cutoff=one_euro_d_cutoff,
+            ),
+            t_intv=t_intv,
+            n_jerk_windows=n_jerk_windows if use_jerk_limit else None,
+            joint_math=JOINT_MATH,
+        )
+        cs.attach(self.pose)
+        return cs
+
     def control_loop(self, f: TextIO | None = None) -> bool:
         """リアルタイム制御ループ"""
         self.last = 0
+        self.last_target_count = self.pose["target_count"]
         self.logger.info("Start Control Loop")
-        self.pose[19] = 0
-        self.pose[20] = 0
-        target_stop = None
+        self.pose["state_received"] = 0
+        self.pose["target_received"] = 0
+        # 1周期の計算の作業領域は制御を始める前に確保しておく
+        cs = self.make_control_step()
+        # 分析用データの記録の作業領域。1周期分をまとめて記録プロセスに渡す
+        records = np.zeros((3, RECORD_SIZE))
+        records[:, F_KIND] = [KIND_TARGET, KIND_TARGET_DELAYED, KIND_CONTROL]
+        extra_target_delayed = records[1, F_EXTRA:F_EXTRA + 1]
+        extra_control = records[2, F_EXTRA:F_EXTRA + 3]
+        joint_views = [records[i, F_JOINT] for i in range(3)]
+        n_dropped = 0
         stop_event = threading.Event()
         error_event = threading.Event()
         lock = threading.Lock()
@@ -285,8 +382,43 @@ class Jaka_CON:
         else:
             last_tool_corrected = None
 
+        # 制御周期はt_intvの格子上の締め切りで決める
+        # servo_jの応答待ち時間に周期を依存させない
+        scheduler = PeriodicScheduler(t_intv)
+        # 処理区間ごとの処理時間を共有メモリ上のヒストグラムに記録する
+        lh = self.latency
+        if move_robot and SERVO_PIPELINE:
+            # エラーは次のmove_joint_servoの例外で受ける
+            self.robot.start_servo_stream(
+                SERVO_MAX_IN_FLIGHT,
+                on_reply=lambda ec, ns: lh.record(P_SERVO_J_REPLY, ns))
+        # 状態値、目標値の書き込み時刻と書き込み回数による途切れと遅延の計測
+        state_watch = StaleWatch("state", state_stale_timeout, self.logger)
+        target_watch = StaleWatch("target", target_stale_timeout, self.logger)
+        motion_latency = MotionLatency()
+        last_state_count = 0
+        last_target_count = 0
+        # 前回の制御値の送信時刻 (time.monotonic_ns)
+        last_send_ns = 0
+        # 共有メモリの時刻 (time.monotonic_ns) を制御計算用の時刻
+        # (time.perf_counter) に換算するための差
+        perf_minus_monotonic = time.perf_counter() - time.monotonic()
+        # 状態値と目標値が届くまでは周期で起きずに通知を待つ
+        wait_notification = False
         while True:
+            # t: 制御計算用の時刻 (単調増加、締め切りの時刻)
+            # now: 記録用の時刻 (UNIX時間)
+            if wait_notification:
+                # ハンドのスレッドの終了も確認するため時間切れでも起きる
+                self.notifiers.control.wait(1)
+                # 届いたらすぐに周期を始める
+                t = scheduler.restart()
+                wait_notification = False
+            else:
+                t = scheduler.wait()
             now = time.time()
+            t_ns_start = time.perf_counter_ns()
+            lh.record(P_WAKEUP, int(scheduler.lateness * 1e9))
 
             # TODO: これがメインスレッドを遅くしている可能性ありだが
             # この1行だけでとも思う。要検証
@@ -298,44 +430,77 @@ class Jaka_CON:
             # targetの値がstateの値によらずにどんどん
             # 変化していく場合は、以下で待ちすぎると
             # 制御値のもとになる最初のtargetの値が
-            # stateから大きく離れるので、t_intv秒と短い時間だけ
-            # 待っている。もしもっと待つと最初に
+            # stateから大きく離れるので、受信の通知ですぐに
+            # 起きるようにしている。もしもっと待つと最初に
             # ガッとロボットが動いてしまう。実際のシステムでは
             # targetはstateに依存するのでまた別に考える
-            stop = self.pose[16]
+            stop = self.pose["stop_control"]
             if stop:
                 stop_event.set()
 
             # 現在情報を取得しているかを確認
-            if self.pose[19] != 1:
-                time.sleep(t_intv)
+            if self.pose["state_received"] != 1:
                 # self.logger.info("Wait for monitoring")
                 # 取得する前に終了する場合即時終了可能
                 if stop:
                     break
+                wait_notification = True
                 continue
 
             # 目標値を取得しているかを確認
-            if self.pose[20] != 1:
-                time.sleep(t_intv)
+            if self.pose["target_received"] != 1:
                 # self.logger.info("Wait for target")
                 # 取得する前に終了する場合即時終了可能
                 if stop:
                     break
+                wait_notification = True
                 continue
 
             # NOTE: 最初にVR側でロボットの状態値を取得できていれば追加してもよいかも
             # state = self.pose[:6].copy()
-            # target = self.pose[6:12].copy()
+            # target = self.pose["target"].copy()
             # if np.any(np.abs(state - target) > 0.01):
             #     continue
 
-            # 関節の状態値
-            state = self.pose[:6].copy()
+            # 関節の状態値と目標値
+            # 作業領域にコピーし、周期ごとの配列の確保を避ける
+            t_ns = time.perf_counter_ns()
+            read_ok = cs.snapshot()
+            # 目標値の受信カウンタが変わっていれば新しい目標値が届いている
+            target_count = self.pose["target_count"]
+            target_arrived = target_count != self.last_target_count
+            self.last_target_count = target_count
+            t_ns = lh.lap(P_SNAPSHOT, t_ns)
+            if self.last == 0 and not read_ok:
+                # 書き込み中だった値は書き込みが終わればすぐ読めるので短く読み直す
+                read_ok = cs.snapshot(spin=FIRST_READ_SPIN)
+            if self.last == 0 and not read_ok:
+                # 状態値と目標値が一度読めるまでは制御を始めない
+                # (作業領域の0を基準にしてしまう)。書き込みの通知は読めなかった
+                # 書き込みの分はもう来ない (例外で拒否された書き込みは通知しない)
+                # ので、通知は待たずに次の周期で読み直す
+                if stop:
+                    break
+                continue
 
-            # 目標値
-            target = self.pose[6:12].copy()
-            target_raw = target
+            # 書き込み時刻で途切れを、書き込み回数で新しい値かを判断する
+            now_ns = time.monotonic_ns()
+            seqlocks = cs.seqlocks
+            state_watch.update(now_ns, seqlocks.state.time_ns)
+            target_watch.update(now_ns, seqlocks.target.time_ns)
+            if seqlocks.target.count != last_target_count:
+                last_target_count = seqlocks.target.count
+                motion_latency.on_target(
+                    cs.target_raw, seqlocks.target.time_ns, cs.state)
+            if seqlocks.state.count != last_state_count:
+                last_state_count = seqlocks.state.count
+                latencies = motion_latency.on_state(
+                    cs.state, seqlocks.state.time_ns, now_ns)
+                if latencies is not None:
+                    ns_to_send, ns_to_motion = latencies
+                    lh.record(P_TARGET_TO_SERVO_J, ns_to_send)
+                    lh.record(P_SERVO_J_TO_MOTION, ns_to_motion)
+                    lh.record(P_TARGET_TO_MOTION, ns_to_send + ns_to_motion)
 
             # 目標値の角度が360度の不定性が許される場合 (1度と-359度を区別しない場合) でも
             # 実機の関節の角度は360度の不定性が許されないので
@@ -345,19 +510,16 @@ class Jaka_CON:
             # ないずれが生じ、急に実機が動く可能性があるので、VR側で
             # 実機との比較をし、実機側で制限値を超えることがないようにする必要がある
             # とりあえず急に動こうとすれば止まる仕組みは入れている
-            target = state + (target - state + 180) % 360 - 180
-
             # TODO: VR側でもソフトリミットを設定したほうが良い
-            target_th = np.maximum(target, min_joint_soft_limit)
-            if (target != target_th).any():
+            hit_min, hit_max = cs.wrap_clip()
+            if hit_min:
                 self.logger.warning("target reached minimum threshold")
-            target_th = np.minimum(target_th, max_joint_soft_limit)
-            if (target != target_th).any():
+            if hit_max:
                 self.logger.warning("target reached maximum threshold")
-            target = target_th
+            t_ns = lh.lap(P_WRAP_CLIP, t_ns)
 
             # 目標値が状態値から大きく離れた場合は制御を停止する
-#            if (np.abs(target - state) > 
+#            if (np.abs(cs.target - cs.state) > 
 #                target_state_abs_joint_diff_limit).any():
 #                stop = 1
 #                code_stop = 1
@@ -368,43 +530,11 @@ class Jaka_CON:
                 # 制御する前に終了する場合即時終了可能
                 if stop:
                     break
-                self.last = now
-
-                # 目標値を遅延を許して極力線形補間するためのセットアップ
-                if use_interp:
-                    di = DelayedInterpolator(delay=0.1)
-                    di.reset(now, target)
-                    target_delayed = di.read(now, target)
-                else:
-                    target_delayed = target
-                self.last_target_delayed = target_delayed
-                
+                self.last = t
+                last_send_ns = 0
+                # 目標値を遅延を許して極力線形補間するためのセットアップと
                 # 移動平均フィルタのセットアップ（t_intv秒間隔）
-                if filter_kind == "original":
-                    self.last_control = state
-                    _filter = SMAFilter(n_windows=n_windows)
-                    _filter.reset(state)
-                elif filter_kind == "target":
-                    _filter = SMAFilter(n_windows=n_windows)
-                    _filter.reset(target)
-                elif filter_kind == "state_and_target_diff":
-                    self.last_control = state
-                    _filter = SMAFilter(n_windows=n_windows)
-                    _filter.reset(state)
-                elif filter_kind == "moveit_servo_humble":
-                    _filter = SMAFilter(n_windows=n_windows)
-                    _filter.reset(state)
-                elif filter_kind == "control_and_target_diff":
-                    self.last_control = state
-                    _filter = SMAFilter(n_windows=n_windows)
-                    _filter.reset(state)
-
-                # 速度制限をフィルタの手前にも入れてみる
-                if True:
-                    assert filter_kind == "original"
-                    self.last_target_delayed_velocity = np.zeros(6)
-
-                self.last_control_velocity = np.zeros(6)
+                cs.setup(t)
                 continue
 
             # 制御値を送り済みの場合は
@@ -412,180 +542,71 @@ class Jaka_CON:
             # 厳密にはここに初めて到達した場合は制御値は送っていないが
             # 簡潔さのため同じように扱う
             if stop:
-                if target_stop is None:
-                    target_stop = state
-                target = target_stop
+                cs.hold()
+
+            # 速度・加速度制限と平滑化には締め切りの間隔 (周期の整数倍) を使う。
+            # 目標値も締め切りの時刻で補間するので、起床の揺らぎを
+            # 比率やフィルタに持ち込まないように実際の送信間隔は記録だけにする
+            dt = t - self.last
+            if last_send_ns != 0:
+                lh.record(P_SEND_INTERVAL, now_ns - last_send_ns)
 
             # target_delayedは、delay秒前の目標値を前後の値を
             # 使って線形補間したもの
-            if use_interp:
-                target_delayed = di.read(now, target)
-            else:
-                target_delayed = target
+            # 目標値は共有メモリに書かれた時刻 (送信時刻があれば送信時刻) で補間する
+            t_ns = time.perf_counter_ns()
+            t_target = None
+            if target_arrived and not stop:
+                t_target = seqlocks.target.time_ns / 1e9 + perf_minus_monotonic
+            cs.interpolate(t, target_arrived, t_target)
+            t_ns = lh.lap(P_INTERP, t_ns)
 
             # 速度制限をフィルタの手前にも入れてみる
-            if True:
-                assert filter_kind == "original"
-                target_diff = target_delayed - self.last_target_delayed
-                # 速度制限
-                dt = now - self.last
-                v = target_diff / dt
-                ratio = np.abs(v) / (speed_limit_ratio * speed_limits)
-                max_ratio = np.max(ratio)
-                if max_ratio > 1:
-                    v /= max_ratio
-                target_diff_speed_limited = v * dt
-
-                # 加速度制限
-                a = (v - self.last_target_delayed_velocity) / dt
-                accel_ratio = np.abs(a) / (accel_limit_ratio * accel_limits)
-                accel_max_ratio = np.max(accel_ratio)
-                if accel_max_ratio > 1:
-                    a /= accel_max_ratio
-                v = self.last_target_delayed_velocity + a * dt
-                target_diff_speed_limited = v * dt
-
-                # 速度がしきい値より小さければ静止させ無駄なドリフトを避ける
-                # NOTE: スレーブモードを落とさないためには前の速度が十分小さいとき (しきい値は不明) 
-                # にしか静止させてはいけない
-                if np.all(target_diff_speed_limited / dt < stopped_velocity_eps):
-                    target_diff_speed_limited = np.zeros_like(
-                        target_diff_speed_limited)
-                    v = target_diff_speed_limited / dt
-
-                self.last_target_delayed_velocity = v
-                target_delayed = self.last_target_delayed + target_diff_speed_limited
-
-            self.last_target_delayed = target_delayed
+            cs.pre_limit(dt)
+            t_ns = lh.lap(P_PRE_LIMITER, t_ns)
 
             # 平滑化
-            if filter_kind == "original":
-                # 成功している方法
-                # 速度制限済みの制御値で平滑化をしており、
-                # moveit servoなどでは見られない処理
-                target_filtered = _filter.predict_only(target_delayed)
-                target_diff = target_filtered - self.last_control
-            elif filter_kind == "target":
-                # 成功することもあるが平滑化窓を増やす必要あり
-                # 状態値を無視した目標値の値をロボットに送る
-                last_target_filtered = _filter.previous_filtered_measurement
-                target_filtered = _filter.filter(target_delayed)
-                target_diff = target_filtered - last_target_filtered
-            elif filter_kind == "state_and_target_diff":
-                # 失敗する
-                # 状態値に目標値の差分を足したものを平滑化する
-                # moveit servo (少なくともhumble版)ではこのようにしているが、
-                # 速度がどんどん大きくなっていって（正のフィードバック）
-                # 制限に引っかかる
-                # stateを含む移動平均を取ると、stateが速度を持つと
-                # その速度を保持し続けようとするので、そこに差分を足すと
-                # どんどん加速していくのでは。
-                # 遅延があることも影響しているかも。
-                # NOTE(20250813): targetがstateのフィードバックを受けていない場合は
-                # target_alignedは、stateとtargetが乖離するので不適切
-                target_diff = target_delayed - self.last_target_delayed
-                target_aligned = state + target_diff
-                last_target_filtered = _filter.previous_filtered_measurement
-                target_filtered = _filter.filter(target_aligned)
-                target_diff = target_filtered - last_target_filtered
-            elif filter_kind == "moveit_servo_humble":
-                # 失敗する
-                # 停止はしないがかなりゆっくり動き、目標軌跡も追従しなくなる
-                # v = (target_filtered - state) / t_intv
-                # target_filteredとstateの差は、
-                # - 制御値を送ってからその値にstateがなるまで0.1s程度の遅延があること
-                # - テストなどであらかじめ決まっているtargetを逐次送り、
-                #   targetの速度がロボットの速度制限より大きいとき、
-                #   targetがstateからどんどん離れていくこと
-                # などの理由からt_intv秒で移動できる距離以上になってしまうため
-                target_diff = target_delayed - self.last_target_delayed
-                target_aligned = state + target_diff
-                last_target_filtered = _filter.previous_filtered_measurement
-                target_filtered = _filter.filter(target_aligned)
-                target_diff = target_filtered - state
-            elif filter_kind == "control_and_target_diff":
-                # 失敗する
-                # 速度制限にひっかかり途中停止する
-                # 制御値に目標値の差分を足したものを平滑化する
-                # 上記と同様に正のフィードバック的になっている
-                # moveit_servo_mainの処理に近い
-                target_diff = target_delayed - self.last_target_delayed
-                target_aligned = self.last_control + target_diff
-                last_target_filtered = _filter.previous_filtered_measurement
-                target_filtered = _filter.filter(target_aligned)
-                target_diff = target_filtered - last_target_filtered
-            else:
-                raise ValueError
-
-            # 速度制限
-            dt = now - self.last
-            v = target_diff / dt
-            ratio = np.abs(v) / (speed_limit_ratio * speed_limits)
-            max_ratio = np.max(ratio)
-            if max_ratio > 1:
-                v /= max_ratio
-            target_diff_speed_limited = v * dt
-
-            # 加速度制限
-            a = (v - self.last_control_velocity) / dt
-            accel_ratio = np.abs(a) / (accel_limit_ratio * accel_limits)
-            accel_max_ratio = np.max(accel_ratio)
-            if accel_max_ratio > 1:
-                a /= accel_max_ratio
-            v = self.last_control_velocity + a * dt
-            target_diff_speed_limited = v * dt
-
-            # 速度がしきい値より小さければ静止させ無駄なドリフトを避ける
-            # NOTE: スレーブモードを落とさないためには前の速度が十分小さいとき (しきい値は不明) 
-            # にしか静止させてはいけない
-            if np.all(target_diff_speed_limited / dt < stopped_velocity_eps):
-                target_diff_speed_limited = np.zeros_like(
-                    target_diff_speed_limited)
-                v = target_diff_speed_limited / dt
-
-            self.last_control_velocity = v
-
-            # 平滑化の種類による対応
-            if filter_kind == "original":
-                control = self.last_control + target_diff_speed_limited
-                # 登録するだけ
-                _filter.filter(control)
-            elif filter_kind == "target":
-                control = last_target_filtered + target_diff_speed_limited
-            elif filter_kind == "state_and_target_diff":
-                control = last_target_filtered + target_diff_speed_limited
-            elif filter_kind == "moveit_servo_humble":
-                control = state + target_diff_speed_limited
-            elif filter_kind == "control_and_target_diff":
-                control = last_target_filtered + target_diff_speed_limited
-            else:
-                raise ValueError
-            
-            self.pose[24:30] = control
+            cs.smooth(dt)
+            # originalでは制御値の登録分を後で足してから記録する
+            t_ns_filter = time.perf_counter_ns()
+            ns_filter = t_ns_filter - t_ns
+            t_ns = t_ns_filter
+
+            # 速度・加速度制限
+            cs.limit(dt)
+            t_ns = lh.lap(P_LIMITER, t_ns)
+
+            # 平滑化の種類による対応 (originalではフィルタへの登録)
+            # 制御値には送信の時刻として直前の時刻を書き込む
+            send_ns = time.monotonic_ns()
+            cs.apply(send_ns)
+            self.history.control.append(send_ns, cs.control)
+            t_ns_filter = time.perf_counter_ns()
+            ns_filter += t_ns_filter - t_ns
+            t_ns = t_ns_filter
+            lh.record(P_FILTER, ns_filter)
+
+            # ロボットに送る差分
+            # 加加速度を整形する場合、制御値 (control) はフィードバック用に
+            # 整形前の値のままとし、ロボットには移動平均で遅らせた差分を送る
+            # 記録する加加速度の比率は送る差分のもの
+            command_diff = cs.command_diff()
 
             # 分析用データ保存
-            datum = [
-                dict(
-                    time=now,
-                    kind="target",
-                    joint=target_raw.tolist(),
-                ),
-                dict(
-                    time=now,
-                    kind="target_delayed",
-                    joint=target_delayed.tolist(),
-                ),
-                dict(
-                    time=now,
-                    kind="control",
-                    joint=control.tolist(),
-                    max_ratio=max_ratio,
-                    accel_max_ratio=accel_max_ratio,
-                ),
-            ]
-            self.control_to_archiver_queue.put(datum)
-
-            t_elapsed = time.time() - now
+            # 記録プロセスが追いつかず溢れた場合は捨てて制御を優先する
+            records[:, F_TIME] = now
+            np.copyto(joint_views[0], cs.target_raw)
+            np.copyto(joint_views[1], cs.target_delayed)
+            np.copyto(joint_views[2], cs.control)
+            extra_target_delayed[0] = cs.di.delay if use_interp else 0.0
+            extra_control[0] = cs.limiter.max_ratio
+            extra_control[1] = cs.limiter.accel_max_ratio
+            extra_control[2] = cs.jerk_meter.jerk_max_ratio
+            if not self.records.push(records):
+                n_dropped += 1
+            lh.lap(P_ARCHIVE_PUT, t_ns)
+
+            t_elapsed = time.perf_counter() - t
             if t_elapsed > t_intv * 2:
                 self.logger.warning(
                     f"Control loop is more than 2 times as slow as expected before command: "
@@ -593,7 +614,10 @@ class Jaka_CON:
 
             if move_robot:
                 try:
-                    self.robot.move_joint_servo(target_diff_speed_limited.tolist())
+                    t_ns = time.perf_counter_ns()
+                    self.robot.move_joint_servo(command_diff.tolist())
+                    lh.lap(P_SERVO_J, t_ns)
+                    motion_latency.on_send(command_diff, send_ns)
                 except Exception as e:
                     # JAKAでは無視できるエラーがあるか現状不明なためすべて上位に任せる
                     with lock:
@@ -605,7 +629,7 @@ class Jaka_CON:
                     break
 
                 if not use_hand_thread:
-                    tool = self.pose[13]
+                    tool = self.pose["hand_target"]
                     if tool != 0:
                         tool -= 100
                         tool_corrected = (tool - (-1)) / (89 - (-1)) * (1000 - 0)
@@ -617,27 +641,56 @@ class Jaka_CON:
                             th.start()
                             last_tool_corrected = tool_corrected
 
-            t_elapsed = time.time() - now
-            t_wait = t_intv - t_elapsed
-            if t_wait > 0:
-                if not move_robot:
-                    time.sleep(t_wait)
-            
-            t_elapsed = time.time() - now
+            t_elapsed = time.perf_counter() - t
             if t_elapsed > t_intv * 2:
                 self.logger.warning(
                     f"Control loop is more than 2 times as slow as expected after command: "
                     f"{t_elapsed} seconds")
+            lh.lap(P_CYCLE, t_ns_start)
 
             if stop:
                 # スレーブモードでは十分低速時に2回同じ位置のコマンドを送ると
                 # ロボットを停止させてスレーブモードを解除可能な状態になる
-                if (control == self.last_control).all():
+                # 整形する場合は整形前の差分を送り切ってから止める
+                if cs.control_unchanged():
                     break
                 
-            self.last_control = control
-            self.last = now
-        
+            cs.commit()
+            self.last = t
+            last_send_ns = send_ns
+
+        if use_interp and adaptive_delay and self.last != 0:
+            di = cs.di
+            self.logger.info(
+                f"Interpolation delay: {di.delay:.3f} seconds "
+                f"(target {di.target_delay:.3f} seconds, "
+                f"{di.n_arrivals} arrivals, "
+                f"extrapolated {di.n_extrapolated} cycles)")
+        for watch in [state_watch, target_watch]:
+            if watch.n_stale > 0:
+                self.logger.warning(
+                    f"No new {watch.name} for longer than "
+                    f"{watch.timeout_ns / 1e9:.3f} seconds {watch.n_stale} "
+                    f"times (longest gap {watch.max_gap_ns / 1e9:.3f} "
+                    f"seconds)")
+        for name in ["state", "target"]:
+            seqlock = getattr(cs.seqlocks, name)
+            if seqlock.n_failures > 0:
+                self.logger.warning(
+                    f"Could not read a consistent {name} "
+                    f"{seqlock.n_failures} times "
+                    f"(retried {seqlock.n_retries} times)")
+        if n_dropped > 0:
+            self.logger.warning(
+                f"Dropped control records of {n_dropped} cycles "
+                f"because the control archiver fell behind")
+        stats = scheduler.stats()
+        if stats["overruns"] > 0:
+            self.logger.warning(
+                f"Control loop overran {stats['overruns']} times "
+                f"(skipped {stats['skipped']} cycles, "
+                f"max lateness {stats['max_lateness']:.6f} seconds) "
+                f"in {stats['cycles']} cycles")
         # hand_thread.join()
         if error_event.is_set():
             # TODO: これで例外発生元のスタックトレースが取得できればこれで十分
@@ -722,17 +775,17 @@ class Jaka_CON:
             self.logger.error(f"{self.robot.format_error(e)}")
 
     def enter_servo_mode(self):
-        # self.pose[14]は0のとき必ず通常モード。
-        # self.pose[14]は1のとき基本的にスレーブモードだが、
+        # self.pose["slave_mode"]は0のとき必ず通常モード。
+        # self.pose["slave_mode"]は1のとき基本的にスレーブモードだが、
         # 変化前後の短い時間は通常モードの可能性がある。
         # 順番固定
         with self.slave_mode_lock:
-            self.pose[14] = 1
+            self.pose["slave_mode"] = 1
         self.robot.enter_servo_mode()
 
     def leave_servo_mode(self):
-        # self.pose[14]は0のとき必ず通常モード。
-        # self.pose[14]は1のとき基本的にスレーブモードだが、
+        # self.pose["slave_mode"]は0のとき必ず通常モード。
+        # self.pose["slave_mode"]は1のとき基本的にスレーブモードだが、
         # 変化前後の短い時間は通常モードの可能性がある。
         # 順番固定
         self.robot.leave_servo_mode()
@@ -740,7 +793,7 @@ class Jaka_CON:
             if not self.robot.is_in_servomove():
                 break
             time.sleep(0.008)
-        self.pose[14] = 0
+        self.pose["slave_mode"] = 0
 
     def control_loop_w_recover_automatic(self) -> bool:
         """自動復帰を含むリアルタイム制御ループ"""
@@ -754,8 +807,8 @@ class Jaka_CON:
                 self.control_loop()
                 self.leave_servo_mode()
                 # ここまで正常に終了した場合、ユーザーが要求した場合が成功を意味する
-                if self.pose[16] == 1:
-                    self.pose[16] = 0
+                if self.pose["stop_control"] == 1:
+                    self.pose["stop_control"] = 0
                     self.logger.info("User required stop and succeeded")
                     return True
             except Exception as e:
@@ -796,7 +849,7 @@ class Jaka_CON:
                                 self.logger.error(
                                     "Failed to reconnect robot after"
                                     " 10 attempts")
-                                self.pose[16] = 0
+                                self.pose["stop_control"] = 0
                                 return False
                         time.sleep(1)
 
@@ -805,7 +858,7 @@ class Jaka_CON:
                     # NOTE: Jakaでは、どのエラーが自動復帰可能かの分類が
                     # ドキュメント、実験ともに不足していて現状よくわからないので、
                     # 緊急停止状態の場合のみ自動復帰せず、それ以外は自動復帰を試みる
-                    is_emergency_stop = int(self.pose[30])
+                    is_emergency_stop = int(self.pose["emergency_stop"])
                     if not is_emergency_stop:
                         # 自動復帰を試行。失敗またはエラーの場合は通常モードに戻る。
                         # エラー直後の自動復帰処理に失敗しても、
@@ -820,26 +873,26 @@ class Jaka_CON:
                     else:
                         self.logger.error(
                             "Error is not automatically recoverable")
-                        self.pose[16] = 0
+                        self.pose["stop_control"] = 0
                         return False
                 except Exception as e_recover:
                     self.logger.error("Error during automatic recover")
                     self.logger.error(f"{self.robot.format_error(e_recover)}")
-                    self.pose[16] = 0
+                    self.pose["stop_control"] = 0
                     return False
 
 
     def mqtt_control_loop(self) -> None:
         """MQTTによる制御ループ"""
         self.logger.info("Start MQTT Control Loop")
-        self.pose[15] = 1
+        self.pose["mqtt_control"] = 1
         while True:
             # 停止するのは、ユーザーが要求した場合か、自然に内部エラーが発生した場合
             success_stop = self.control_loop_w_recover_automatic()
             # 停止フラグが成功の場合は、ユーザーが要求した場合のみありうる
-            next_tool_id = self.pose[17].copy()
-            put_down_box = self.pose[21].copy()
-            change_log_file = self.pose[33].copy()
+            next_tool_id = self.pose["tool_change"].copy()
+            put_down_box = self.pose["put_down_box"].copy()
+            change_log_file = self.pose["change_log_control"].copy()
             if success_stop:
                 # ツールチェンジが要求された場合
                 if next_tool_id != 0:
@@ -852,16 +905,16 @@ class Jaka_CON:
                         # NOTE: より良い方法がないか
                         # VRアニメーションがロボットの動きに追従し終わるのを待つ
                         time.sleep(3)
-                        self.pose[18] = 1
-                        self.pose[17] = 0
+                        self.pose["tool_change_status"] = 1
+                        self.pose["tool_change"] = 0
                         # VRのIKで解いた関節角度にロボットの関節角度を合わせるのを待つ
                         time.sleep(3)
                         self.logger.info("Tool change succeeded")
                     except Exception as e:
                         self.logger.error("Error during tool change")
                         self.logger.error(f"{self.robot.format_error(e)}")
-                        self.pose[18] = 2
-                        self.pose[17] = 0
+                        self.pose["tool_change_status"] = 2
+                        self.pose["tool_change"] = 0
                         break
                 # 棚の上の箱を置くことが要求された場合
                 elif put_down_box != 0:
@@ -883,19 +936,20 @@ class Jaka_CON:
                 # ツールチェンジが要求された場合
                 if next_tool_id != 0:
                     # 要求コマンドのみリセット
-                    self.pose[18] = 2
-                    self.pose[17] = 0
+                    self.pose["tool_change_status"] = 2
+                    self.pose["tool_change"] = 0
                 # 棚の上の箱を置くことが要求された場合
                 elif put_down_box != 0:
                     # 要求コマンドのみリセット
-                    self.pose[22] = 2
-                    self.pose[21] = 0
+                    self.pose["put_down_box_status"] = 2
+                    self.pose["put_down_box"] = 0
                 # ループを抜ける
                 elif change_log_file != 0:
                     # 要求コマンドのみリセット
-                    self.pose[33] = 0
+                    self.pose["change_log_control"] = 0
+                    self.notifiers.main.notify()
                 break
-        self.pose[15] = 0
+        self.pose["mqtt_control"] = 0
 
     def get_tool_info(
         self, tool_infos: List[Dict[str, Any]], tool_id: int) -> Dict[str, Any]:
@@ -945,7 +999,7 @@ class Jaka_CON:
         #     self.hand_name = name
         #     self.hand = hand
         #     self.tool_id = next_tool_id
-        #     self.pose[23] = next_tool_id
+        #     self.pose["tool_id"] = next_tool_id
         #     self.robot.ext_speed(speed_normal)
         #     self.robot.move_pose(wps["exit_path_1"])
         #     self.robot.move_pose(wps["exit_path_2"])
@@ -979,7 +1033,7 @@ class Jaka_CON:
         #         self.hand_name = name
         #         self.hand = hand
         #         self.tool_id = next_tool_id
-        #         self.pose[23] = next_tool_id
+        #         self.pose["tool_id"] = next_tool_id
         #         self.robot.ext_speed(speed_normal)
         #     elif tool_info["holder_region"] != next_tool_info["holder_region"]:
         #         self.robot.ext_speed(speed_normal)
@@ -1001,7 +1055,7 @@ class Jaka_CON:
         #         self.hand_name = name
         #         self.hand = hand
         #         self.tool_id = next_tool_id
-        #         self.pose[23] = next_tool_id
+        #         self.pose["tool_id"] = next_tool_id
         #         self.robot.ext_speed(speed_normal)
         #     self.robot.move_pose(wps["exit_path_1"])
         #     self.robot.move_pose(wps["exit_path_2"])
@@ -1038,17 +1092,17 @@ class Jaka_CON:
 
     def tool_change_not_in_rt(self) -> None:
         while True:
-            next_tool_id = self.pose[17]
+            next_tool_id = self.pose["tool_change"]
             if next_tool_id != 0:
                 try:
                     self.tool_change(next_tool_id)
-                    self.pose[18] = 1
+                    self.pose["tool_change_status"] = 1
                 except Exception as e:
                     self.logger.error("Error during tool change")
                     self.logger.error(f"{self.robot.format_error(e)}")
-                    self.pose[18] = 2
+                    self.pose["tool_change_status"] = 2
                 finally:
-                    self.pose[17] = 0
+                    self.pose["tool_change"] = 0
                     break
 
     def jog_joint(self, joint: int, direction: float) -> None:
@@ -1202,15 +1256,15 @@ class Jaka_CON:
         #     # NOTE: より良い方法がないか
         #     # VRアニメーションがロボットの動きに追従し終わるのを待つ
         #     time.sleep(3)
-        #     self.pose[22] = 1
+        #     self.pose["put_down_box_status"] = 1
         #     # VRのIKで解いた関節角度にロボットの関節角度を合わせるのを待つ
         #     time.sleep(3)
         # except Exception as e:
         #     self.logger.error("Error during demo put down box")
         #     self.logger.error(f"{self.robot.format_error(e)}")
-        #     self.pose[22] = 2
+        #     self.pose["put_down_box_status"] = 2
         # finally:
-        #     self.pose[21] = 0
+        #     self.pose["put_down_box"] = 0
 
     def setup_logger(self, log_queue):
         self.logger = logging.getLogger("CTRL")
@@ -1239,23 +1293,29 @@ class Jaka_CON:
 
     def change_log_file(self, logging_dir: str) -> None:
         self.logging_dir = logging_dir
-        self.pose[33] = 0
+        self.pose["change_log_control"] = 0
+        self.notifiers.main.notify()
 
-    def run_proc(self, control_pipe, slave_mode_lock, log_queue, logging_dir, control_to_archiver_queue):
+    def run_proc(self, control_pipe, slave_mode_lock, log_queue, logging_dir, notifiers: Notifiers):
         self.setup_logger(log_queue)
         self.logger.info("Process started")
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
+        self.sm, self.pose = attach_shm()
+        self.notifiers = notifiers
+        self.latency = LatencyHistograms()
+        self.records = RecordRing()
+        self.history = Histories()
         self.slave_mode_lock = slave_mode_lock
  
         self.control_pipe = control_pipe
         self.logging_dir = logging_dir
-        self.control_to_archiver_queue = control_to_archiver_queue 
 
         self.init_robot()
         self.init_realtime()
         while True:
-            if control_pipe.poll(timeout=1):
+            # コマンドか終了の通知を待つ
+            mp.connection.wait([control_pipe, self.notifiers.control], timeout=1)
+            self.notifiers.control.clear()
+            if control_pipe.poll():
                 command = control_pipe.recv()
                 if command["command"] == "enable":
                     self.enable()
@@ -1289,9 +1349,11 @@ class Jaka_CON:
                 else:
                     self.logger.warning(
                         f"Unknown command: {command['command']}")
-            if self.pose[32] == 1:
+            if self.pose["exit"] == 1:
                 self.sm.close()
-                self.control_to_archiver_queue.close()
+                self.latency.close()
+                self.records.close()
+                self.history.close()
                 time.sleep(1)
                 self.logger.info("Process stopped")
                 self.handler.close()
@@ -1300,25 +1362,39 @@ class Jaka_CON:
 
 
 class JAKA_CON_Archiver:
+    def drain_records(self, f: TextIO | None = None) -> None:
+        """溜まっている制御の記録をまとめて読み出してファイルに書く"""
+        while True:
+            n = self.records.drain(self.record_buffer)
+            if n == 0:
+                break
+            if f is not None:
+                s = ""
+                for record in self.record_buffer[:n]:
+                    s = s + json.dumps(
+                        record_to_dict(record), ensure_ascii=False) + "\n"
+                f.write(s)
+        overflows = self.records.overflows
+        if overflows != self.last_overflows:
+            self.logger.warning(
+                f"Control record ring overflowed: "
+                f"{overflows - self.last_overflows} records dropped "
+                f"({overflows} in total)")
+            self.last_overflows = overflows
+
     def monitor_start(self, f: TextIO | None = None):
         while True:
             # ログファイル変更時
-            if self.pose[35] == 1:
+            if self.pose["change_log_archiver"] == 1:
                 return True
-            try:
-                datum = self.control_to_archiver_queue.get(
-                    block=True, timeout=T_INTV)
-            except queue.Empty:
-                datum = None
-            if ((f is not None) and 
-                (datum is not None)):
-                s = ""
-                for d in datum:
-                    s = s + json.dumps(d, ensure_ascii=False) + "\n"
-                f.write(s)
-            # プロセス終了時
-            if self.pose[32] == 1:
+            self.drain_records(f)
+            # プロセス終了時は残りを書いてから終わる
+            if self.pose["exit"] == 1:
+                self.drain_records(f)
                 return False
+            # 制御プロセスは待たずに書き込むのでまとめて読み出す
+            # ログファイルの変更と終了の通知があればすぐに起きる
+            self.notifiers.archiver.wait(archive_interval)
 
     def setup_logger(self, log_queue):
         self.logger = logging.getLogger("CTRL-ARCV")
@@ -1337,16 +1413,18 @@ class JAKA_CON_Archiver:
 
     def change_log_file(self, logging_dir: str) -> None:
         self.logging_dir = logging_dir
-        self.pose[35] = 0
+        self.pose["change_log_archiver"] = 0
 
-    def run_proc(self, control_arcv_pipe, log_queue, logging_dir, control_to_archiver_queue):
+    def run_proc(self, control_arcv_pipe, log_queue, logging_dir, notifiers: Notifiers):
         self.setup_logger(log_queue)
         self.logger.info("Process started")
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
+        self.sm, self.pose = attach_shm()
+        self.notifiers = notifiers
         self.control_arcv_pipe = control_arcv_pipe
         self.logging_dir = logging_dir
-        self.control_to_archiver_queue = control_to_archiver_queue
+        self.records = RecordRing()
+        self.record_buffer = np.zeros((self.records.capacity, RECORD_SIZE))
+        self.last_overflows = self.records.overflows
 
         while True:
             try:
@@ -1367,9 +1445,9 @@ class JAKA_CON_Archiver:
                 self.logger.error("Error in control archiver")
                 self.logger.error(e)
             # プロセス終了時は大きいループを抜ける
-            if self.pose[32] == 1:
+            if self.pose["exit"] == 1:
                 self.sm.close()
-                self.control_to_archiver_queue.close()
+                self.records.close()
                 time.sleep(1)
                 self.logger.info("Process stopped")
                 self.handler.close()
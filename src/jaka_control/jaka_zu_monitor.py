@@ -18,8 +18,14 @@ import numpy as np
 
 from dotenv import load_dotenv
 
-from .config import SHM_NAME, SHM_SIZE, T_INTV
+from .config import T_INTV
 from .jaka_robot import JakaRobotFeedback
+from .latency import LatencyHistograms
+from .notify import Notifiers
+from .seqlock import PoseSeqLocks
+from .shm import attach_shm
+from .history import Histories
+from .snapshot import Snapshots
 # from .jaka_robot_mock import MockJakaRobotFeedback
 from .tools import tool_infos, tool_classes
 
@@ -124,14 +130,21 @@ class Jaka_MON:
         return [tool_info for tool_info in tool_infos
                 if tool_info["id"] == tool_id][0]
 
-    def monitor_start(self, f: TextIO | None = None):
+    def monitor_start(
+        self, f: TextIO | None = None, e2e_f: TextIO | None = None):
+        """
+        f: 状態値を記録するファイル (state.jsonl)
+        e2e_f: ゴーグルとの遅延を記録するファイル (e2e.jsonl)。
+        state.jsonlの行は関節角度と姿勢を持つ前提で読まれるので分ける
+        """
         last = 0
         last_error_monitored = 0
+        last_state_time_ns = 0
         is_in_tool_change = False
         is_put_down_box = False
         while True:
             # ログファイル変更時
-            if self.pose[34] == 1:
+            if self.pose["change_log_monitor"] == 1:
                 return True
 
             now = time.time()
@@ -143,7 +156,7 @@ class Jaka_MON:
             actual_joint_js = {}
 
             # ツール番号
-            tool_id = int(self.pose[23].copy())
+            tool_id = int(self.pose["tool_id"].copy())
             # 起動時（共有メモリが初期化されている）のみ初期値を使用
             if tool_id == 0:
                 tool_id = self.tool_id
@@ -153,7 +166,7 @@ class Jaka_MON:
 
             # ツールチェンジ
             status_tool_change = None
-            next_tool_id = int(self.pose[17].copy())
+            next_tool_id = int(self.pose["tool_change"].copy())
             if next_tool_id != 0:
                 if not is_in_tool_change:
                     is_in_tool_change = True
@@ -161,7 +174,7 @@ class Jaka_MON:
             else:
                 if is_in_tool_change:
                     is_in_tool_change = False
-                    status_tool_change = bool(self.pose[18] == 1)
+                    status_tool_change = bool(self.pose["tool_change_status"] == 1)
                     self.logger.info("Tool change finished")
             if status_tool_change is not None:
                 self.logger.info(f"Tool change status: {status_tool_change}")
@@ -181,14 +194,14 @@ class Jaka_MON:
 
             # 棚の上の箱を作業台に置くデモ
             status_put_down_box = None
-            put_down_box = self.pose[21].copy()
+            put_down_box = self.pose["put_down_box"].copy()
             if put_down_box != 0:
                 if not is_put_down_box:
                     is_put_down_box = True
             else:
                 if is_put_down_box:
                     is_put_down_box = False
-                    status_put_down_box = bool(self.pose[22] == 1)
+                    status_put_down_box = bool(self.pose["put_down_box_status"] == 1)
             # 終了した場合のみキーを追加
             if status_put_down_box is not None:
                 actual_joint_js["put_down_box"] = status_put_down_box
@@ -203,7 +216,8 @@ class Jaka_MON:
                 actual_tcp_pose = None
             # 関節
             try:
-                actual_joint = self.robot.get_current_joint_feed()
+                actual_joint, state_time_ns = \
+                    self.robot.get_current_joint_feed_stamped()
             except Exception as e:
                 self.logger.error("Error in get_current_joint: ")
                 self.logger.error(f"{self.robot.format_error(e)}")
@@ -214,7 +228,8 @@ class Jaka_MON:
                     joints = ['j1','j2','j3','j4','j5','j6']
                     actual_joint_js.update({
                         k: v for k, v in zip(joints, actual_joint)})
-                elif MQTT_FORMAT == 'Jaka-Control-IK':
+                elif MQTT_FORMAT in ['Jaka-Control-IK', 'Jaka-Control-Binary']:
+                    # Jaka-Control-Binaryでも状態値はJaka-Control-IKと同じJSONで送る
                     # 7要素送る必要があるのでダミーの[0]を追加
                     actual_joint_js.update({"joints": list(actual_joint) + [0]})
                 else:
@@ -266,17 +281,17 @@ class Jaka_MON:
                         width = None
                         force = None
                     elif self.hand_name == "dhrobotics_ag95":
-                        width = self.pose[12]
+                        width = self.pose["hand_state"]
                         if width == 0:
                             width = None
                         else:
                             width = int(width - 100)
                         force = None
-                        caught = self.pose[31]
+                        caught = self.pose["hand_caught"]
                         if caught == 0:
                             caught = None
                         else:
-                            caught = int(self.pose[31] - 100)
+                            caught = int(self.pose["hand_caught"] - 100)
                     else:
                         width = None
                         force = None
@@ -300,7 +315,7 @@ class Jaka_MON:
                 enabled = False
             actual_joint_js["enabled"] = enabled
 
-            self.pose[30] = self.robot.is_emergency_stop_feed()
+            self.pose["emergency_stop"] = self.robot.is_emergency_stop_feed()
 
             error = {}
             # スレーブモード中にエラー情報を取得しようとすると、
@@ -309,7 +324,7 @@ class Jaka_MON:
             # 別プロセスでスレーブモードに入る可能性があるので、
             # 通常モードの場合のみ呼び出す
             with self.slave_mode_lock:
-                if self.pose[14] == 0:
+                if self.pose["slave_mode"] == 0:
                     actual_joint_js["servo_mode"] = False
                     try:
                         errors = self.robot.get_cur_error_info_all()
@@ -336,7 +351,7 @@ class Jaka_MON:
                             error["auto_recoverable"] = False
                 else:
                     actual_joint_js["servo_mode"] = True
-            if self.pose[15] == 0:
+            if self.pose["mqtt_control"] == 0:
                 actual_joint_js["mqtt_control"] = "OFF"
             else:
                 actual_joint_js["mqtt_control"] = "ON"
@@ -345,24 +360,38 @@ class Jaka_MON:
                 actual_joint_js["error"] = error
 
             if actual_joint is not None:
-                self.pose[:len(actual_joint)] = actual_joint
-                self.pose[19] = 1
+                # 同じフィードバックを何度も書かないように受信時刻で見分ける
+                if state_time_ns != last_state_time_ns:
+                    self.seqlocks.state.write(actual_joint, state_time_ns)
+                    self.history.state.append(state_time_ns, actual_joint)
+                    last_state_time_ns = state_time_ns
+                # 制御プロセスが状態値の受信を待っていれば起こす
+                if self.pose["state_received"] == 0:
+                    self.pose["state_received"] = 1
+                    self.notifiers.control.notify()
 
             if now-last > 0.3 or "tool_change" in actual_joint_js or "put_down_box" in actual_joint_js:
+                # ゴーグルとの時計のずれとMQTTの遅延の分布
+                e2e = self.e2e_latency()
+                if e2e is not None:
+                    actual_joint_js["e2e"] = e2e
+                    if (e2e_f is not None and
+                            self.pose["mqtt_control"] == 1):
+                        e2e_f.write(json.dumps(
+                            dict(time=now, kind="e2e", **e2e)) + "\n")
                 jss = json.dumps(actual_joint_js)
                 self.client.publish(MQTT_ROBOT_STATE_TOPIC, jss)
-                with self.monitor_lock:
-                    actual_joint_js["topic_type"] = "robot"
-                    actual_joint_js["topic"] = MQTT_ROBOT_STATE_TOPIC
-                    if actual_tcp_pose is not None:
-                        actual_joint_js["poses"] = actual_tcp_pose
-                    self.monitor_dict.clear()
-                    self.monitor_dict.update(actual_joint_js)
+                # GUIへの表示用
+                if actual_tcp_pose is not None:
+                    actual_joint_js["poses"] = actual_tcp_pose
+                self.snapshots.monitor.write(
+                    "robot", MQTT_ROBOT_STATE_TOPIC,
+                    json.dumps(actual_joint_js).encode())
                 last = now
 
             # MQTT手動制御モード時のみ記録する
             # それ以外の時のエラーはstate情報は必要ないと考えたため
-            if f is not None and self.pose[15] == 1:
+            if f is not None and self.pose["mqtt_control"] == 1:
                 datum = dict(
                     time=now,
                     kind="state",
@@ -381,7 +410,7 @@ class Jaka_MON:
                 js = json.dumps(datum, ensure_ascii=False)
                 f.write(js + "\n")
 
-            if self.pose[32] == 1:
+            if self.pose["exit"] == 1:
                 return False
 
             t_elapsed = time.time() - now
@@ -410,15 +439,44 @@ class Jaka_MON:
         logging_dir = command["params"]["logging_dir"]
         self.logger.info("Change log file")
         self.logging_dir = logging_dir
-        self.pose[34] = 0
-
-    def run_proc(self, monitor_dict, monitor_lock, slave_mode_lock, log_queue, monitor_pipe, logging_dir):
+        self.pose["change_log_monitor"] = 0
+        self.notifiers.main.notify()
+
+    def e2e_latency(self) -> Dict[str, Any] | None:
+        """
+        MQTTの受信プロセスが推定したゴーグルとの時計のずれと最小の往復の遅延、
+        往復の遅延、制御メッセージの片道の遅延、ブローカーなどでの滞留の分布 (ms)。
+        まだ推定できていなければNone
+        """
+        rtt = int(self.pose["clock_rtt"])
+        if rtt == 0:
+            return None
+        e2e = {
+            "clock_offset_ms": int(self.pose["clock_offset"]) / 1e6,
+            "min_rtt_ms": rtt / 1e6,
+        }
+        summary = self.latency.summary(
+            percentiles=[50, 99],
+            phases=["mqtt_rtt", "mqtt_one_way", "mqtt_broker"])
+        for phase, s in summary.items():
+            if s["count"] > 0:
+                e2e[phase] = {
+                    "count": s["count"],
+                    "p50_ms": s["p50_us"] / 1000,
+                    "p99_ms": s["p99_us"] / 1000,
+                    "max_ms": s["max_us"] / 1000,
+                }
+        return e2e
+
+    def run_proc(self, slave_mode_lock, log_queue, monitor_pipe, logging_dir, notifiers: Notifiers):
         self.setup_logger(log_queue)
         self.logger.info("Process started")
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
-        self.monitor_dict = monitor_dict
-        self.monitor_lock = monitor_lock
+        self.sm, self.pose = attach_shm()
+        self.seqlocks = PoseSeqLocks(self.pose)
+        self.notifiers = notifiers
+        self.snapshots = Snapshots()
+        self.history = Histories()
+        self.latency = LatencyHistograms()
         self.slave_mode_lock = slave_mode_lock
         self.monitor_pipe = monitor_pipe
         self.logging_dir = logging_dir
@@ -431,8 +489,10 @@ class Jaka_MON:
                 if save_state:
                     with open(
                         os.path.join(self.logging_dir, "state.jsonl"), "a"
-                    ) as f:
-                        will_change_log_file = self.monitor_start(f)
+                    ) as f, open(
+                        os.path.join(self.logging_dir, "e2e.jsonl"), "a"
+                    ) as e2e_f:
+                        will_change_log_file = self.monitor_start(f, e2e_f)
                 else:
                     will_change_log_file = self.monitor_start()
                 if will_change_log_file:
@@ -440,10 +500,13 @@ class Jaka_MON:
             except Exception as e:
                 self.logger.error("Error in monitor")
                 self.logger.error(f"{self.robot.format_error(e)}")
-            if self.pose[32] == 1:
+            if self.pose["exit"] == 1:
                 self.client.loop_stop()
                 self.client.disconnect()
                 self.sm.close()
+                self.snapshots.close()
+                self.history.close()
+                self.latency.close()
                 time.sleep(1)
                 self.logger.info("Process stopped")
                 self.handler.close()
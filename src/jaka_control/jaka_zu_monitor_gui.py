@@ -1,46 +1,34 @@
-import multiprocessing.shared_memory as sm
 import sys
 import time
-import threading
-from collections import deque
 
-import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtWidgets
 
 from .config import (
     N_JOINTS,
-    SHM_NAME,
-    SHM_SIZE,
     T_INTV,
 )
+from .history import HISTORY_KINDS, Histories
+from .shm import attach_shm
 
 
 class JointMonitorPlot(QtWidgets.QWidget):
     def __init__(
         self,
-        max_points=1000,
+        window=8.0,
     ):
-        """関節角度の時系列データのプロット。"""
+        """
+        関節角度の時系列データのプロット。
+        window: 表示する最近の秒数
+        """
         super().__init__()
         self.n_joints = N_JOINTS
-        self.max_points = max_points
+        self.window = window
         self.t_intv = T_INTV
-        self.t_start = time.time()
-        self.xdata = deque(maxlen=max_points)
-        self.ydata = {
-            'state': [deque(maxlen=max_points) for _ in range(self.n_joints)],
-            'target': [deque(maxlen=max_points) for _ in range(self.n_joints)],
-            'control': [deque(maxlen=max_points) for _ in range(self.n_joints)],
-        }
-        self.shm = sm.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray(
-            (SHM_SIZE,), dtype=np.float32, buffer=self.shm.buf)
-        self.data_lock = threading.Lock()
-        self._stop_event = threading.Event()
-        self.data_thread = threading.Thread(
-            target=self.data_acquisition_loop, daemon=True)
-        self.data_thread.start()
+        self.shm, self.pose = attach_shm()
+        # 各プロセスが値を得たときに書き込む履歴を読むので、
+        # 周期的に共有メモリを見る場合のような取りこぼしや重複がない
+        self.history = Histories()
         self.plots = []
         self.curves = []
         layout = QtWidgets.QVBoxLayout()
@@ -70,41 +58,19 @@ class JointMonitorPlot(QtWidgets.QWidget):
         self.timer.timeout.connect(self.update_plot)
         self.timer.start(int(self.t_intv * 1000))
 
-    def data_acquisition_loop(self):
-        # 共有メモリから最近数件のデータを取得、高速なのでロックしてもOK
-        while not self._stop_event.is_set():
-            t = time.time() - self.t_start
-            pose = self.pose.copy()
-            with self.data_lock:
-                self.xdata.append(t)
-                for i in range(self.n_joints):
-                    self.ydata['state'][i].append(float(pose[i]))
-                    self.ydata['target'][i].append(float(pose[i+6]))
-                    self.ydata['control'][i].append(float(pose[i+24]))
-            # ループ時間が一定になるようにする
-            t_after = time.time() - self.t_start
-            t_elapsed = t_after - t
-            t_wait = self.t_intv - t_elapsed
-            if t_wait > 0:
-                time.sleep(t_wait)
-
     def update_plot(self):
-        # 最近数件のデータを取得、高速なのでロックしてもOK
-        with self.data_lock:
-            x = np.array(self.xdata)
-            y = {}
+        # 横軸は現在からの秒数 (負)
+        now_ns = time.monotonic_ns()
+        since_ns = now_ns - int(self.window * 1e9)
+        for k in HISTORY_KINDS:
+            records = getattr(self.history, k).read_since(since_ns)
+            x = (records["time"] - now_ns) / 1e9
+            y = records["joint"]
             for i in range(self.n_joints):
-                for k in self.ydata:
-                    y_ = np.array(self.ydata[k][i])
-                    if k not in y:
-                        y[k] = [y_]
-                    else:
-                        y[k].append(y_)
-        # 描画、低速 (30 ms周期くらい)なのでロックしないほうがいい
-        for i in range(self.n_joints):
-            for k in self.ydata:
-                self.curves[i][k].setData(x, y[k][i])
-        if self.pose[32] == 1:
+                self.curves[i][k].setData(x, y[:, i])
+        if self.pose["exit"] == 1:
+            self.timer.stop()
+            self.history.close()
             self.shm.close()
             time.sleep(1)
 
@@ -2,6 +2,7 @@
 
 import json
 import logging
+import threading
 from paho.mqtt import client as mqtt
 import multiprocessing as mp
 import multiprocessing.shared_memory
@@ -10,7 +11,6 @@ from multiprocessing import Process
 
 import os
 from datetime import datetime
-import numpy as np
 import time
 from dotenv import load_dotenv
 
@@ -19,7 +19,19 @@ import uuid
 
 # from jaka_control.jaka_robot_mock import MockJakaRobotSharedMemoryManager
 
-from .config import SHM_NAME, SHM_SIZE
+from .clock_sync import ClockSync
+from .control_message import (
+    FLAG_PUT_DOWN_BOX, FLAG_TOOL, FLAG_TOOL_CHANGE, check_joints,
+    decode_control_message, loads_jaka_control_ik, loads_fast
+)
+from .latency import LATENCY_PHASES, LatencyHistograms
+from .mailbox import TargetMailbox
+from .notify import Notifiers
+from .record_ring import RecordRing
+from .seqlock import PoseSeqLocks
+from .shm import attach_shm, create_shm
+from .history import Histories
+from .snapshot import Snapshots
 from .jaka_zu_monitor_gui import run_joint_monitor_gui
 from .jaka_zu_control import Jaka_CON, JAKA_CON_Archiver
 from .jaka_zu_monitor import Jaka_MON
@@ -34,15 +46,30 @@ MQTT_MANAGE_TOPIC = os.getenv("MQTT_MANAGE_TOPIC", "mgr")
 MQTT_CTRL_TOPIC = os.getenv("MQTT_CTRL_TOPIC", "control")
 MQTT_FORMAT = os.getenv("MQTT_FORMAT", "Jaka-Control-IK")
 MQTT_MANAGE_RCV_TOPIC = os.getenv("MQTT_MANAGE_RCV_TOPIC", "dev")+"/"+ROBOT_UUID
+# ゴーグルとの時計のずれの推定。ロボットがpingを送り、ゴーグルがpongを返す
+MQTT_PING_TOPIC = os.getenv("MQTT_PING_TOPIC", "ping")+"/"+ROBOT_UUID
+MQTT_PONG_TOPIC = os.getenv("MQTT_PONG_TOPIC", "pong")+"/"+ROBOT_UUID
+# pingを送る間隔 (秒)
+CLOCK_SYNC_INTERVAL = float(os.getenv("CLOCK_SYNC_INTERVAL", "0.5"))
 
 MOCK = os.getenv("MOCK", "False")
 
+# MQTTの受信プロセスが記録する遅延の区間
+P_MQTT_RTT, P_MQTT_ONE_WAY, P_MQTT_BROKER = (
+    LATENCY_PHASES.index(p)
+    for p in ["mqtt_rtt", "mqtt_one_way", "mqtt_broker"])
 
 class Jaka_MQTT:
     def __init__(self):
         self.gripState = False
         self.mqtt_ctrl_topic = None
         self.last_registered = None
+        self.clock_sync = ClockSync()
+        # 受信した目標値は最新の1件だけを取り込みのスレッドが共有メモリに書く
+        # 送信時刻はping/pongで推定した時計のずれで換算する
+        self.mailbox = TargetMailbox(clock=self.clock_sync)
+        self.ingest_thread = None
+        self._stop_ingest = False
 
     def on_connect(self, client, userdata, connect_flags, reason_code, properties):
         # ロボットのメタ情報の中身はとりあえず
@@ -59,12 +86,11 @@ class Jaka_MQTT:
                 "version": "none",
                 "devId": ROBOT_UUID,
             }
-            self.client.publish(MQTT_MANAGE_TOPIC + "/register", json.dumps(info))
-            with self.mqtt_control_lock:
-                info["topic_type"] = "mgr/register"
-                info["topic"] = MQTT_MANAGE_TOPIC + "/register"
-                self.mqtt_control_dict.clear()
-                self.mqtt_control_dict.update(info)
+            payload = json.dumps(info)
+            self.client.publish(MQTT_MANAGE_TOPIC + "/register", payload)
+            self.snapshots.mqtt_control.write(
+                "mgr/register", MQTT_MANAGE_TOPIC + "/register",
+                payload.encode())
             self.logger.info("publish to: " + MQTT_MANAGE_TOPIC + "/register")
             self.last_registered = time.time()
             self.client.subscribe(MQTT_MANAGE_RCV_TOPIC)
@@ -73,6 +99,8 @@ class Jaka_MQTT:
             self.logger.info("subscribe to: " + MQTT_CTRL_TOPIC)
             self.mqtt_ctrl_topic = MQTT_CTRL_TOPIC
             self.client.subscribe(self.mqtt_ctrl_topic)
+        self.client.subscribe(MQTT_PONG_TOPIC)
+        self.logger.info("subscribe to: " + MQTT_PONG_TOPIC)
 
     def on_disconnect(
         self,
@@ -87,54 +115,90 @@ class Jaka_MQTT:
 
     def on_message(self, client, userdata, msg):
         if msg.topic == self.mqtt_ctrl_topic:
-            js = json.loads(msg.payload)
-
-            if MQTT_FORMAT == "UR-realtime-control-MQTT":
-                joints=['j1','j2','j3','j4','j5','j6']
-                rot =[js[x]  for x in joints]    
-                joint_q = [x for x in rot]
-            elif MQTT_FORMAT == "Jaka-Control-IK":
-                # 7要素入っているが6要素でよいため
-                rot = js["joints"][:6]
-                joint_q = [x for x in rot]
+            # 受信時刻 (制御プロセスで目標値の古さと遅延を計算する)
+            t_ns = time.monotonic_ns()
+
+            seq = None
+            sender_time_ns = None
+            if MQTT_FORMAT == "Jaka-Control-Binary":
+                try:
+                    header, joint_q = decode_control_message(msg.payload)
+                except ValueError as e:
+                    self.logger.warning(f"Invalid control message: {e}")
+                    return
+                seq = header.seq
+                sender_time_ns = header.sender_time_ns
+                self.record_one_way_latency(t_ns, sender_time_ns)
+                flags = header.flags
+                tool = header.tool if flags & FLAG_TOOL else None
+                tool_change = \
+                    header.tool_change if flags & FLAG_TOOL_CHANGE else None
+                put_down_box = bool(flags & FLAG_PUT_DOWN_BOX)
+            elif MQTT_FORMAT in ["Jaka-Control-IK", "UR-realtime-control-MQTT"]:
+                # 関節の値の個数や型が違うメッセージは共有メモリに書く前に捨てる
+                # (取り込みのスレッドでの書き込みが失敗しないように)
+                try:
+                    if MQTT_FORMAT == "Jaka-Control-IK":
+                        # 7要素入っているが6要素でよいため
+                        joint_q, tool, tool_change, put_down_box = \
+                            loads_jaka_control_ik(msg.payload)
+                    else:
+                        js = loads_fast(msg.payload)
+                        joints=['j1','j2','j3','j4','j5','j6']
+                        rot =[js[x]  for x in joints]    
+                        joint_q = [x for x in rot]
+                        tool = js.get("tool")
+                        tool_change = js.get("tool_change")
+                        put_down_box = js.get("put_down_box", False)
+                    joint_q = check_joints(joint_q)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    self.logger.warning(f"Invalid control message: {e!r}")
+                    return
             else:
                 raise ValueError
-            self.pose[6:12] = joint_q 
+            # 順序が入れ替わった古い目標値は捨てる (ツールなどの指示は以下で扱う)
+            self.mailbox.put(
+                joint_q, t_ns, msg.payload, seq=seq,
+                sender_time_ns=sender_time_ns)
 
             # if "grip" in js:
             #     if js['grip']:
             #         if not self.gripState:
             #             self.gripState = True
-            #             self.pose[13] = 1
+            #             self.pose["hand_target"] = 1
 
             #     else:
             #         if self.gripState:
             #             self.gripState = False
-            #             self.pose[13] = 2
-
-            if "tool" in js:
-                if js['tool']:
-                    # HACK: 0の場合に対応するため暫定的に+100している
-                    self.pose[13] = js['tool'] + 100
-
-            if "tool_change" in js:
-                if self.pose[17] == 0:
-                    tool = js["tool_change"]
-                    self.pose[16] = 1
-                    self.pose[17] = tool
+            #             self.pose["hand_target"] = 2
+
+            if tool:
+                # HACK: 0の場合に対応するため暫定的に+100している
+                self.pose["hand_target"] = tool + 100
+
+            if tool_change is not None:
+                if self.pose["tool_change"] == 0:
+                    self.pose["stop_control"] = 1
+                    self.pose["tool_change"] = tool_change
+                    self.notifiers.control.notify()
             
-            if "put_down_box" in js:
-                if self.pose[21] == 0:
-                    if js["put_down_box"]:
-                        self.pose[16] = 1
-                        self.pose[21] = 1
-
-            self.pose[20] = 1
-            with self.mqtt_control_lock:
-                js["topic_type"] = "control"
-                js["topic"] = msg.topic
-                self.mqtt_control_dict.clear()
-                self.mqtt_control_dict.update(js)
+            if put_down_box:
+                if self.pose["put_down_box"] == 0:
+                    self.pose["stop_control"] = 1
+                    self.pose["put_down_box"] = 1
+                    self.notifiers.control.notify()
+
+        elif msg.topic == MQTT_PONG_TOPIC:
+            t3 = time.monotonic_ns()
+            try:
+                delay = self.clock_sync.on_pong(json.loads(msg.payload), t3)
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.warning(f"Invalid pong: {e}")
+                return
+            if delay is not None:
+                self.latency.record(P_MQTT_RTT, delay)
+                self.pose["clock_offset"] = self.clock_sync.offset_ns
+                self.pose["clock_rtt"] = self.clock_sync.delay_ns
 
         elif msg.topic == MQTT_MANAGE_RCV_TOPIC:
             if MQTT_MODE == "metawork":
@@ -147,14 +211,62 @@ class Jaka_MQTT:
                     self.mqtt_ctrl_topic = mqtt_ctrl_topic
                 self.client.subscribe(self.mqtt_ctrl_topic)
                 self.logger.info("subscribe to: " + self.mqtt_ctrl_topic)
-                with self.mqtt_control_lock:
-                    js["topic_type"] = "dev"
-                    js["topic"] = msg.topic
-                    self.mqtt_control_dict.clear()
-                    self.mqtt_control_dict.update(js)
+                self.snapshots.mqtt_control.write(
+                    "dev", msg.topic, msg.payload)
         else:
             self.logger.warning("not subscribe msg" + msg.topic)
 
+    def record_one_way_latency(self, recv_ns: int, sender_time_ns: int) -> None:
+        """
+        制御メッセージの片道の遅延と、そのうち最小の片道の遅延
+        (最小の往復の遅延の半分) を超えた分を記録する
+        """
+        clock_sync = self.clock_sync
+        if clock_sync.offset_ns is None:
+            return
+        one_way = max(recv_ns - clock_sync.to_local(sender_time_ns), 0)
+        self.latency.record(P_MQTT_ONE_WAY, one_way)
+        self.latency.record(
+            P_MQTT_BROKER, max(one_way - clock_sync.delay_ns // 2, 0))
+
+    def send_ping(self) -> None:
+        ping = self.clock_sync.make_ping()
+        self.client.publish(MQTT_PING_TOPIC, json.dumps(ping))
+
+    def ingest_loop(self):
+        """
+        メールボックスの最新の目標値を共有メモリに書く。
+        書いている間に届いた目標値は、次に取り出すときに最新の1件にまとめられている
+        """
+        mailbox = self.mailbox
+        last_t_ns = 0
+        while not self._stop_ingest:
+            target = mailbox.take(1)
+            self.pose["target_coalesced"] = mailbox.n_coalesced
+            self.pose["target_reordered"] = mailbox.n_reordered
+            self.pose["target_dropped"] = mailbox.n_dropped
+            if target is None:
+                continue
+            # 1件の失敗でスレッドが終わると以後の目標値が届かなくなるので、
+            # その1件を捨てて続ける
+            try:
+                # 履歴や補間のため時刻は戻さない
+                t_ns = max(target.t_ns, last_t_ns)
+                self.seqlocks.target.write(target.joints, t_ns)
+                last_t_ns = t_ns
+                self.history.target.append(t_ns, target.joints)
+                # 同じ値の目標値が届いたことも制御側でわかるように数える
+                self.pose["target_count"] += 1
+                # 制御プロセスが目標値の受信を待っていれば起こす
+                if self.pose["target_received"] == 0:
+                    self.pose["target_received"] = 1
+                    self.notifiers.control.notify()
+                # GUIへの表示用。受信したバイト列をそのまま共有メモリにコピーする
+                self.snapshots.mqtt_control.write(
+                    "control", self.mqtt_ctrl_topic, target.payload)
+            except Exception:
+                self.logger.exception("Error in writing a target")
+
     def connect_mqtt(self):
         self.client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2) 
@@ -174,14 +286,21 @@ class Jaka_MQTT:
         self.logger.addHandler(self.handler)
         self.logger.setLevel(logging.INFO)
 
-    def run_proc(self, mqtt_control_dict, mqtt_control_lock, log_queue):
+    def run_proc(self, log_queue, notifiers: Notifiers):
         self.setup_logger(log_queue)
         self.logger.info("Process started")
-        self.sm = mp.shared_memory.SharedMemory(SHM_NAME)
-        self.pose = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf)
-        self.mqtt_control_dict = mqtt_control_dict
-        self.mqtt_control_lock = mqtt_control_lock
+        self.sm, self.pose = attach_shm()
+        self.seqlocks = PoseSeqLocks(self.pose)
+        self.notifiers = notifiers
+        self.snapshots = Snapshots()
+        self.history = Histories()
+        self.latency = LatencyHistograms()
+        self.ingest_thread = threading.Thread(
+            target=self.ingest_loop, daemon=True)
+        self.ingest_thread.start()
         self.connect_mqtt()
+        # 次にpingを送る時刻 (time.monotonic)
+        next_ping = time.monotonic()
         while True:
             # 30分ごとに再登録
             now = time.time()
@@ -200,19 +319,18 @@ class Jaka_MQTT:
                         "version": "none",
                         "devId": ROBOT_UUID,
                     }
+                    payload = json.dumps(info)
                     self.client.publish(
-                        MQTT_MANAGE_TOPIC + "/register", json.dumps(info))
-                    with self.mqtt_control_lock:
-                        info["topic_type"] = "mgr/register"
-                        info["topic"] = MQTT_MANAGE_TOPIC + "/register"
-                        self.mqtt_control_dict.clear()
-                        self.mqtt_control_dict.update(info)
+                        MQTT_MANAGE_TOPIC + "/register", payload)
+                    self.snapshots.mqtt_control.write(
+                        "mgr/register", MQTT_MANAGE_TOPIC + "/register",
+                        payload.encode())
                     self.logger.info(
                         "re-publish to: " + MQTT_MANAGE_TOPIC + "/register")
                     self.last_registered = now
 
             # プロセス終了時
-            if self.pose[32] == 1:
+            if self.pose["exit"] == 1:
                 if MQTT_MODE == "metawork":
                     info = {"devId": ROBOT_UUID}
                     self.client.publish(
@@ -221,52 +339,61 @@ class Jaka_MQTT:
                         "publish to: " + MQTT_MANAGE_TOPIC + "/unregister")
                 self.client.loop_stop()
                 self.client.disconnect()
+                self._stop_ingest = True
+                self.mailbox.wake()
+                self.ingest_thread.join()
+                mailbox = self.mailbox
+                self.logger.info(
+                    f"Targets received: {mailbox.n_received}, "
+                    f"coalesced: {mailbox.n_coalesced}, "
+                    f"reordered: {mailbox.n_reordered}, "
+                    f"dropped: {mailbox.n_dropped}")
+                clock_sync = self.clock_sync
+                if clock_sync.offset_ns is not None:
+                    self.logger.info(
+                        f"Clock offset to goggles: "
+                        f"{clock_sync.offset_ns / 1e6:.3f} ms, "
+                        f"min RTT: {clock_sync.delay_ns / 1e6:.3f} ms "
+                        f"({clock_sync.n_pongs} pongs)")
                 self.sm.close()
+                self.snapshots.close()
+                self.history.close()
+                self.latency.close()
                 time.sleep(1)
                 self.logger.info("Process stopped")
                 self.handler.close()
                 break
 
-            time.sleep(1)
+            # ゴーグルが接続していれば時計のずれの推定のため
+            # CLOCK_SYNC_INTERVALごとにpingを送る (通知で起きた場合は送らない)
+            timeout = 1.0
+            if self.mqtt_ctrl_topic is not None:
+                now_mono = time.monotonic()
+                if now_mono >= next_ping:
+                    self.send_ping()
+                    next_ping = now_mono + CLOCK_SYNC_INTERVAL
+                timeout = min(timeout, next_ping - now_mono)
+
+            # 終了の通知か、再登録の確認 (1秒ごと) と次のpingの早い方まで待つ
+            self.notifiers.mqtt.wait(timeout)
 
 
 class ProcessManager:
     def __init__(self):
         # mp.set_start_method('spawn')
-        sz = SHM_SIZE * np.dtype('float32').itemsize
-        try:
-            self.sm = mp.shared_memory.SharedMemory(create=True,size = sz, name=SHM_NAME)
-        except FileExistsError:
-            self.sm = mp.shared_memory.SharedMemory(size = sz, name=SHM_NAME)
-        # self.arの要素の説明
-        # [0:6]: 関節の状態値
-        # [6:12]: 関節の目標値
-        # [12]: ハンドの状態値
-        # [13]: ハンドの目標値
-        # [14]: 0: 必ず通常モード。1: 基本的にスレーブモード（通常モードになっている場合もある）
-        # [15]: 0: mqtt_control実行中でない。1: mqtt_control実行中
-        # [16]: 1: リアルタイム制御停止命令（mqtt_control停止命令ではないことに注意）
-        # [17]: ツールチェンジの実行フラグ。0: 終了。0以外: 開始。次のツール番号
-        # [18]: ツールチェンジ完了状態。0: 未定義。1: 成功。2: 失敗
-        # [19]: 制御開始後の状態値の受信フラグ
-        # [20]: 制御開始後の目標値の受信フラグ
-        # [21]: 棚の上の箱を作業台に置くデモの実行フラグ。0: 終了。1: 開始
-        # [22]: 棚の上の箱を作業台に置くデモの完了状態。0: 未定義。1: 成功。2: 失敗
-        # [23]: 現在のツール番号
-        # [24:30]: 関節の制御値
-        # [30]: 緊急停止フラグ。0: 停止でない。1: 停止
-        # [31]: ハンドの把持の有無。0: 把持していない。1: 把持している。-1: 不明
-        # [32]: プロセス終了フラグ
-        # [33]: ログ出力先の変更フラグ(control用)
-        # [34]: ログ出力先の変更フラグ(monitor用)
-        # [35]: ログ出力先の変更フラグ(contol-archiver用)
-        self.ar = np.ndarray((SHM_SIZE,), dtype=np.dtype("float32"), buffer=self.sm.buf) # 共有メモリ上の Array
-        self.ar[:] = 0
-        self.manager = multiprocessing.Manager()
-        self.monitor_dict = self.manager.dict()
-        self.monitor_lock = self.manager.Lock()
-        self.mqtt_control_dict = self.manager.dict()
-        self.mqtt_control_lock = self.manager.Lock()
+        # 共有メモリの形式はconfig.SHM_DTYPEを参照
+        # self.arは共有メモリ上の構造化配列の要素
+        self.sm, self.ar = create_shm()
+        # 制御ループの処理区間ごとの処理時間のヒストグラム
+        self.latency = LatencyHistograms(create=True)
+        # 制御プロセスから記録プロセスへの制御の記録
+        self.records = RecordRing(create=True)
+        # 共有メモリの値やフラグを書いたことを待っているプロセスに知らせる
+        self.notifiers = Notifiers()
+        # GUIに表示するモニタプロセスとMQTTの受信プロセスの最新のメッセージ
+        self.snapshots = Snapshots(create=True)
+        # 関節の状態値、目標値、制御値の履歴
+        self.history = Histories(create=True)
         self.slave_mode_lock = multiprocessing.Lock()
         self.main_to_control_pipe, self.control_pipe = multiprocessing.Pipe()
         self.main_to_monitor_pipe, self.monitor_pipe = multiprocessing.Pipe()
@@ -282,7 +409,6 @@ class ProcessManager:
         self.monP = None
         self.ctrlP = None
         self.monitor_guiP = None
-        self.control_to_archiver_queue = multiprocessing.Queue()
         self.main_to_control_archiver_pipe, self.control_archiver_pipe = \
             multiprocessing.Pipe()
 
@@ -290,9 +416,8 @@ class ProcessManager:
         self.recv = Jaka_MQTT()
         self.recvP = Process(
             target=self.recv.run_proc,
-            args=(self.mqtt_control_dict,
-                  self.mqtt_control_lock,
-                  self.log_queue),
+            args=(self.log_queue,
+                  self.notifiers),
             name="MQTT-recv")
         self.recvP.start()
         self.state_recv_mqtt = True
@@ -301,12 +426,11 @@ class ProcessManager:
         self.mon = Jaka_MON()
         self.monP = Process(
             target=self.mon.run_proc,
-            args=(self.monitor_dict,
-                  self.monitor_lock,
-                  self.slave_mode_lock,
+            args=(self.slave_mode_lock,
                   self.log_queue,
                   self.monitor_pipe,
-                  logging_dir),
+                  logging_dir,
+                  self.notifiers),
             name="JAKA-Zu-monitor")
         self.monP.start()
         self.state_monitor = True
@@ -315,7 +439,7 @@ class ProcessManager:
         self.ctrl = Jaka_CON()
         self.ctrlP = Process(
             target=self.ctrl.run_proc,
-            args=(self.control_pipe, self.slave_mode_lock, self.log_queue, logging_dir, self.control_to_archiver_queue),
+            args=(self.control_pipe, self.slave_mode_lock, self.log_queue, logging_dir, self.notifiers),
             name="JAKA-Zu-control")
         self.ctrlP.start()
 
@@ -325,7 +449,7 @@ class ProcessManager:
             args=(self.control_archiver_pipe,
                   self.log_queue,
                   logging_dir,
-                  self.control_to_archiver_queue,
+                  self.notifiers,
                   ),
             name="JAKA-Zu-control-archiver")
         self.ctrl_archiverP.start()
@@ -340,8 +464,12 @@ class ProcessManager:
         self.state_monitor_gui = True
 
     def stop_all_processes(self):
-        self.ar[32] = 1
-        self.ar[16] = 1
+        self.ar["exit"] = 1
+        self.ar["stop_control"] = 1
+        for notifier in [
+                self.notifiers.control, self.notifiers.archiver,
+                self.notifiers.mqtt]:
+            notifier.notify()
         if self.recvP is not None:
             self.recvP.join()
         if self.monP is not None:
@@ -354,12 +482,19 @@ class ProcessManager:
             self.monitor_guiP.join()
         self.sm.close()
         self.sm.unlink()
-        self.manager.shutdown()
+        self.latency.close()
+        self.latency.unlink()
+        self.records.close()
+        self.records.unlink()
+        self.notifiers.close()
+        self.snapshots.close()
+        self.snapshots.unlink()
+        self.history.close()
+        self.history.unlink()
         self.main_to_control_pipe.close()
         self.control_pipe.close()
         self.main_to_monitor_pipe.close()
         self.monitor_pipe.close()
-        self.control_to_archiver_queue.close()
 
     def _send_command_to_control(self, command):
         self.main_to_control_pipe.send(command)
@@ -390,11 +525,12 @@ class ProcessManager:
 
     def stop_mqtt_control(self):
         # mqtt_control中のみシグナルを出す
-        if self.ar[15] == 1:
-            self.ar[16] = 1
+        if self.ar["mqtt_control"] == 1:
+            self.ar["stop_control"] = 1
+            self.notifiers.control.notify()
 
     def tool_change(self, tool_id: int):
-        self.ar[17] = tool_id
+        self.ar["tool_change"] = tool_id
         self._send_command_to_control({"command": "tool_change"})
 
     def jog_joint(self, joint, direction):
@@ -407,24 +543,31 @@ class ProcessManager:
         self._send_command_to_control({"command": "demo_put_down_box"})
 
     def get_current_monitor_log(self):
-        with self.monitor_lock:
-            monitor_dict = self.monitor_dict.copy()
-        return monitor_dict
-    
+        """前回から更新されていればモニタプロセスの最新のメッセージ、なければNone"""
+        return self.snapshots.monitor.read()
+
     def get_current_mqtt_control_log(self):
-        with self.mqtt_control_lock:
-            mqtt_control_dict = self.mqtt_control_dict.copy()
-        return mqtt_control_dict
+        """前回から更新されていればMQTTの最新の受信メッセージ、なければNone"""
+        return self.snapshots.mqtt_control.read()
+
+    def get_latency_summary(self):
+        return self.latency.summary()
+
+    def dump_latency_histograms(self, logging_dir: str) -> str:
+        path = os.path.join(logging_dir, "latency.json")
+        self.latency.dump(path)
+        return path
 
     def change_log_file(self, logging_dir: str):
         # モニタプロセス
-        self.ar[34] = 1
+        self.ar["change_log_monitor"] = 1
         self._send_command_to_monitor({"command": "change_log_file", "params": {"logging_dir": logging_dir}})
         # 制御プロセス
-        self.ar[33] = 1
+        self.ar["change_log_control"] = 1
         self._send_command_to_control({"command": "change_log_file", "params": {"logging_dir": logging_dir}})
         # 制御プロセスはMQTTControl時は一旦停止させる
         self.stop_mqtt_control()
         # 制御記録用プロセス
-        self.ar[35] = 1
+        self.ar["change_log_archiver"] = 1
+        self.notifiers.archiver.notify()
         self._send_command_to_control({"command": "change_log_file", "params": {"logging_dir": logging_dir}})
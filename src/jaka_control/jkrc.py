@@ -9,18 +9,58 @@ JAKA Zu 5sのPython APIのドキュメントは取得できたが、コード(jk
 - nkawa/MQTT_Dobot_Nova2_Control/dobot_api.py
 """
 
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import json
 import logging
+import queue
 import socket
-from time import sleep, perf_counter
+from collections import deque
+from time import sleep, perf_counter, perf_counter_ns
 import threading
 
+from .jkrc_reply import ReplyDesyncError, ReplyFramer, reply_cmd_name
+from .rc_telemetry import RCTelemetry
+
 
 logger = logging.getLogger(__name__)
 
 
+# 頻繁に送るコマンドのエンコード済みの形
+_GET_JOINT_POS = b'{"cmdName":"get_joint_pos"}'
+_IS_IN_SERVOMOVE = b'{"cmdName":"is_in_servomove"}'
+
+
+def servo_j_format(move_mode: int, step_num: int, decimals: int) -> bytes:
+    """
+    servo_jのJSONのbytesの書式。関節の値 (6個) を%で埋める。
+    小数点以下decimals桁の固定小数で表す
+    """
+    cp = ",".join([f"%.{decimals}f"] * 6)
+    return (f'{{"cmdName": "servo_j", "jointPosition": [{cp}], '
+            f'"relFlag": {move_mode}, "stepNum": {step_num}}}').encode()
+
+
+def _cmd_name(send: str) -> str:
+    # 送信するJSONのcmdNameの値
+    i = send.find('"', send.find(':', send.find('"cmdName"') + 9)) + 1
+    return send[i:send.find('"', i)]
+
+
+class _Pending:
+    """パイプラインで応答を待っているコマンド"""
+    __slots__ = ("cmd", "t_send_ns", "event", "reply")
+
+    def __init__(
+        self, cmd: str, t_send_ns: int, event: threading.Event | None,
+    ) -> None:
+        self.cmd = cmd
+        self.t_send_ns = t_send_ns
+        # servo_j以外 (送信したスレッドが応答を待つ) の場合のみ
+        self.event = event
+        self.reply = None
+
+
 class RC:
     """
     JAKAの制御用API。
@@ -34,36 +74,231 @@ class RC:
         ip: str = "10.5.5.100",
         port: int = 10001,
         timeout: Optional[float] = 60,
+        telemetry_log_interval: Optional[float] = 60,
+        servo_decimals: int = 6,
     ) -> None:
+        """
+        telemetry_log_interval: コマンドごとの往復の時間とエラーの集計
+        (self.telemetry) をログに出す間隔 (秒)。Noneで出さない
+        servo_decimals: servo_jで送る関節の値 (deg) の小数点以下の桁数
+        """
         self._ip = ip
         self._port = port
         self._socket = None
         self._timeout = timeout
         self.__globalLock = threading.Lock()
+        self._servo_decimals = servo_decimals
+        # (move_mode, step_num)ごとのservo_jの書式
+        self._servo_formats: Dict[Tuple[int, int], bytes] = {}
+        # 応答のストリームから1件ずつ切り出す
+        self._framer = ReplyFramer()
+        # タイムアウトなどで受け取らずに諦めた応答のcmdName (送信順)。
+        # 後で届いたら捨てる
+        self._abandoned = deque()
+        # servo_jのパイプライン (start_servo_pipeline)。動いていなければNone
+        self._reader = None
+        self._pending = None
+        self._in_flight = None
+        self._on_servo_reply = None
+        # パイプラインで受けたservo_jのエラー (ec, recv)。最初の1件を残す。
+        # 受信スレッドが書き、制御ループがservo_jで読む (ロックなし)
+        self._servo_error = None
+        self.servo_stats = {}
+        self.telemetry = RCTelemetry(
+            log_interval=telemetry_log_interval, logger=logger)
 
     def _send_data(self, string):
+        # 頻繁に送るコマンドはエンコード済みのbytesで受ける
         assert self._socket is not None, "Socket is not connected"
-        self._socket.send(str.encode(string, 'utf-8'))
+        if isinstance(string, str):
+            string = string.encode('utf-8')
+        self._socket.sendall(string)
 
-    def _wait_reply(self):
+    def _wait_reply(self, cmd=None):
         assert self._socket is not None, "Socket is not connected"
-        data = self._socket.recv(1024)
-        if len(data) == 0:
-            data_str = data
-        else:
-            data_str = str(data, encoding="utf-8")
-        return data_str
-
-    def _sendRecvMsg(self, string):
+        abandoned = self._abandoned
+        while True:
+            reply = self._framer.read_reply(self._socket)
+            name = reply_cmd_name(reply)
+            if not abandoned:
+                break
+            # 諦めた応答は届かないこともあるので、数ではなくcmdNameで見分ける。
+            # 応答は送信順に届くので、送ったコマンドの応答が届けばそれより前の
+            # 諦めた応答はもう届かない
+            if name is not None and name != cmd and name in abandoned:
+                while abandoned.popleft() != name:
+                    pass
+                logger.warning(f"Discarded late reply: {reply}")
+                continue
+            if name is None or name in abandoned:
+                # 遅れた応答か送ったコマンドの応答か区別できない
+                abandoned.clear()
+                raise ReplyDesyncError(
+                    f"Could not tell a late reply from the reply to {cmd}: "
+                    f"{reply}")
+            abandoned.clear()
+            break
+        # 応答にcmdNameがあれば送ったコマンドと一致するはず
+        if cmd is not None and name is not None and name != cmd:
+            raise ReplyDesyncError(f"Reply to {name} received for {cmd}: {reply}")
+        return reply
+
+    def _sendRecvMsg(self, string, cmd=None):
+        if cmd is None:
+            cmd = _cmd_name(string)
+        if self._reader is not None:
+            return self._sendRecvMsg_pipelined(string, cmd)
         with self.__globalLock:
+            t_send_ns = perf_counter_ns()
             self._send_data(string)
-            recvData = self._wait_reply()
+            try:
+                recvData = self._wait_reply(cmd)
+            except socket.timeout:
+                self.telemetry.record_timeout(cmd)
+                self._abandoned.append(cmd)
+                raise
+            ec = self._parse_error_code_fast(recvData)
+            self.telemetry.record(cmd, t_send_ns, perf_counter_ns(), ec)
             return recvData
 
+    def _sendRecvMsg_pipelined(self, string, cmd):
+        # パイプラインの動作中は応答を受信スレッドから受け取る
+        p = _Pending(cmd, 0, threading.Event())
+        with self.__globalLock:
+            p.t_send_ns = perf_counter_ns()
+            self._send_data(string)
+            self._pending.put(p)
+        if not p.event.wait(self._timeout):
+            self.telemetry.record_timeout(cmd)
+            raise TimeoutError(f"No reply in {self._timeout} seconds: {string}")
+        if p.reply is None:
+            raise ConnectionError(f"Connection lost before reply: {string}")
+        return p.reply
+
+    def start_servo_pipeline(
+        self,
+        max_in_flight: int = 4,
+        on_reply: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        """
+        servo_jを応答を待たずに送るパイプラインを開始する。Python SDKにはない。
+        応答は受信スレッドが送信順に対応づけ、エラーは次のservo_jの返り値で知らせる。
+        max_in_flight: 応答を待つservo_jの上限。超える場合は応答を待ってから送る
+        on_reply: servo_jの応答ごとに受信スレッドから (エラーコード, 往復の時間 (ns))
+        で呼ばれる
+        """
+        assert max_in_flight >= 1
+        if self._reader is not None:
+            return
+        self._pending = queue.SimpleQueue()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._on_servo_reply = on_reply
+        self._servo_error = None
+        self.servo_stats = {
+            "sent": 0,
+            "replied": 0,
+            "errors": 0,
+            "max_in_flight": 0,
+            "max_rtt_ns": 0,
+        }
+        self._reader = threading.Thread(
+            target=self._reader_loop, name="jkrc_reader", daemon=True)
+        self._reader.start()
+
+    def command_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        cmdNameごとの往復の時間 (ms) の分位点、エラーコードとタイムアウトの件数。
+        Python SDKにはない
+        """
+        return self.telemetry.summary()
+
+    @property
+    def servo_pipelined(self) -> bool:
+        """servo_jのパイプラインが動いているか"""
+        return self._reader is not None
+
+    def stop_servo_pipeline(self) -> Tuple[int] | Tuple[int, Any]:
+        """
+        送ったservo_jの応答をすべて受けてからパイプラインを止める。
+        パイプラインで受けたエラーがあれば (ec, recv) を返す
+        """
+        reader = self._reader
+        if reader is None:
+            return (0,)
+        self._pending.put(None)
+        reader.join(self._timeout)
+        if reader.is_alive():
+            logger.warning("Servo pipeline reader did not stop")
+        self._reader = None
+        error = self._servo_error
+        self._servo_error = None
+        if error is not None:
+            return error
+        return (0,)
+
+    def _reader_loop(self) -> None:
+        # 送信順に並んだ_Pendingに、届いた順の応答を1件ずつ対応づける
+        stats = self.servo_stats
+        telemetry = self.telemetry
+        while True:
+            p = self._pending.get()
+            if p is None:
+                break
+            try:
+                reply = self._wait_reply(p.cmd)
+            except Exception as e:
+                logger.error(f"Servo pipeline reader stopped: {e!r}")
+                if isinstance(e, socket.timeout):
+                    telemetry.record_timeout(p.cmd)
+                if self._servo_error is None:
+                    self._servo_error = (-1, repr(e))
+                self._fail_pending(p)
+                break
+            t_recv_ns = perf_counter_ns()
+            ec = self._parse_error_code_fast(reply)
+            telemetry.record(p.cmd, p.t_send_ns, t_recv_ns, ec)
+            if p.event is not None:
+                p.reply = reply
+                p.event.set()
+                continue
+            rtt_ns = t_recv_ns - p.t_send_ns
+            stats["replied"] += 1
+            if rtt_ns > stats["max_rtt_ns"]:
+                stats["max_rtt_ns"] = rtt_ns
+            if ec != 0:
+                stats["errors"] += 1
+                if self._servo_error is None:
+                    self._servo_error = (ec, reply)
+            self._in_flight.release()
+            if self._on_servo_reply is not None:
+                self._on_servo_reply(ec, rtt_ns)
+
+    def _fail_pending(self, p: _Pending | None) -> None:
+        # 受信できなくなったので、待っているものをすべて起こす
+        while p is not None:
+            self._abandoned.append(p.cmd)
+            if p.event is not None:
+                p.event.set()
+            else:
+                self._in_flight.release()
+            try:
+                p = self._pending.get_nowait()
+            except queue.Empty:
+                p = None
+
     def _close(self):
+        # 別スレッドの送受信の途中で切らない
+        with self.__globalLock:
+            self._close_socket()
+
+    def _close_socket(self):
+        # __globalLockを持って呼ぶ
         if self._socket is not None:
             try:
                 self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                # 既に切れた接続をログインし直す場合
+                logger.debug(f"Socket shutdown failed: {e!r}")
             except Exception:
                 logger.exception("Error while socket shutdown")
             try:
@@ -75,14 +310,36 @@ class RC:
     def __del__(self):
         self._close()
 
+    @property
+    def connected(self) -> bool:
+        return self._socket is not None
+
     def login(self) -> Tuple[int] | Tuple[int, Any]:
-        try:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._socket.settimeout(self._timeout)
-            self._socket.connect((self._ip, self._port))
-        except Exception as e:
-            self._close()
-            raise e
+        """
+        接続する。接続済みなら切断してから接続し直す。
+        別スレッドが送受信している間は、それが終わるまで待つ
+        """
+        with self.__globalLock:
+            if self._socket is not None:
+                self._close_socket()
+                if self._reader is not None:
+                    # 受信スレッドは切断でエラーになって止まる
+                    # (受信スレッドは__globalLockを使わない)
+                    self.stop_servo_pipeline()
+            try:
+                self._socket = socket.socket(
+                    socket.AF_INET, socket.SOCK_STREAM)
+                self._socket.settimeout(self._timeout)
+                self._socket.connect((self._ip, self._port))
+                # 応答を待たずに続けて送るservo_jを、前の送信の確認応答まで
+                # 溜めないようにする (Nagle)
+                self._socket.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception as e:
+                self._close_socket()
+                raise e
+            self._framer.reset()
+            self._abandoned.clear()
         return (0,)
 
     def power_on(self) -> Tuple[int] | Tuple[int, Any]:
@@ -122,8 +379,7 @@ class RC:
 
     def is_in_servomove(self) -> Tuple[int, bool] | Tuple[int, Any]:
         """Python SDKにはない"""
-        send = '{"cmdName":"is_in_servomove"}'
-        ec, ret, recv = self._process(send)
+        ec, ret, recv = self._process(_IS_IN_SERVOMOVE, "is_in_servomove")
         if ec != 0:
             return (ec, recv)
         ps = ret["in_servomove"]
@@ -158,21 +414,46 @@ class RC:
          
         """
         assert move_mode in [0, 1]
-        cp = ",".join(map(str, joint_pos))
-        sn = step_num
-        send = f'{{"cmdName": "servo_j", "jointPosition": [{cp}], "relFlag": {move_mode}, "stepNum": {sn}}}'
-        recv = self._sendRecvMsg(send)
+        fmt = self._servo_formats.get((move_mode, step_num))
+        if fmt is None:
+            fmt = servo_j_format(move_mode, step_num, self._servo_decimals)
+            self._servo_formats[(move_mode, step_num)] = fmt
+        send = fmt % tuple(joint_pos)
+        if self._reader is not None:
+            return self._servo_j_pipelined(send)
+        recv = self._sendRecvMsg(send, "servo_j")
         ec = self._parse_error_code_fast(recv)
         if ec == 0:
             return (ec,)
         else:
             return (ec, recv)
 
+    def _servo_j_pipelined(self, send: bytes) -> Tuple[int] | Tuple[int, Any]:
+        # 応答を待たずに送る。前に送ったものがエラーになっていればそれを返す
+        error = self._servo_error
+        if error is not None:
+            return error
+        if not self._in_flight.acquire(timeout=self._timeout):
+            return (-1, f"No servo_j reply in {self._timeout} seconds")
+        stats = self.servo_stats
+        with self.__globalLock:
+            t_send_ns = perf_counter_ns()
+            try:
+                self._send_data(send)
+            except Exception:
+                self._in_flight.release()
+                raise
+            self._pending.put(_Pending("servo_j", t_send_ns, None))
+            stats["sent"] += 1
+        n = stats["sent"] - stats["replied"]
+        if n > stats["max_in_flight"]:
+            stats["max_in_flight"] = n
+        return (0,)
+
     def get_joint_position(self) -> Tuple[
         int, Tuple[float, float, float, float, float, float]
     ] | Tuple[int, Any]:
-        send = '{"cmdName":"get_joint_pos"}'
-        recv = self._sendRecvMsg(send)
+        recv = self._sendRecvMsg(_GET_JOINT_POS, "get_joint_pos")
         ec = self._parse_error_code_fast(recv)
         if ec == 0:
             # Assume "joint_pos": [j1,j2,j3,j4,j5,j6]
@@ -455,8 +736,10 @@ class RC:
             error_code = valueRecv[j:][:k]
             return int(error_code)
 
-    def _process(self, send: str) -> Tuple[int, Any, str]:
-        recv = self._sendRecvMsg(send)
+    def _process(
+        self, send: str | bytes, cmd: str | None = None,
+    ) -> Tuple[int, Any, str]:
+        recv = self._sendRecvMsg(send, cmd)
         ret = self._parse_results(recv)
         ec = int(ret["errorCode"])
         return (ec, ret, recv)
@@ -3,7 +3,7 @@ from typing import Any, Dict, Optional, Tuple
 import json
 import logging
 import socket
-from time import sleep, perf_counter
+from time import monotonic_ns, sleep, perf_counter
 import threading
 
 
@@ -112,6 +112,8 @@ class RCFeedBack:
             with self.__Lock:
                 self.__MyType = json.loads(unit_data.decode())
                 self.__MyType["timestamp"] = perf_counter()
+                # 受信時刻。プロセス間で比較できる単調増加の時刻 (ns)
+                self.__MyType["timestamp_ns"] = monotonic_ns()
                 if self._callback is not None:
                     self._callback(self.__MyType)
 
@@ -0,0 +1,181 @@
+"""
+TCP API (jkrc.RC) の応答の切り出し。
+応答はJSONのオブジェクトが区切りなしに続くストリームで、1回のrecvで
+応答の一部しか届かないことも、複数の応答がまとめて届くこともある。
+"""
+import re
+import socket
+
+
+# 文字列の外で意味のある文字と、文字列の中で意味のある文字
+_OUTSIDE = re.compile(rb'[{}"]')
+_INSIDE = re.compile(rb'["\\]')
+_NON_SPACE = re.compile(rb'\S')
+_CMD_NAME = re.compile(r'"cmdName"\s*:\s*"([^"]*)"')
+
+
+class ReplyDesyncError(ConnectionError):
+    """応答と送ったコマンドの対応が崩れた。接続し直す必要がある"""
+    pass
+
+
+def reply_cmd_name(reply: str) -> str | None:
+    """応答のcmdName。含まない応答 (一部のエラー) ではNone"""
+    m = _CMD_NAME.search(reply)
+    return None if m is None else m.group(1)
+
+
+class ReplyFramer:
+    """
+    受信したバイト列から完結した応答を1件ずつ切り出す。
+    受信バッファは使い回し、recv_intoで直接受ける。
+    括弧の深さと文字列の中かどうかを保つので、分割して届いても
+    走査済みの部分は読み直さない。
+    応答の間に空白以外があるか、応答がmax_sizeバイトを超える場合は
+    ReplyDesyncErrorとする
+    """
+    def __init__(self, size: int = 4096, max_size: int = 1 << 20) -> None:
+        self.max_size = max_size
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self.reset()
+
+    def reset(self) -> None:
+        """溜まっているものを捨てる (接続し直したとき)"""
+        # 未消費の先頭、走査済みの終わり、受信済みの終わり
+        self._start = 0
+        self._pos = 0
+        self._end = 0
+        self._depth = 0
+        self._in_str = False
+        # 前の受信が文字列中のバックスラッシュで終わった
+        self._escaped = False
+
+    def __len__(self) -> int:
+        """溜まっている未消費のバイト数"""
+        return self._end - self._start
+
+    def _reserve(self) -> None:
+        # 受信バッファの後ろに空きを作る。未消費の部分を先頭に詰め、
+        # それでも空きがなければ大きくする
+        if self._end < len(self._buf):
+            return
+        n = self._end - self._start
+        if n >= self.max_size:
+            raise ReplyDesyncError(
+                f"No complete reply in {n} bytes: "
+                f"{bytes(self._mv[self._start:self._start + 100])!r}...")
+        if self._start > 0:
+            self._mv[:n] = self._mv[self._start:self._end]
+        else:
+            buf = bytearray(2 * len(self._buf))
+            buf[:n] = self._mv[:n]
+            self._mv.release()
+            self._buf = buf
+            self._mv = memoryview(buf)
+        self._pos -= self._start
+        self._end = n
+        self._start = 0
+
+    def recv_from(self, sock: socket.socket) -> int:
+        """sockから1回受信して溜める。受信したバイト数 (切断で0) を返す"""
+        self._reserve()
+        n = sock.recv_into(self._mv[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data: bytes) -> None:
+        """受信したバイト列を溜める (recv_fromを使わない場合)"""
+        mv = memoryview(data)
+        while len(mv) > 0:
+            self._reserve()
+            k = min(len(mv), len(self._buf) - self._end)
+            self._mv[self._end:self._end + k] = mv[:k]
+            self._end += k
+            mv = mv[k:]
+
+    def next_reply(self) -> str | None:
+        """完結した応答があれば1件返す。なければNone"""
+        buf = self._buf
+        pos = self._pos
+        end = self._end
+        depth = self._depth
+        in_str = self._in_str
+        if self._escaped:
+            if pos >= end:
+                return None
+            pos += 1
+            self._escaped = False
+        while pos < end:
+            if depth == 0:
+                # 応答の始まりの前は空白のみ
+                if buf[pos] == 0x7B:
+                    i = pos
+                else:
+                    m = _NON_SPACE.search(buf, pos, end)
+                    if m is None:
+                        pos = end
+                        self._start = end
+                        break
+                    i = m.start()
+                if buf[i] != 0x7B:  # {
+                    raise ReplyDesyncError(
+                        f"Unexpected data between replies: "
+                        f"{bytes(buf[i:min(end, i + 100)])!r}")
+                self._start = i
+                # 入れ子とエスケープのない応答 (ほとんどの応答) は
+                # 最初の}までの引用符が対になっていれば終わり
+                j = buf.find(b"}", i + 1, end)
+                if (j != -1 and buf.find(b"{", i + 1, j) == -1
+                        and buf.find(b"\\", i + 1, j) == -1
+                        and buf.count(b'"', i + 1, j) % 2 == 0):
+                    pos = j + 1
+                    reply = str(self._mv[i:pos], "utf-8")
+                    self._start = self._pos = pos
+                    return reply
+                depth = 1
+                pos = i + 1
+                continue
+            m = (_INSIDE if in_str else _OUTSIDE).search(buf, pos, end)
+            if m is None:
+                pos = end
+                break
+            i = m.start()
+            c = buf[i]
+            pos = i + 1
+            if in_str:
+                if c == 0x22:  # "
+                    in_str = False
+                elif pos < end:
+                    # バックスラッシュの次の1文字を飛ばす
+                    pos += 1
+                else:
+                    self._escaped = True
+            elif c == 0x22:
+                in_str = True
+            elif c == 0x7B:
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    reply = str(self._mv[self._start:pos], "utf-8")
+                    self._start = self._pos = pos
+                    self._depth = 0
+                    self._in_str = False
+                    return reply
+        self._pos = pos
+        self._depth = depth
+        self._in_str = in_str
+        if self._start == self._end:
+            # すべて消費したので先頭から使う
+            self._start = self._pos = self._end = 0
+        return None
+
+    def read_reply(self, sock: socket.socket) -> str:
+        """応答を1件返す。届いていなければsockから受信して待つ"""
+        while True:
+            reply = self.next_reply()
+            if reply is not None:
+                return reply
+            if self.recv_from(sock) == 0:
+                raise ConnectionError("Connection closed by controller")
@@ -0,0 +1,328 @@
+"""
+control_loopの関節ごとの計算 (360度の規格化、ソフトリミット、
+速度・加速度制限) を、あらかじめ確保した配列上で行う。
+返り値やout引数の配列は呼び出し側の作業領域で、周期ごとに配列を確保しない。
+"""
+from typing import Tuple
+
+import numpy as np
+
+
+def wrap(state: np.ndarray, target: np.ndarray, out: np.ndarray) -> None:
+    """
+    状態値に最も近い目標値に規格化する。
+    out = state + (target - state + 180) % 360 - 180
+    outはstate, targetと別の配列とする
+    """
+    np.subtract(target, state, out=out)
+    np.add(out, 180, out=out)
+    np.remainder(out, 360, out=out)
+    np.subtract(out, 180, out=out)
+    np.add(state, out, out=out)
+
+
+def clip(
+    target: np.ndarray,
+    min_limit: np.ndarray,
+    max_limit: np.ndarray,
+    out: np.ndarray,
+    neq: np.ndarray,
+) -> Tuple[bool, bool]:
+    """
+    ソフトリミットで制限し、下限、上限で制限されたかを返す。
+    上限の判定はcontrol_loopと同じく下限の制限も含めて比較する。
+    neqは作業用のboolの配列
+    """
+    np.maximum(target, min_limit, out=out)
+    hit_min = np.count_nonzero(np.not_equal(target, out, out=neq)) > 0
+    np.minimum(out, max_limit, out=out)
+    hit_max = np.count_nonzero(np.not_equal(target, out, out=neq)) > 0
+    return hit_min, hit_max
+
+
+class MaxReducer:
+    """
+    配列の最大値を、あらかじめ作ったビューの間のnp.maximumの
+    トーナメントで求める。np.maxは小さな配列でも縮約のための
+    一時領域を確保するため。最大値の選択なので結果はnp.maxと同じ。
+    bufの中身は呼び出すたびに読み直す
+    """
+    def __init__(self, buf: np.ndarray) -> None:
+        # 長さが奇数のときは前半と後半を1要素重ねて比べる。
+        # 入力と出力が重なるとnumpyが一時的な複製を作るので、段ごとに出力を分ける
+        self.ops = []
+        cur = buf
+        while len(cur) > 1:
+            h = (len(cur) + 1) // 2
+            nxt = np.zeros(h)
+            self.ops.append((cur[:h], cur[len(cur) - h:], nxt))
+            cur = nxt
+        self.result = cur
+
+    def __call__(self) -> float:
+        for a, b, out in self.ops:
+            np.maximum(a, b, out=out)
+        return self.result[0]
+
+
+class JointLimiter:
+    """
+    速度・加速度制限。全関節を同じ比率で制限して関節間の同期を保つ。
+    jerk_limitsを指定した場合は加加速度の制限に対する比率も計算する
+    (制限はしない)
+    """
+    def __init__(
+        self,
+        speed_limits: float | np.ndarray,
+        accel_limits: float | np.ndarray,
+        stopped_velocity_eps: float = 1e-4,
+        jerk_limits: np.ndarray | None = None,
+        n_dims: int = 6,
+    ) -> None:
+        """
+        speed_limits, accel_limits, jerk_limits: 比率を掛けた後の制限
+        """
+        self.speed_limits = speed_limits
+        self.accel_limits = accel_limits
+        self.stopped_velocity_eps = stopped_velocity_eps
+        self.jerk_limits = jerk_limits
+        self.last_velocity = np.zeros(n_dims)
+        self.last_accel = np.zeros(n_dims)
+        self._v = np.zeros(n_dims)
+        self._a = np.zeros(n_dims)
+        self._tmp = np.zeros(n_dims)
+        self._lt = np.zeros(n_dims, dtype=bool)
+        self._max = MaxReducer(self._tmp)
+        self.max_ratio = 0.0
+        self.accel_max_ratio = 0.0
+        self.jerk_max_ratio = 0.0
+
+    def reset(self) -> None:
+        self.last_velocity.fill(0)
+        self.last_accel.fill(0)
+
+    def limit(self, diff: np.ndarray, dt: float, out: np.ndarray) -> None:
+        """
+        1周期の差分diffを制限してoutに書き込む。outはdiffと同じ配列でもよい。
+        制限に対する最大の比率はmax_ratio, accel_max_ratio, jerk_max_ratioに残す
+        """
+        v, a, tmp = self._v, self._a, self._tmp
+        last_velocity = self.last_velocity
+
+        # 速度制限
+        np.divide(diff, dt, out=v)
+        np.abs(v, out=tmp)
+        np.divide(tmp, self.speed_limits, out=tmp)
+        max_ratio = self._max()
+        if max_ratio > 1:
+            np.divide(v, max_ratio, out=v)
+
+        # 加速度制限
+        np.subtract(v, last_velocity, out=a)
+        np.divide(a, dt, out=a)
+        np.abs(a, out=tmp)
+        np.divide(tmp, self.accel_limits, out=tmp)
+        accel_max_ratio = self._max()
+        if accel_max_ratio > 1:
+            np.divide(a, accel_max_ratio, out=a)
+
+        # 加加速度の制限に対する比率
+        if self.jerk_limits is not None:
+            np.subtract(a, self.last_accel, out=tmp)
+            np.divide(tmp, dt, out=tmp)
+            np.abs(tmp, out=tmp)
+            np.divide(tmp, self.jerk_limits, out=tmp)
+            self.jerk_max_ratio = self._max()
+
+        np.multiply(a, dt, out=a)
+        np.add(last_velocity, a, out=v)
+        np.multiply(v, dt, out=out)
+
+        # 速度がしきい値より小さければ静止させ無駄なドリフトを避ける
+        # NOTE: スレーブモードを落とさないためには前の速度が十分小さいとき (しきい値は不明)
+        # にしか静止させてはいけない
+        np.divide(out, dt, out=tmp)
+        if np.count_nonzero(
+                np.less(tmp, self.stopped_velocity_eps, out=self._lt)) == len(tmp):
+            out.fill(0)
+            v.fill(0)
+
+        if self.jerk_limits is not None:
+            # 静止させた場合も含めて実際の加速度を次の周期の基準にする
+            np.subtract(v, last_velocity, out=self.last_accel)
+            np.divide(self.last_accel, dt, out=self.last_accel)
+        np.copyto(last_velocity, v)
+        self.max_ratio = max_ratio
+        self.accel_max_ratio = accel_max_ratio
+
+
+# 以下は同じ計算を6要素程度の小さなベクトル向けにPythonのfloatで行うもの。
+# numpyの関数呼び出しのオーバーヘッドが計算より大きいため。
+# 引数はnumpyの配列のmemoryviewかfloatのリストとし、
+# 要素ごとの演算の順序をnumpy版と同じにしてビット単位で同じ結果にする
+
+
+class JerkMeter:
+    """
+    ロボットに送った差分 (1周期の移動量) の加加速度の、制限に対する最大の比率。
+    制限はしない。ロボットは1つのservo_jを制御周期 (t_intv) で動くので、
+    差分の2階差分をt_intvの3乗で割ったものを加加速度とする
+    """
+    def __init__(
+        self,
+        jerk_limits: np.ndarray,
+        t_intv: float,
+        n_dims: int = 6,
+    ) -> None:
+        """jerk_limits: 比率を掛けた後の制限"""
+        self.jerk_limits = jerk_limits
+        self.t_intv = t_intv
+        # 差分の2階差分の制限
+        self._limits = np.asarray(jerk_limits, dtype=float) * t_intv ** 3
+        self.last_diff = np.zeros(n_dims)
+        self.last_diff2 = np.zeros(n_dims)
+        self._d2 = np.zeros(n_dims)
+        self._tmp = np.zeros(n_dims)
+        self._max = MaxReducer(self._tmp)
+        self.jerk_max_ratio = 0.0
+
+    def reset(self) -> None:
+        """静止した状態から始める"""
+        self.last_diff.fill(0)
+        self.last_diff2.fill(0)
+        self.jerk_max_ratio = 0.0
+
+    def measure(self, diff: np.ndarray) -> float:
+        """送った差分diffを記録し、加加速度の比率を返す (jerk_max_ratioにも残す)"""
+        d2, tmp = self._d2, self._tmp
+        np.subtract(diff, self.last_diff, out=d2)
+        np.subtract(d2, self.last_diff2, out=tmp)
+        np.abs(tmp, out=tmp)
+        np.divide(tmp, self._limits, out=tmp)
+        self.jerk_max_ratio = self._max()
+        np.copyto(self.last_diff, diff)
+        # 入れ替えて次の周期の基準にする
+        self._d2, self.last_diff2 = self.last_diff2, d2
+        return self.jerk_max_ratio
+
+
+def wrap_py(state, target, out) -> None:
+    """wrapのPython版"""
+    for i in range(len(out)):
+        s = state[i]
+        out[i] = s + ((target[i] - s + 180) % 360 - 180)
+
+
+def clip_py(target, min_limit, max_limit, out) -> Tuple[bool, bool]:
+    """clipのPython版。min_limit, max_limitはfloatのリスト"""
+    hit_min = hit_max = False
+    for i in range(len(out)):
+        x = target[i]
+        y = min_limit[i] if x < min_limit[i] else x
+        hit_min |= y != x
+        if y > max_limit[i]:
+            y = max_limit[i]
+        hit_max |= y != x
+        out[i] = y
+    return hit_min, hit_max
+
+
+class PyJointLimiter:
+    """JointLimiterのPython版"""
+    def __init__(
+        self,
+        speed_limits: float | np.ndarray,
+        accel_limits: float | np.ndarray,
+        stopped_velocity_eps: float = 1e-4,
+        jerk_limits: np.ndarray | None = None,
+        n_dims: int = 6,
+    ) -> None:
+        """
+        speed_limits, accel_limits, jerk_limits: 比率を掛けた後の制限
+        """
+        as_list = lambda x: np.broadcast_to(  # noqa: E731
+            np.asarray(x, dtype=float), (n_dims,)).tolist()
+        self.n_dims = n_dims
+        self.speed_limits = as_list(speed_limits)
+        self.accel_limits = as_list(accel_limits)
+        self.stopped_velocity_eps = stopped_velocity_eps
+        self.jerk_limits = None
+        if jerk_limits is not None:
+            self.jerk_limits = as_list(jerk_limits)
+        self.last_velocity = [0.0] * n_dims
+        self.last_accel = [0.0] * n_dims
+        self._v = [0.0] * n_dims
+        self._a = [0.0] * n_dims
+        self.max_ratio = 0.0
+        self.accel_max_ratio = 0.0
+        self.jerk_max_ratio = 0.0
+
+    def reset(self) -> None:
+        for i in range(self.n_dims):
+            self.last_velocity[i] = 0.0
+            self.last_accel[i] = 0.0
+
+    def limit(self, diff, dt: float, out) -> None:
+        """
+        1周期の差分diffを制限してoutに書き込む。outはdiffと同じでもよい。
+        制限に対する最大の比率はmax_ratio, accel_max_ratio, jerk_max_ratioに残す
+        """
+        n = self.n_dims
+        v, a = self._v, self._a
+        last_velocity, last_accel = self.last_velocity, self.last_accel
+        speed_limits, accel_limits = self.speed_limits, self.accel_limits
+
+        # 速度制限
+        max_ratio = 0.0
+        for i in range(n):
+            x = diff[i] / dt
+            v[i] = x
+            r = abs(x) / speed_limits[i]
+            if i == 0 or r > max_ratio:
+                max_ratio = r
+        if max_ratio > 1:
+            for i in range(n):
+                v[i] = v[i] / max_ratio
+
+        # 加速度制限
+        accel_max_ratio = 0.0
+        for i in range(n):
+            x = (v[i] - last_velocity[i]) / dt
+            a[i] = x
+            r = abs(x) / accel_limits[i]
+            if i == 0 or r > accel_max_ratio:
+                accel_max_ratio = r
+        if accel_max_ratio > 1:
+            for i in range(n):
+                a[i] = a[i] / accel_max_ratio
+
+        # 加加速度の制限に対する比率
+        jerk_limits = self.jerk_limits
+        if jerk_limits is not None:
+            jerk_max_ratio = 0.0
+            for i in range(n):
+                r = abs((a[i] - last_accel[i]) / dt) / jerk_limits[i]
+                if i == 0 or r > jerk_max_ratio:
+                    jerk_max_ratio = r
+            self.jerk_max_ratio = jerk_max_ratio
+
+        # 速度がしきい値より小さければ静止させ無駄なドリフトを避ける
+        eps = self.stopped_velocity_eps
+        stopped = True
+        for i in range(n):
+            x = last_velocity[i] + a[i] * dt
+            v[i] = x
+            d = x * dt
+            out[i] = d
+            stopped &= d / dt < eps
+        if stopped:
+            for i in range(n):
+                out[i] = 0.0
+                v[i] = 0.0
+
+        for i in range(n):
+            if jerk_limits is not None:
+                last_accel[i] = (v[i] - last_velocity[i]) / dt
+            last_velocity[i] = v[i]
+        self.max_ratio = max_ratio
+        self.accel_max_ratio = accel_max_ratio
@@ -0,0 +1,184 @@
+import json
+import math
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from .config import LATENCY_SHM_NAME, LATENCY_SHM_VERSION, SHM_HEADER_FIELDS
+from .shm import attach_shm, create_shm
+
+
+# 制御ループの処理区間
+LATENCY_PHASES: List[str] = [
+    # 締め切りから実際に起床するまでの遅れ
+    "wakeup",
+    # 共有メモリからの状態値、目標値の取得
+    "snapshot",
+    # 360度の規格化とソフトリミット
+    "wrap_clip",
+    # DelayedInterpolator.read
+    "interp",
+    # フィルタ手前の速度・加速度制限
+    "pre_limiter",
+    # 平滑化
+    "filter",
+    # フィルタ後の速度・加速度制限
+    "limiter",
+    # 記録用のリングバッファへの書き込み
+    "archive_put",
+    # servo_jの呼び出し (パイプラインでは送信のみ、でなければ応答まで)
+    "servo_j",
+    # パイプラインでのservo_jの送信から応答まで (jkrcの受信スレッドが記録する)
+    "servo_j_reply",
+    # 起床から周期の処理の終わりまで
+    "cycle",
+    # 前回のservo_jの送信からの実際の間隔 (起床の揺らぎを含む)。
+    # 速度・加速度制限と平滑化には使わず、締め切りの間隔を使う
+    "send_interval",
+    # 以下は処理時間ではなく、静止から動き出すときのプロセスをまたいだ遅延
+    # (stream_timing.MotionLatency)
+    # VRの目標値の受信からservo_jの送信まで (補間の遅延を含む)
+    "target_to_servo_j",
+    # servo_jの送信からフィードバックの状態値が動くまで
+    "servo_j_to_motion",
+    # VRの目標値の受信からフィードバックの状態値が動くまで
+    "target_to_motion",
+    # 以下はMQTTの受信プロセスが記録する (clock_sync.ClockSync)
+    # ゴーグルとのping/pongの往復の遅延
+    "mqtt_rtt",
+    # 制御メッセージの送信 (ゴーグル) から受信までの片道の遅延。送信時刻がある場合のみ
+    "mqtt_one_way",
+    # 片道の遅延のうち、最小の往復の遅延の半分を超えた分 (ブローカーなどでの滞留)
+    "mqtt_broker",
+]
+# 1 us未満を最初のビンにまとめ、以降は1オクターブを4分割した対数ビン
+# 最後のビンは約1 s以上をまとめる
+N_SUB_BUCKETS = 4
+N_OCTAVES = 20
+N_BUCKETS = 2 + N_OCTAVES * N_SUB_BUCKETS
+MIN_NS = 1000
+
+
+def bucket_upper_ns(i: int) -> float:
+    """ビンiに入る値の上限 (ns)"""
+    if i == 0:
+        return MIN_NS
+    if i == N_BUCKETS - 1:
+        return math.inf
+    return MIN_NS * 2 ** (i / N_SUB_BUCKETS)
+
+
+# 処理区間ごとのヒストグラムと件数、合計、最大 (ns)
+LATENCY_SHM_DTYPE = np.dtype(SHM_HEADER_FIELDS + [
+    ("counts", "<i8", (len(LATENCY_PHASES), N_BUCKETS)),
+    ("count", "<i8", (len(LATENCY_PHASES),)),
+    ("sum_ns", "<i8", (len(LATENCY_PHASES),)),
+    ("max_ns", "<i8", (len(LATENCY_PHASES),)),
+], align=True)
+
+
+class LatencyHistograms:
+    """
+    処理区間ごとの処理時間の対数ヒストグラム。
+    共有メモリ上に固定サイズで置くので、制御プロセス以外
+    (GUIなど) からも読み出せる。書き込むのは処理区間ごとに1プロセスのみとする。
+    """
+    def __init__(self, create: bool = False) -> None:
+        self.phases = LATENCY_PHASES
+        self.n_phases = len(self.phases)
+        self.phase_index = {p: i for i, p in enumerate(self.phases)}
+        # 以前の形式の共有メモリが残っていれば作成時は作り直し、
+        # 接続時はShmSchemaErrorを送出する
+        if create:
+            self.sm, ar = create_shm(
+                LATENCY_SHM_NAME, LATENCY_SHM_DTYPE, LATENCY_SHM_VERSION)
+        else:
+            self.sm, ar = attach_shm(
+                LATENCY_SHM_NAME, LATENCY_SHM_DTYPE, LATENCY_SHM_VERSION)
+        # 配列のフィールドは共有メモリのビュー
+        self.counts = ar["counts"]
+        self.count = ar["count"]
+        self.sum_ns = ar["sum_ns"]
+        self.max_ns = ar["max_ns"]
+
+    def reset(self) -> None:
+        for a in [self.counts, self.count, self.sum_ns, self.max_ns]:
+            a[...] = 0
+
+    def record(self, phase: int, ns: int) -> None:
+        """phase (LATENCY_PHASESのインデックス) の処理時間nsを記録する"""
+        if ns < MIN_NS:
+            i = 0
+        else:
+            i = 1 + int(math.log2(ns / MIN_NS) * N_SUB_BUCKETS)
+            if i >= N_BUCKETS:
+                i = N_BUCKETS - 1
+        self.counts[phase, i] += 1
+        self.count[phase] += 1
+        self.sum_ns[phase] += ns
+        if ns > self.max_ns[phase]:
+            self.max_ns[phase] = ns
+
+    def lap(self, phase: int, t_start_ns: int) -> int:
+        """t_start_nsから現在までをphaseとして記録し、現在の時刻 (ns) を返す"""
+        t_ns = time.perf_counter_ns()
+        self.record(phase, t_ns - t_start_ns)
+        return t_ns
+
+    def summary(
+        self,
+        percentiles: List[float] = [50, 90, 99, 99.9],
+        phases: List[str] | None = None,
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        区間ごとの件数、平均、パーセンタイル、最大 (us) を返す。
+        パーセンタイルはビンの上限で表すので実際より最大2割程度大きい。
+        phases: 返す区間。Noneですべて
+        """
+        counts = self.counts.copy()
+        count = self.count.copy()
+        sum_ns = self.sum_ns.copy()
+        max_ns = self.max_ns.copy()
+        ret = {}
+        for p, phase in enumerate(self.phases):
+            if phases is not None and phase not in phases:
+                continue
+            n = int(count[p])
+            s = {"count": n}
+            if n > 0:
+                s["mean_us"] = float(sum_ns[p]) / n / 1000
+                cum = np.cumsum(counts[p])
+                for q in percentiles:
+                    i = int(np.searchsorted(cum, n * q / 100))
+                    i = min(i, N_BUCKETS - 1)
+                    # 上限のない最後のビンは最大値で代用
+                    upper = min(bucket_upper_ns(i), float(max_ns[p]))
+                    s[f"p{q:g}_us"] = upper / 1000
+                s["max_us"] = float(max_ns[p]) / 1000
+            ret[phase] = s
+        return ret
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "bucket_upper_us": [
+                bucket_upper_ns(i) / 1000 for i in range(N_BUCKETS - 1)
+            ] + [None],
+            "counts": {
+                phase: self.counts[p].tolist()
+                for p, phase in enumerate(self.phases)
+            },
+            "summary": self.summary(),
+        }
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def close(self) -> None:
+        # 共有メモリのビューを先に手放す
+        del self.counts, self.count, self.sum_ns, self.max_ns
+        self.sm.close()
+
+    def unlink(self) -> None:
+        self.sm.unlink()
@@ -0,0 +1,121 @@
+"""
+VRからの目標値の受け渡し。MQTTの受信スレッド (on_message) は復号した目標値を
+TargetMailboxに置くだけにし、取り込みのスレッドが最新の1件だけを共有メモリに書く。
+WANの途切れの後にブローカーから溜まったメッセージがまとめて届いた場合も、
+古い目標値を1件ずつ共有メモリに書かずに最新のものにまとめる。
+送信側の通し番号があれば、順序が入れ替わって届いた古いメッセージを捨てる。
+送信時刻は、ping/pongで推定したゴーグルとの時計のずれ (clock_sync.ClockSync) で
+受信側の時刻に換算する。
+"""
+import threading
+from typing import Any, NamedTuple
+
+from .clock_sync import ClockSync
+
+SEQ_MASK = 0xFFFFFFFF
+SEQ_HALF = 0x80000000
+
+
+class MailTarget(NamedTuple):
+    # 関節の目標値
+    joints: Any
+    # 目標値の時刻 (time.monotonic_ns)。送信時刻があり時計のずれを推定できていれば
+    # 換算した送信時刻 (受信時刻以前)、なければ受信時刻
+    t_ns: int
+    # 受信時刻 (time.monotonic_ns)
+    recv_ns: int
+    # 受信したメッセージ (GUIへの表示用)
+    payload: bytes
+
+
+class TargetMailbox:
+    """
+    最新の目標値1件の置き場所。置くスレッド、取り出すスレッドはそれぞれ1つとする。
+    数える値 (共有メモリのtarget_*に書き出す):
+    - n_coalesced: 取り出される前に次の目標値で上書きされた数
+    - n_reordered: 前に受け付けたものより古い (同じ) 通し番号で届き、捨てた数
+    - n_dropped: 通し番号の飛びから数えた届かなかった数。遅れて届いたものは除く
+    """
+    def __init__(
+        self,
+        reorder_window: int = 1024,
+        clock: ClockSync | None = None,
+    ) -> None:
+        """
+        reorder_window: 通し番号がこの数より大きく戻った場合は
+        送信側が再起動したとみなして受け付ける
+        clock: 送信時刻の換算に使うゴーグルとの時計のずれの推定。
+        Noneでは送信時刻を使わず受信時刻を目標値の時刻とする
+        """
+        self.reorder_window = reorder_window
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._target = None
+        self._last_seq = None
+        self.n_received = 0
+        self.n_coalesced = 0
+        self.n_reordered = 0
+        self.n_dropped = 0
+
+    def put(
+        self,
+        joints,
+        recv_ns: int,
+        payload: bytes,
+        seq: int | None = None,
+        sender_time_ns: int | None = None,
+    ) -> bool:
+        """目標値を置く。古い通し番号で捨てた場合はFalseを返す"""
+        with self._lock:
+            self.n_received += 1
+            if seq is not None:
+                if not self._accept_seq(seq):
+                    self.n_reordered += 1
+                    return False
+            t_ns = recv_ns
+            clock = self.clock
+            if (sender_time_ns is not None and clock is not None
+                    and clock.offset_ns is not None):
+                # 経路の非対称さによる推定の誤差で受信時刻より後にはしない
+                t_ns = min(clock.to_local(sender_time_ns), recv_ns)
+            if self._target is not None:
+                self.n_coalesced += 1
+            self._target = MailTarget(joints, t_ns, recv_ns, payload)
+        self._event.set()
+        return True
+
+    def _accept_seq(self, seq: int) -> bool:
+        last = self._last_seq
+        if last is not None:
+            d = (seq - last) & SEQ_MASK
+            if d == 0:
+                # 重複
+                return False
+            if d >= SEQ_HALF:
+                if SEQ_MASK + 1 - d <= self.reorder_window:
+                    # 飛びとして数えたものが遅れて届いた
+                    if self.n_dropped > 0:
+                        self.n_dropped -= 1
+                    return False
+                # 送信側の再起動。時計も変わりうるので推定し直す
+                if self.clock is not None:
+                    self.clock.reset()
+            else:
+                self.n_dropped += d - 1
+        self._last_seq = seq
+        return True
+
+    def take(self, timeout: float | None = None) -> MailTarget | None:
+        """最新の目標値を取り出す。timeout秒待っても置かれなければNoneを返す"""
+        if not self._event.wait(timeout):
+            return None
+        with self._lock:
+            self._event.clear()
+            target = self._target
+            self._target = None
+        return target
+
+    def wake(self) -> None:
+        """取り出し側を (終了のために) 起こす"""
+        self._event.set()
@@ -0,0 +1,114 @@
+"""
+プロセス間の起床の通知。共有メモリの値やフラグを書いたプロセスがnotifyし、
+それを待つプロセスはsleepで周期的に確認する代わりにwaitで眠る。
+eventfd (Linux) を使い、なければpipeを使う。
+
+通知は数えずにまとめて1回として読み出すので、待つ側は起きたら
+共有メモリの値を確認する。1つのNotifierを待つプロセスは1つとし、
+待つプロセスごとにチャンネルを分ける (Notifiers)。
+forkで起動したプロセスはファイル記述子をそのまま引き継ぐ。
+spawnなどで起動する場合は、Processの引数として渡せば複製される。
+"""
+import os
+import select
+
+from multiprocessing import context, reduction
+
+
+# 通知を待つプロセス (スレッド) ごとのチャンネル
+# control: 制御プロセス (状態値・目標値の受信、停止、ログファイルの変更、終了)
+# archiver: 制御の記録プロセス (ログファイルの変更、終了)
+# mqtt: MQTTの受信プロセス (終了)
+# main: GUI (各プロセスのログファイルの変更の完了)
+NOTIFY_CHANNELS = ["control", "archiver", "mqtt", "main"]
+
+
+class Notifier:
+    def __init__(self) -> None:
+        if hasattr(os, "eventfd"):
+            self.kind = "eventfd"
+            fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._rfd = self._wfd = fd
+        else:
+            self.kind = "pipe"
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+        self._setup_poll()
+
+    def _setup_poll(self) -> None:
+        self._poll = select.poll()
+        self._poll.register(self._rfd, select.POLLIN)
+
+    def fileno(self) -> int:
+        """multiprocessing.connection.waitなどで他と一緒に待つため"""
+        return self._rfd
+
+    def notify(self) -> None:
+        try:
+            if self.kind == "eventfd":
+                os.eventfd_write(self._wfd, 1)
+            else:
+                os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            # pipeが一杯の場合は既に通知が溜まっている
+            pass
+
+    def clear(self) -> bool:
+        """溜まっている通知を読み捨て、通知があったかを返す"""
+        if self.kind == "eventfd":
+            try:
+                os.eventfd_read(self._rfd)
+            except BlockingIOError:
+                return False
+            return True
+        notified = False
+        while True:
+            try:
+                os.read(self._rfd, 4096)
+            except BlockingIOError:
+                return notified
+            notified = True
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        通知があるかtimeout秒経つまで待つ。通知があればTrueを返す。
+        待つ前に溜まっていた通知もここで読み捨てる
+        """
+        if self.clear():
+            return True
+        ms = None if timeout is None else max(int(timeout * 1000), 0)
+        if not self._poll.poll(ms):
+            return False
+        return self.clear()
+
+    def close(self) -> None:
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
+
+    def __getstate__(self):
+        if context.get_spawning_popen() is None:
+            raise TypeError(
+                "Notifier can only be passed to a process when starting it")
+        wfd = None
+        if self._wfd != self._rfd:
+            wfd = reduction.DupFd(self._wfd)
+        return self.kind, reduction.DupFd(self._rfd), wfd
+
+    def __setstate__(self, state) -> None:
+        self.kind, rfd, wfd = state
+        self._rfd = rfd.detach()
+        self._wfd = self._rfd if wfd is None else wfd.detach()
+        self._setup_poll()
+
+
+class Notifiers:
+    """NOTIFY_CHANNELSのチャンネルごとのNotifier"""
+    def __init__(self) -> None:
+        for name in NOTIFY_CHANNELS:
+            setattr(self, name, Notifier())
+
+    def close(self) -> None:
+        for name in NOTIFY_CHANNELS:
+            getattr(self, name).close()
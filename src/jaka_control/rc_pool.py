@@ -0,0 +1,156 @@
+"""
+コントローラー (TCP API) への役割ごとの接続。
+1つの接続ではコマンドがRCのロックで順に送受信されるので、別スレッドの状態の問い合わせや
+clear_errorが次のservo_jを往復の時間だけ止める。servo_j専用の接続を分け、
+問い合わせと通常の移動は別の接続で送る。
+"""
+import logging
+import threading
+from typing import Any, Dict, Tuple
+
+from .jkrc import RC
+from .jkrc_reply import ReplyDesyncError
+
+# 役割
+# "servo": スレーブモードの切り替えとservo_j
+# "query": 状態の問い合わせ (何度送っても同じなので、接続し直して送り直してよい)
+# "motion": 電源、有効化、エラーの解除と通常の移動
+RC_ROLES: Tuple[str, ...] = ("servo", "query", "motion")
+
+# 接続し直せば回復しうるエラー
+CONNECTION_ERRORS = (OSError, ReplyDesyncError)
+
+
+class RCPool:
+    """
+    役割ごとのRCの接続。接続が切れた (エラーになった) ら、その接続だけ
+    ログインし直す。queryのコマンドは接続し直した後に1回だけ送り直す。
+    shared=Trueでは全役割で1つの接続を使う (以前の動作)
+    """
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        shared: bool = False,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+        self.shared = shared
+        if shared:
+            rc = RC(ip=ip, port=port)
+            self.clients: Dict[str, RC] = {role: rc for role in RC_ROLES}
+        else:
+            self.clients = {role: RC(ip=ip, port=port) for role in RC_ROLES}
+        self._locks = {role: threading.Lock() for role in self._roles()}
+        self.n_relogins = {role: 0 for role in self._roles()}
+        self._health_thread = None
+        self._health_interval = None
+        self._health_stop = threading.Event()
+
+    def _roles(self) -> Tuple[str, ...]:
+        # 実際の接続ごとに1つの役割
+        return RC_ROLES[:1] if self.shared else RC_ROLES
+
+    def __getitem__(self, role: str) -> RC:
+        return self.clients[role]
+
+    def login(self) -> None:
+        """すべての接続でログインする。接続済みなら接続し直す"""
+        # 確認のスレッドのログインし直しと重ならないよう、動いていれば止めておく
+        interval = self._health_interval
+        running = self._health_thread is not None
+        self.stop_health_monitor()
+        for role in self._roles():
+            with self._locks[role]:
+                self.clients[role].login()
+        if running:
+            self.start_health_monitor(interval)
+
+    def logout(self) -> None:
+        self.stop_health_monitor()
+        for role in self._roles():
+            self.clients[role].logout()
+
+    def relogin(self, role: str) -> None:
+        """roleの接続だけログインし直す"""
+        if self.shared:
+            role = RC_ROLES[0]
+        with self._locks[role]:
+            self.clients[role].login()
+            self.n_relogins[role] += 1
+        self.logger.info(f"Logged in again on the {role} connection")
+
+    def call(self, role: str, name: str, *args, **kwargs) -> Any:
+        """
+        roleの接続でRCのメソッドnameを呼ぶ。
+        接続のエラーではログインし直し、queryの場合だけ1回送り直す
+        """
+        client = self.clients[role]
+        if not client.connected:
+            self.relogin(role)
+        try:
+            return getattr(client, name)(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            self.logger.warning(
+                f"Error on the {role} connection in {name}: {e!r}")
+            self.relogin(role)
+            if role != "query":
+                raise
+        return getattr(client, name)(*args, **kwargs)
+
+    def check_health(self) -> Dict[str, bool]:
+        """
+        servo以外の接続で状態を問い合わせ、応答がなければログインし直す。
+        servoの接続はservo_jの送信を遅らせないよう確かめない
+        (エラーはservo_jで、往復の時間はRC.telemetryで分かる)
+        """
+        ret = {}
+        for role in self._roles():
+            if role == "servo" and not self.shared:
+                continue
+            client = self.clients[role]
+            if self.shared and client.servo_pipelined:
+                continue
+            try:
+                # エラーコードによらず応答があれば接続は生きている
+                ok = client.connected
+                if ok:
+                    client.get_robot_state()
+            except CONNECTION_ERRORS as e:
+                self.logger.warning(
+                    f"Health check failed on the {role} connection: {e!r}")
+                ok = False
+            if not ok:
+                try:
+                    self.relogin(role)
+                except CONNECTION_ERRORS as e:
+                    self.logger.error(
+                        f"Could not log in again on the {role} "
+                        f"connection: {e!r}")
+            ret[role] = ok
+        return ret
+
+    def start_health_monitor(self, interval: float = 5.0) -> None:
+        """interval秒ごとにcheck_healthを呼ぶスレッドを開始する"""
+        if self._health_thread is not None:
+            return
+        self._health_stop.clear()
+        self._health_interval = interval
+        self._health_thread = threading.Thread(
+            target=self._health_loop, args=(interval,),
+            name="rc_health", daemon=True)
+        self._health_thread.start()
+
+    def stop_health_monitor(self) -> None:
+        if self._health_thread is None:
+            return
+        self._health_stop.set()
+        self._health_thread.join()
+        self._health_thread = None
+
+    def _health_loop(self, interval: float) -> None:
+        while not self._health_stop.wait(interval):
+            try:
+                self.check_health()
+            except Exception:
+                self.logger.exception("Error in health check")
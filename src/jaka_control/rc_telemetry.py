@@ -0,0 +1,108 @@
+"""
+RC (TCP API) のコマンドごとの往復の時間とエラーの集計。
+コントローラーとの通信が劣化しているか (スレーブモードが切れる前に) を見るためと、
+ベンチマークで遅延を通信と自前の処理に分けるために使う。
+"""
+import logging
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+
+class CommandStats:
+    """1つのcmdNameの集計。往復の時間は最近n_windows件から分位点を求める"""
+    def __init__(self, n_windows: int) -> None:
+        self.rtt_ns = np.zeros(n_windows, dtype=np.int64)
+        self.count = 0
+        self.max_ns = 0
+        # エラーコード (0以外) ごとの件数。応答をパースできなければ-1
+        self.errors: Dict[int, int] = {}
+        self.timeouts = 0
+
+    def record(self, rtt_ns: int, ec: int) -> None:
+        self.rtt_ns[self.count % len(self.rtt_ns)] = rtt_ns
+        self.count += 1
+        if rtt_ns > self.max_ns:
+            self.max_ns = rtt_ns
+        if ec != 0:
+            self.errors[ec] = self.errors.get(ec, 0) + 1
+
+
+class RCTelemetry:
+    """
+    cmdNameごとの往復の時間 (送信から応答の受信まで、perf_counter_ns)、
+    エラーコードとタイムアウトの件数。
+    記録するスレッドはcmdNameごとに同時に1つとする (RCでは送受信のロックの中か
+    servo_jのパイプラインの受信スレッド)
+    """
+    def __init__(
+        self,
+        n_windows: int = 1024,
+        log_interval: float | None = 60,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        """
+        n_windows: 分位点を求める最近の件数
+        log_interval: 集計をログに出す間隔 (秒)。Noneで出さない
+        """
+        self.n_windows = n_windows
+        self.commands: Dict[str, CommandStats] = {}
+        self.logger = logger or logging.getLogger(__name__)
+        self.log_interval_ns = (
+            None if log_interval is None else int(log_interval * 1e9))
+        self._next_log_ns = time.perf_counter_ns() + (self.log_interval_ns or 0)
+
+    def _stats(self, cmd: str) -> CommandStats:
+        stats = self.commands.get(cmd)
+        if stats is None:
+            stats = self.commands[cmd] = CommandStats(self.n_windows)
+        return stats
+
+    def record(self, cmd: str, t_send_ns: int, t_recv_ns: int, ec: int) -> None:
+        self._stats(cmd).record(t_recv_ns - t_send_ns, ec)
+        if self.log_interval_ns is not None and t_recv_ns >= self._next_log_ns:
+            self._next_log_ns = t_recv_ns + self.log_interval_ns
+            self.log()
+
+    def record_timeout(self, cmd: str) -> None:
+        self._stats(cmd).timeouts += 1
+
+    def summary(
+        self,
+        percentiles: List[float] = [50, 90, 99],
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        cmdNameごとの件数、最近n_windows件の往復の時間の分位点と
+        全体の最大 (ms)、エラーコードごとの件数、タイムアウトの件数を返す
+        """
+        ret = {}
+        for cmd, stats in list(self.commands.items()):
+            n = min(stats.count, self.n_windows)
+            d = {"count": stats.count}
+            if n > 0:
+                values = np.percentile(stats.rtt_ns[:n], percentiles) / 1e6
+                for p, v in zip(percentiles, values):
+                    d[f"p{p:g}"] = float(v)
+            d["max"] = stats.max_ns / 1e6
+            d["errors"] = dict(stats.errors)
+            d["timeouts"] = stats.timeouts
+            ret[cmd] = d
+        return ret
+
+    def format_summary(self) -> str:
+        lines = []
+        for cmd, d in self.summary().items():
+            s = f"{cmd}: {d['count']} replies"
+            if "p50" in d:
+                s += (f", round trip p50 {d['p50']:.3f} ms, "
+                      f"p99 {d['p99']:.3f} ms, max {d['max']:.3f} ms")
+            if d["errors"]:
+                s += f", errors {d['errors']}"
+            if d["timeouts"]:
+                s += f", {d['timeouts']} timeouts"
+            lines.append(s)
+        return "; ".join(lines)
+
+    def log(self) -> None:
+        self.logger.info(f"Controller commands: {self.format_summary()}")
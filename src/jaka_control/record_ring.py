@@ -0,0 +1,127 @@
+from typing import Dict, List
+
+import numpy as np
+
+from .config import (
+    N_JOINTS, RECORD_RING_SHM_NAME, RECORD_RING_SHM_VERSION, SHM_HEADER_FIELDS
+)
+from .shm import attach_shm, create_shm
+
+
+# 記録の種類。control.jsonlの"kind"
+RECORD_KINDS: List[str] = ["target", "target_delayed", "control"]
+KIND_TARGET, KIND_TARGET_DELAYED, KIND_CONTROL = range(len(RECORD_KINDS))
+# 記録はfloat64の固定長で、[時刻, 種類, 関節 (6), 種類ごとの値 (3)]
+F_TIME = 0
+F_KIND = 1
+F_JOINT = slice(2, 2 + N_JOINTS)
+F_EXTRA = 2 + N_JOINTS
+RECORD_SIZE = F_EXTRA + 3
+# 種類ごとの値の名前
+RECORD_EXTRAS: Dict[int, List[str]] = {
+    KIND_TARGET: [],
+    KIND_TARGET_DELAYED: ["delay"],
+    KIND_CONTROL: ["max_ratio", "accel_max_ratio", "jerk_max_ratio"],
+}
+# 記録の数。1周期3件で約20秒分
+CAPACITY = 8192
+# 件数 (int64): [書き込み済みの件数, 読み出し済みの件数, 溢れた件数]
+H_WRITE, H_READ, H_OVERFLOWS = range(3)
+
+
+def record_ring_dtype(capacity: int = CAPACITY) -> np.dtype:
+    """容量capacityのリングバッファの共有メモリの形式"""
+    return np.dtype(SHM_HEADER_FIELDS + [
+        ("counters", "<i8", (3,)),
+        ("records", "<f8", (capacity, RECORD_SIZE)),
+    ], align=True)
+
+
+class RecordRing:
+    """
+    制御プロセスから記録プロセスへ制御の記録を渡す共有メモリ上のリングバッファ。
+    書き込むプロセスと読み出すプロセスはそれぞれ1つとし、ロックは使わない。
+    件数は単調に増やし、位置は容量の剰余で求める。
+    書き込み側はデータを書いてから書き込み済みの件数を、
+    読み出し側はデータを読んでから読み出し済みの件数を更新する。
+    空きが足りない場合は待たずに捨て、溢れた件数に数える
+    """
+    def __init__(self, create: bool = False, capacity: int = CAPACITY) -> None:
+        """
+        capacity: 記録の数。接続時は作成時と同じ値を与える。
+        以前の形式や容量の異なる共有メモリには接続せずShmSchemaErrorを送出する
+        """
+        dtype = record_ring_dtype(capacity)
+        if create:
+            self.sm, ar = create_shm(
+                RECORD_RING_SHM_NAME, dtype, RECORD_RING_SHM_VERSION)
+        else:
+            self.sm, ar = attach_shm(
+                RECORD_RING_SHM_NAME, dtype, RECORD_RING_SHM_VERSION)
+        self.capacity = capacity
+        # 配列のフィールドは共有メモリのビュー
+        self.counters = ar["counters"]
+        self.records = ar["records"]
+
+    @property
+    def overflows(self) -> int:
+        return int(self.counters[H_OVERFLOWS])
+
+    def push(self, records: np.ndarray) -> bool:
+        """
+        (n, RECORD_SIZE)の記録を書き込む。空きが足りなければ捨ててFalseを返す。
+        書き込み側のプロセスからのみ呼ぶ
+        """
+        counters = self.counters
+        n = len(records)
+        w = int(counters[H_WRITE])
+        if w + n - int(counters[H_READ]) > self.capacity:
+            counters[H_OVERFLOWS] += n
+            return False
+        i = w % self.capacity
+        if i + n <= self.capacity:
+            self.records[i:i + n] = records
+        else:
+            k = self.capacity - i
+            self.records[i:] = records[:k]
+            self.records[:n - k] = records[k:]
+        counters[H_WRITE] = w + n
+        return True
+
+    def drain(self, out: np.ndarray) -> int:
+        """
+        溜まっている記録を最大len(out)件outにコピーし、件数を返す。
+        読み出し側のプロセスからのみ呼ぶ
+        """
+        counters = self.counters
+        r = int(counters[H_READ])
+        n = min(int(counters[H_WRITE]) - r, len(out))
+        if n <= 0:
+            return 0
+        i = r % self.capacity
+        k = min(n, self.capacity - i)
+        out[:k] = self.records[i:i + k]
+        out[k:n] = self.records[:n - k]
+        counters[H_READ] = r + n
+        return n
+
+    def close(self) -> None:
+        # 共有メモリのビューを先に手放す
+        del self.counters, self.records
+        self.sm.close()
+
+    def unlink(self) -> None:
+        self.sm.unlink()
+
+
+def record_to_dict(record: np.ndarray) -> Dict[str, object]:
+    """記録をcontrol.jsonlの1行の辞書にする"""
+    kind = int(record[F_KIND])
+    d = dict(
+        time=float(record[F_TIME]),
+        kind=RECORD_KINDS[kind],
+        joint=record[F_JOINT].tolist(),
+    )
+    for j, name in enumerate(RECORD_EXTRAS[kind]):
+        d[name] = float(record[F_EXTRA + j])
+    return d
@@ -0,0 +1,789 @@
+"""
+記録したcontrol.jsonlの目標値の列に対して、control_loopの目標値から
+制御値までの処理をロボットや実時間の時計なしで再現する。
+
+- 360度の規格化
+- ソフトリミット
+- 遅延を許した線形補間 (RingDelayedInterpolator)
+- フィルタ手前の速度・加速度制限
+- 平滑化 (filter_kindのすべての分岐)
+- フィルタ後の速度・加速度・加加速度制限
+
+前の周期に依存しない処理は時間方向にまとめて計算する。
+- 規格化・ソフトリミット・補間 (遅延が一定の場合): パラメータによらず全周期を1回で
+- 加加速度の整形と比率、送った位置の積算: 差分をブロックごとにまとめて
+速度・加速度制限と平滑化は前の周期の値に依存し、control_loopと
+完全に一致させるため1周期ずつのループで、複数のパラメータの組を
+バッチ (先頭の次元) としてまとめて計算する。フィルタ手前の制限は
+1周期先の分をフィルタ後の制限と重ねて1回で計算する。
+
+ループの1周期の時間はnumpyの小さな配列の演算数十回の呼び出しの
+オーバーヘッドでほぼ決まる。そのため1組だけでは1時間分 (125 Hz、
+45万周期) に約25秒かかり、数秒にはならない。丸めまで一致させたまま
+時間方向にまとめる方法がないため。パラメータの探索には
+replay_gridで多くの組をまとめて計算する (64組で1組あたり約1.2秒)。
+"""
+import itertools
+import json
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from .config import (
+    ACCEL_LIMITS, JERK_LIMITS, MAX_JOINT_LIMIT, MIN_JOINT_LIMIT, N_JOINTS,
+    SPEED_LIMIT, T_INTV
+)
+from .filter import OneEuroFilter
+from .interpolate import AdaptiveDelayedInterpolator, RingDelayedInterpolator
+
+
+# replayでバッチにできる (組ごとにスカラーの) 引数
+BATCH_PARAMS = [
+    "n_windows",
+    "speed_limit_ratio",
+    "accel_limit_ratio",
+    "speed_limits",
+    "jerk_limit_ratio",
+    "one_euro_min_cutoff",
+    "one_euro_beta",
+    "one_euro_d_cutoff",
+]
+
+# replayで加加速度の整形と比率、送った位置の積算をまとめて計算する周期数
+REPLAY_BLOCK = 4096
+
+FILTER_KINDS = [
+    "original",
+    "target",
+    "state_and_target_diff",
+    "moveit_servo_humble",
+    "control_and_target_diff",
+    "one_euro",
+]
+
+
+def load_control_log(path: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    control.jsonlを読み込み、kindごとに時刻 (T,) と関節角度 (T, 6) を返す。
+    controlにはmax_ratio, accel_max_ratioも記録されているが読み込まない
+    """
+    times: Dict[str, List[float]] = {}
+    joints: Dict[str, List[List[float]]] = {}
+    with open(path) as f:
+        for line in f:
+            js = json.loads(line)
+            kind = js["kind"]
+            if kind not in times:
+                times[kind] = []
+                joints[kind] = []
+            times[kind].append(js["time"])
+            joints[kind].append(js["joint"])
+    return {
+        kind: (np.array(times[kind]), np.array(joints[kind], dtype=float))
+        for kind in times
+    }
+
+
+def split_segments(ts: np.ndarray, max_gap: float = 1.0) -> List[slice]:
+    """
+    制御ループの開始・停止ごとに追記されたログを、時刻の間隔が
+    max_gap秒より空いたところで区切る
+    """
+    breaks = np.flatnonzero(np.diff(ts) > max_gap) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(ts)]])
+    return [slice(int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+def snap_times(ts: np.ndarray, t_intv: float = T_INTV) -> np.ndarray:
+    """
+    記録時刻 (UNIX時間で揺らぎがある) を制御ループの締め切りの格子に合わせる。
+    オーバーランで読み飛ばした周期は間隔が周期の整数倍として残る
+    """
+    k = np.round((ts - ts[0]) / t_intv).astype(np.int64)
+    # 同じ格子点に丸められた場合は後ろにずらし、狭義単調増加にする
+    idx = np.arange(len(k))
+    k = np.maximum.accumulate(k - idx) + idx
+    return ts[0] + k * t_intv
+
+
+def wrap_targets(
+    targets_raw: np.ndarray,
+    reference: np.ndarray,
+) -> np.ndarray:
+    """
+    360度の規格化。control_loopは状態値に最も近くなるように規格化するが、
+    ここでは直前の規格化済みの目標値に最も近くなるように規格化する。
+    状態値が目標値に180度以内で追従していれば同じ結果になる
+    """
+    n = np.empty_like(targets_raw)
+    n[0] = np.round((reference - targets_raw[0]) / 360)
+    n[1:] = np.round(-np.diff(targets_raw, axis=0) / 360)
+    return targets_raw + 360 * np.cumsum(n, axis=0)
+
+
+def delay_targets(
+    ts: np.ndarray,
+    targets: np.ndarray,
+    delay: float = 0.1,
+    adaptive_delay: bool = False,
+    capacity: int = 256,
+) -> np.ndarray:
+    """
+    RingDelayedInterpolatorで各周期に読み出した値を返す。
+    遅延が一定の場合は時間方向にまとめて計算する (_delay_targets_fixed)。
+    adaptive_delayの場合はAdaptiveDelayedInterpolatorを1周期ずつ使うが、
+    ログには目標値の受信のタイミングがないので、値が変わったときを到着とする
+    """
+    if not adaptive_delay:
+        out = _delay_targets_fixed(ts, targets, delay, capacity)
+        if out is not None:
+            return out
+        di = RingDelayedInterpolator(
+            delay=delay, capacity=capacity, n_dims=targets.shape[1])
+    else:
+        di = AdaptiveDelayedInterpolator(
+            delay=delay, capacity=capacity, n_dims=targets.shape[1])
+    out = np.empty_like(targets)
+    di.reset(ts[0], targets[0])
+    for k in range(len(ts)):
+        out[k] = di.read(ts[k], targets[k])
+    return out
+
+
+def _delay_targets_fixed(
+    ts: np.ndarray,
+    targets: np.ndarray,
+    delay: float,
+    capacity: int,
+) -> np.ndarray | None:
+    """
+    RingDelayedInterpolatorを1周期ずつ使った場合と完全に一致する値を
+    時間方向にまとめて計算する。リングバッファが溢れる場合はNoneを返す。
+
+    リングバッファに入る点は、値が変わった周期と、直前の点が
+    遅延の2倍より古くなってバッファが空になった周期 (値は直前と同じ)。
+    k周期目に読み出す値は、時刻ts[k] - delayの直前の点 (j1) と
+    直後の点 (j2、k周期目までに入ったもの) だけで決まる。
+    - j1があり、遅延の2倍より古くなければ、j2との線形補間 (j2がなければj1)
+    - j1が古すぎて捨てられているか、j1がなければj2
+    """
+    n_times = len(ts)
+    # 時刻と比べる値はRingDelayedInterpolatorと同じ演算で求める
+    ts_read = ts - delay
+    ts_drop = ts - delay * 2
+    changed = np.empty(n_times, dtype=bool)
+    changed[0] = True
+    np.any(targets[1:] != targets[:-1], axis=1, out=changed[1:])
+    points = np.flatnonzero(changed)
+    # バッファが空になる周期は、次に値が変わるまでの間隔が
+    # 遅延の2倍を超える場合だけなので、その間隔ごとに求める
+    ends = np.append(points[1:], n_times)
+    long_gaps = np.flatnonzero(ts_drop[ends - 1] > ts[points])
+    if len(long_gaps) > 0:
+        refills = []
+        for g in long_gaps:
+            k, end = points[g], ends[g]
+            while True:
+                k = int(np.searchsorted(ts_drop, ts[k], side="right"))
+                if k >= end:
+                    break
+                refills.append(k)
+        points = np.union1d(points, refills)
+    t_points = ts[points]
+
+    # j2の候補 (時刻ts[k] - delay以降の最初の点)
+    i = np.searchsorted(t_points, ts_read, side="left")
+    n_points = np.searchsorted(points, np.arange(n_times), side="right")
+    has_j1 = i > 0
+    j1 = np.maximum(i - 1, 0)
+    kept = has_j1 & ~(t_points[j1] < ts_drop)
+    # バッファの大きさがRingDelayedInterpolatorの容量を超えないこと
+    if np.max(n_points - np.where(kept, j1, i)) > capacity:
+        return None
+    has_j2 = i < n_points
+    j2 = np.minimum(i, len(points) - 1)
+
+    out = targets[points[np.where(kept, j1, j2)]]
+    interp = np.flatnonzero(kept & has_j2)
+    t1 = t_points[j1[interp]]
+    d1 = targets[points[j1[interp]]]
+    d2 = targets[points[j2[interp]]]
+    # RingDelayedInterpolator.readと同じ順序で計算する
+    tmp = d2 - d1
+    tmp /= (t_points[j2[interp]] - t1)[:, None]
+    tmp *= (ts_read[interp] - t1)[:, None]
+    out[interp] = d1 + tmp
+    return out
+
+
+class BatchLimiter:
+    """
+    control_loopの速度・加速度制限をバッチで計算する。
+    演算の順序はcontrol_loopと同じにしてあり、結果は完全に一致する
+    """
+    def __init__(
+        self,
+        speed_limits: np.ndarray,
+        accel_limits: np.ndarray,
+        stopped_velocity_eps: float = 1e-4,
+    ) -> None:
+        """
+        speed_limits: (B, N) 比率を掛けた後の速度制限
+        accel_limits: (B, N) 比率を掛けた後の加速度制限
+        """
+        self.speed_limits = speed_limits
+        self.accel_limits = accel_limits
+        self.stopped_velocity_eps = stopped_velocity_eps
+        self.last_velocity = np.zeros_like(speed_limits)
+        # 周期ごとの配列の確保を避けるための作業領域
+        self._v = np.zeros_like(speed_limits)
+        self._a = np.zeros_like(speed_limits)
+        self._tmp = np.zeros_like(speed_limits)
+        self._diff = np.zeros_like(speed_limits)
+        self._lt = np.zeros(speed_limits.shape, dtype=bool)
+        self._scale = np.zeros((len(speed_limits), 1))
+
+    def __call__(
+        self,
+        diff: np.ndarray,
+        dt: float,
+        max_ratio: np.ndarray | None = None,
+        accel_max_ratio: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        制限後の差分を返す。
+        max_ratio, accel_max_ratio: (B,) 速度、加速度の制限に対する
+        最大の比率を書き込む配列。Noneなら作業領域に書く。
+        差分は内部のバッファで、次の呼び出しで上書きされる
+        """
+        v, a, tmp, scale = self._v, self._a, self._tmp, self._scale
+        last_velocity = self.last_velocity
+
+        # 速度制限
+        np.divide(diff, dt, out=v)
+        np.abs(v, out=tmp)
+        np.divide(tmp, self.speed_limits, out=tmp)
+        max_ratio = np.maximum.reduce(tmp, axis=1, out=max_ratio)
+        # 比率が1以下なら1で割る (値は変わらない)
+        np.maximum(max_ratio[:, None], 1, out=scale)
+        np.divide(v, scale, out=v)
+
+        # 加速度制限
+        np.subtract(v, last_velocity, out=a)
+        np.divide(a, dt, out=a)
+        np.abs(a, out=tmp)
+        np.divide(tmp, self.accel_limits, out=tmp)
+        accel_max_ratio = np.maximum.reduce(tmp, axis=1, out=accel_max_ratio)
+        np.maximum(accel_max_ratio[:, None], 1, out=scale)
+        np.divide(a, scale, out=a)
+
+        np.multiply(a, dt, out=a)
+        np.add(last_velocity, a, out=v)
+        diff_limited = np.multiply(v, dt, out=self._diff)
+
+        # 速度がしきい値より小さければ静止させる
+        np.divide(diff_limited, dt, out=tmp)
+        np.less(tmp, self.stopped_velocity_eps, out=self._lt)
+        stopped = np.logical_and.reduce(self._lt, axis=1)
+        if stopped.any():
+            diff_limited[stopped] = 0
+            v[stopped] = 0
+        # 速度のバッファを入れ替える
+        self.last_velocity, self._v = v, last_velocity
+        return diff_limited
+
+
+class BatchSMAFilter:
+    """
+    メンバーごとに窓の長さが異なるSMAFilterをバッチで計算する。
+    履歴は最大の窓の長さのリングバッファに持ち、
+    メンバーごとに窓の先頭の位置を変えて読み出す。
+    previous_filtered_measurementと返り値は内部のバッファで、
+    filterで上書きされる
+    """
+    def __init__(self, n_windows: np.ndarray, n_dims: int = N_JOINTS) -> None:
+        self.n_windows = np.asarray(n_windows, dtype=np.int64)
+        self.n_batch = len(self.n_windows)
+        self.length = int(self.n_windows.max())
+        # SMAFilterと同じくfloatで割る
+        self._n = self.n_windows[:, None].astype(float)
+        self._rows = np.arange(self.n_batch)
+        # 書き込む位置ごとの、メンバーごとの最も古い値の位置
+        self._oldest_index = [
+            (pos - self.n_windows) % self.length for pos in range(self.length)]
+        self.previous_measurements = np.zeros(
+            (self.length, self.n_batch, n_dims))
+        self.previous_filtered_measurement = np.zeros((self.n_batch, n_dims))
+        self.pos = 0
+        self._tmp = np.zeros((self.n_batch, n_dims))
+        self._out = np.zeros((self.n_batch, n_dims))
+
+    def reset(self, data: np.ndarray) -> None:
+        self.previous_measurements[:] = data
+        np.copyto(self.previous_filtered_measurement, data)
+        self.pos = 0
+
+    def _update(self, new_measurement: np.ndarray, out: np.ndarray) -> None:
+        # SMAFilterと同じ順序で計算する
+        # previous - oldest / n + new / n
+        tmp = self._tmp
+        oldest = self.previous_measurements[
+            self._oldest_index[self.pos], self._rows]
+        np.divide(oldest, self._n, out=tmp)
+        np.subtract(self.previous_filtered_measurement, tmp, out=out)
+        np.divide(new_measurement, self._n, out=tmp)
+        np.add(out, tmp, out=out)
+
+    def filter(self, new_measurement: np.ndarray) -> np.ndarray:
+        self._update(new_measurement, self.previous_filtered_measurement)
+        self.previous_measurements[self.pos] = new_measurement
+        self.pos = (self.pos + 1) % self.length
+        return self.previous_filtered_measurement
+
+    def predict_only(self, new_measurement: np.ndarray) -> np.ndarray:
+        self._update(new_measurement, self._out)
+        return self._out
+
+
+class BatchJerkShaper:
+    """
+    メンバーごとに窓の長さが異なるJerkShaperを、時間方向のブロックごとに
+    まとめて計算する。ブロックをまたぐ移動平均のために直前の差分を持ち越す。
+    移動平均は累積和の差で求めるので、JerkShaperとは丸め誤差の分だけ異なる
+    """
+    def __init__(self, n_windows: np.ndarray, n_dims: int = N_JOINTS) -> None:
+        self.n_windows = np.asarray(n_windows, dtype=np.int64)
+        self.length = int(self.n_windows.max())
+        self._n = self.n_windows[:, None, None].astype(float)
+        # 静止した状態から始める
+        self.previous_diffs = np.zeros(
+            (len(self.n_windows), self.length, n_dims))
+
+    def shape(self, diffs: np.ndarray) -> np.ndarray:
+        """diffs: (B, L, N) 整形前の差分。整形した差分 (B, L, N) を返す"""
+        n_batch, n_block, _ = diffs.shape
+        ext = np.concatenate([self.previous_diffs, diffs], axis=1)
+        # 累積和の先頭に0を置き、[k - n + 1, k] の和をc[k + 1] - c[k + 1 - n]とする
+        c = np.zeros((n_batch, ext.shape[1] + 1, ext.shape[2]))
+        np.cumsum(ext, axis=1, out=c[:, 1:])
+        shaped = np.empty_like(diffs)
+        end = self.length + 1 + np.arange(n_block)
+        for b, n in enumerate(self.n_windows):
+            np.subtract(c[b, end], c[b, end - n], out=shaped[b])
+        shaped /= self._n
+        self.previous_diffs = ext[:, -self.length:].copy()
+        return shaped
+
+
+class BatchJerkMeter:
+    """
+    JerkMeterと同じ加加速度の制限に対する最大の比率を、時間方向の
+    ブロックごとにまとめて計算する。直前の2周期の差分を持ち越す
+    """
+    def __init__(self, jerk_limits: np.ndarray, t_intv: float = T_INTV) -> None:
+        """jerk_limits: (B, N) 比率を掛けた後の加加速度制限"""
+        # 差分の2階差分の制限
+        self._limits = (jerk_limits * t_intv ** 3)[:, None, :]
+        # 静止した状態から始める
+        self.last_diffs = np.zeros((len(jerk_limits), 2, jerk_limits.shape[1]))
+
+    def measure(self, diffs: np.ndarray) -> np.ndarray:
+        """diffs: (B, L, N) 送った差分。周期ごとの比率 (B, L) を返す"""
+        ext = np.concatenate([self.last_diffs, diffs], axis=1)
+        # JerkMeterと同じく (d[k] - d[k-1]) - (d[k-1] - d[k-2])
+        d2 = np.diff(ext, n=2, axis=1)
+        np.abs(d2, out=d2)
+        d2 /= self._limits
+        self.last_diffs = ext[:, -2:].copy()
+        return np.max(d2, axis=2)
+
+
+def _per_member(x, n_batch: int, n_dims: int | None = None) -> np.ndarray:
+    """スカラー、(B,)、(N,)、(B, N) のパラメータをバッチの形にそろえる"""
+    a = np.asarray(x, dtype=float)
+    if n_dims is None:
+        return np.broadcast_to(a.reshape(-1), (n_batch,))
+    return np.broadcast_to(a.reshape(-1, n_dims), (n_batch, n_dims))
+
+
+def replay(
+    ts: np.ndarray,
+    targets_raw: np.ndarray,
+    filter_kind: str = "original",
+    n_windows=10,
+    speed_limit_ratio=0.5,
+    accel_limit_ratio=0.5,
+    speed_limits=SPEED_LIMIT,
+    accel_limits=ACCEL_LIMITS,
+    jerk_limit_ratio=0.5,
+    jerk_limits=JERK_LIMITS,
+    use_jerk_limit: bool = False,
+    use_interp: bool = True,
+    delay: float = 0.1,
+    adaptive_delay: bool = False,
+    use_pre_limiter: bool = True,
+    initial_state: np.ndarray | None = None,
+    state_delay: float = 0.1,
+    min_joint_limit=MIN_JOINT_LIMIT,
+    max_joint_limit=MAX_JOINT_LIMIT,
+    stopped_velocity_eps: float = 1e-4,
+    one_euro_min_cutoff=1.0,
+    one_euro_beta=0.02,
+    one_euro_d_cutoff=1.0,
+) -> Dict[str, np.ndarray]:
+    """
+    ts: (T,) 制御ループの時刻。snap_timesで格子に合わせたものを想定
+    targets_raw: (T, 6) 共有メモリから読んだ目標値 (controlのkind="target")
+    n_windows, speed_limit_ratio, accel_limit_ratio, jerk_limit_ratio,
+    speed_limits, one_euro_min_cutoff, one_euro_beta, one_euro_d_cutoff:
+        スカラーまたはバッチの大きさBの配列
+    accel_limits, jerk_limits: (6,) または (B, 6)
+    use_jerk_limit: TrueならJerkShaperで整形した差分をロボットに送るとする。
+        Falseでも加加速度の比率は計算する
+    initial_state: 制御開始時の状態値。省略時は最初の目標値
+    state_delay: 状態値のモデル。制御値がこの時間遅れて状態値になるとする
+
+    1回の呼び出しの時間は時間方向の長さにほぼ比例し、バッチの大きさには
+    ほぼよらない (1時間分で1組なら約25秒、64組で約75秒)。探索にはreplay_gridを使う。
+
+    返り値の配列の時間方向の先頭は制御開始時 (control_loopが制御値を
+    送らずに初期化する周期) の値で、それ以降が各周期の値。
+    - target: (T, 6) 規格化・ソフトリミット後の目標値
+    - target_delayed: (B, T, 6) フィルタ手前の速度・加速度制限後の目標値
+    - control: (B, T, 6) 制御値
+    - command: (B, T, 6) ロボットに送った差分を積算した位置。
+        use_jerk_limitがFalseならcontrolと同じ
+    - max_ratio, accel_max_ratio:
+        (B, T) フィルタ後の速度・加速度制限に対する最大の比率
+    - jerk_max_ratio: (B, T) ロボットに送った差分の加加速度の制限に対する最大の比率
+        (control_loopのJerkMeterと同じく、差分の2階差分をT_INTVの3乗で割る)
+    - filter_jerk_max_ratio: (B, T) 整形前の差分のjerk_max_ratio。
+        use_jerk_limitがFalseならjerk_max_ratioと同じ
+    use_pre_limiterがFalseの場合、target_delayedはメンバーによらない値の
+    読み出し専用のビュー
+    """
+    if filter_kind not in FILTER_KINDS:
+        raise ValueError(f"Unknown filter_kind: {filter_kind}")
+    n_times, n_dims = targets_raw.shape
+    n_windows = np.atleast_1d(np.asarray(n_windows, dtype=np.int64))
+    n_batch = max(
+        len(n_windows),
+        np.size(speed_limit_ratio),
+        np.size(accel_limit_ratio),
+        np.size(speed_limits),
+        np.size(accel_limits) // n_dims,
+        np.size(jerk_limit_ratio),
+        np.size(jerk_limits) // n_dims,
+        np.size(one_euro_min_cutoff),
+        np.size(one_euro_beta),
+        np.size(one_euro_d_cutoff),
+    )
+    n_windows = np.broadcast_to(n_windows, (n_batch,))
+    # control_loopと同じく比率を掛けてから割る
+    v_limits = np.repeat(
+        (_per_member(speed_limit_ratio, n_batch) *
+         _per_member(speed_limits, n_batch))[:, None], n_dims, axis=1)
+    a_limits = (
+        _per_member(accel_limit_ratio, n_batch)[:, None] *
+        _per_member(accel_limits, n_batch, n_dims))
+    j_limits = (
+        _per_member(jerk_limit_ratio, n_batch)[:, None] *
+        _per_member(jerk_limits, n_batch, n_dims))
+
+    # パラメータによらない部分
+    if initial_state is None:
+        initial_state = targets_raw[0]
+    initial_state = np.asarray(initial_state, dtype=float)
+    target = wrap_targets(targets_raw, initial_state)
+    target = np.clip(target, min_joint_limit, max_joint_limit)
+    if use_interp:
+        delayed = delay_targets(ts, target, delay, adaptive_delay)
+    else:
+        delayed = target
+    # k周期目に見える状態値はstate_delay秒前の周期の制御値とする
+    state_idx = np.searchsorted(ts, ts - state_delay, side="right") - 1
+    state_idx = np.clip(state_idx, 0, np.arange(n_times) - 1)
+
+    target_delayed = np.empty((n_batch, n_times, n_dims))
+    control = np.empty((n_batch, n_times, n_dims))
+    # 周期ごとに書き込むので時間を先頭の次元にし、返すときに転置する
+    max_ratios = np.zeros((n_times, n_batch))
+    accel_max_ratios = np.zeros((n_times, n_batch))
+    filter_jerk_max_ratios = np.zeros((n_times, n_batch))
+
+    # 制御開始時の初期化
+    state = np.broadcast_to(initial_state, (n_batch, n_dims))
+    if use_pre_limiter:
+        target_delayed[:, 0] = delayed[0]
+    else:
+        # 制限しなければメンバーによらないのでビューにする
+        target_delayed = np.broadcast_to(delayed, (n_batch, n_times, n_dims))
+    last_target_delayed = target_delayed[:, 0]
+    control[:, 0] = state
+    last_control = control[:, 0]
+    if filter_kind == "one_euro":
+        # 要素ごとの計算なのでそのままバッチにできる
+        _filter = OneEuroFilter(
+            min_cutoff=_per_member(one_euro_min_cutoff, n_batch)[:, None],
+            beta=_per_member(one_euro_beta, n_batch)[:, None],
+            d_cutoff=_per_member(one_euro_d_cutoff, n_batch)[:, None],
+        )
+    else:
+        _filter = BatchSMAFilter(n_windows, n_dims)
+    if filter_kind == "target":
+        _filter.reset(np.repeat(target[:1], n_batch, axis=0))
+    else:
+        _filter.reset(state.copy())
+    # フィルタ手前の制限は目標値だけに依存するので、k + 1周期目の分を
+    # フィルタ後のk周期目の制限と行を重ねて1回の呼び出しで計算する。
+    # 先頭のB行がフィルタ後、続くB行がフィルタ手前。行ごとの計算なので結果は変わらない
+    n_rows = 2 * n_batch if use_pre_limiter else n_batch
+    limiter = BatchLimiter(
+        np.concatenate([v_limits] * (n_rows // n_batch)),
+        np.concatenate([a_limits] * (n_rows // n_batch)),
+        stopped_velocity_eps)
+    limiter_in = np.zeros((n_rows, n_dims))
+    limiter_dt = np.zeros((n_rows, 1))
+    ratios = np.zeros(n_rows)
+    accel_ratios = np.zeros(n_rows)
+    target_diff, pre_in = limiter_in[:n_batch], limiter_in[n_batch:]
+    main_dt, pre_dt = limiter_dt[:n_batch], limiter_dt[n_batch:]
+    # 周期ごとの作業領域
+    target_aligned = np.zeros((n_batch, n_dims))
+    last_target_filtered = np.zeros((n_batch, n_dims))
+
+    # 前の周期に依存しない処理 (加加速度の整形と比率、送った位置の積算) は
+    # ブロックごとにまとめて計算する
+    diffs = np.empty((n_batch, REPLAY_BLOCK, n_dims))
+    filter_meter = BatchJerkMeter(j_limits)
+    if use_jerk_limit:
+        # control_loopのn_jerk_windowsと同じ決め方
+        n_jerk_windows = np.ceil(
+            np.max(2 * a_limits / j_limits, axis=1) / T_INTV).astype(np.int64)
+        shaper = BatchJerkShaper(n_jerk_windows, n_dims)
+        meter = BatchJerkMeter(j_limits)
+        jerk_max_ratios = np.zeros((n_times, n_batch))
+        command = np.empty((n_batch, n_times, n_dims))
+        command[:, 0] = state
+    else:
+        jerk_max_ratios = filter_jerk_max_ratios
+        command = control
+
+    def flush(k_end: int, n: int) -> None:
+        """k_end - n周期目からk_end - 1周期目までの差分の後処理"""
+        k0 = k_end - n
+        block = diffs[:, :n]
+        filter_jerk_max_ratios[k0:k_end] = filter_meter.measure(block).T
+        if use_jerk_limit:
+            sent = shaper.shape(block)
+            jerk_max_ratios[k0:k_end] = meter.measure(sent).T
+            # 1周期ずつ足した場合と同じになるよう直前の位置から累積和をとる
+            np.cumsum(
+                np.concatenate([command[:, k0 - 1:k0], sent], axis=1),
+                axis=1, out=command[:, k0 - 1:k_end])
+
+    dts = np.diff(ts).tolist()
+    state_idx = state_idx.tolist()
+    if use_pre_limiter and n_times > 1:
+        # 1周期目のフィルタ手前の制限。フィルタ後の行は0を入れるので状態は変わらない
+        np.subtract(delayed[1], last_target_delayed, out=pre_in)
+        limiter_dt[:] = dts[0]
+        d = limiter(limiter_in, limiter_dt, ratios, accel_ratios)
+        np.add(last_target_delayed, d[n_batch:], out=target_delayed[:, 1])
+    j = 0
+    for k in range(1, n_times):
+        dt = dts[k - 1]
+        state = control[:, state_idx[k]]
+        # control_loopと同じく、平滑化の前に更新するので
+        # 以下の目標値の差分は0になる
+        td = target_delayed[:, k]
+        last_target_delayed = td
+
+        # 平滑化
+        if filter_kind == "original":
+            target_filtered = _filter.predict_only(td)
+            np.subtract(target_filtered, last_control, out=target_diff)
+        elif filter_kind == "target":
+            np.copyto(
+                last_target_filtered, _filter.previous_filtered_measurement)
+            target_filtered = _filter.filter(td)
+            np.subtract(
+                target_filtered, last_target_filtered, out=target_diff)
+        elif filter_kind == "state_and_target_diff":
+            np.subtract(td, last_target_delayed, out=target_aligned)
+            np.add(state, target_aligned, out=target_aligned)
+            np.copyto(
+                last_target_filtered, _filter.previous_filtered_measurement)
+            target_filtered = _filter.filter(target_aligned)
+            np.subtract(
+                target_filtered, last_target_filtered, out=target_diff)
+        elif filter_kind == "moveit_servo_humble":
+            np.subtract(td, last_target_delayed, out=target_aligned)
+            np.add(state, target_aligned, out=target_aligned)
+            target_filtered = _filter.filter(target_aligned)
+            np.subtract(target_filtered, state, out=target_diff)
+        elif filter_kind == "control_and_target_diff":
+            np.subtract(td, last_target_delayed, out=target_aligned)
+            np.add(last_control, target_aligned, out=target_aligned)
+            np.copyto(
+                last_target_filtered, _filter.previous_filtered_measurement)
+            target_filtered = _filter.filter(target_aligned)
+            np.subtract(
+                target_filtered, last_target_filtered, out=target_diff)
+        elif filter_kind == "one_euro":
+            target_filtered = _filter.filter(td, dt)
+            np.subtract(target_filtered, last_control, out=target_diff)
+
+        # 速度・加速度制限 (フィルタ手前はk + 1周期目)
+        main_dt[:] = dt
+        if use_pre_limiter and k + 1 < n_times:
+            np.subtract(delayed[k + 1], td, out=pre_in)
+            pre_dt[:] = dts[k]
+        d = limiter(limiter_in, limiter_dt, ratios, accel_ratios)
+        diff = d[:n_batch]
+        max_ratios[k] = ratios[:n_batch]
+        accel_max_ratios[k] = accel_ratios[:n_batch]
+        if use_pre_limiter and k + 1 < n_times:
+            np.add(td, d[n_batch:], out=target_delayed[:, k + 1])
+
+        c = control[:, k]
+        if filter_kind == "original":
+            np.add(last_control, diff, out=c)
+            _filter.filter(c)
+        elif filter_kind == "one_euro":
+            np.add(last_control, diff, out=c)
+        elif filter_kind == "moveit_servo_humble":
+            np.add(state, diff, out=c)
+        else:
+            np.add(last_target_filtered, diff, out=c)
+        last_control = c
+
+        diffs[:, j] = diff
+        j += 1
+        if j == REPLAY_BLOCK:
+            flush(k + 1, j)
+            j = 0
+    if j > 0:
+        flush(n_times, j)
+
+    return dict(
+        target=target,
+        target_delayed=target_delayed,
+        control=control,
+        command=command,
+        max_ratio=max_ratios.T,
+        accel_max_ratio=accel_max_ratios.T,
+        jerk_max_ratio=jerk_max_ratios.T,
+        filter_jerk_max_ratio=filter_jerk_max_ratios.T,
+    )
+
+
+def estimate_lag(
+    result: Dict[str, np.ndarray],
+    t_intv: float = T_INTV,
+    max_lag: float = 0.5,
+) -> np.ndarray:
+    """
+    ロボットに送った位置 (command) が目標値から遅れている時間 (s) を
+    メンバーごとに推定する。ロボットに送った位置をずらして目標値との二乗誤差が最小になる周期数を探す
+    """
+    # 二乗誤差の和を (commandの二乗和) + (targetの二乗和) - 2 (内積) に分け、
+    # ずらすごとに (B, T, 6) の差の配列を確保しない。二乗和は累積和から、
+    # 内積は行列とベクトルの積で求める。
+    # 桁落ちを避けるため目標値の関節ごとの平均mを引いた値で計算する
+    # ((c - m)・(t - m) = c・(t - m) - m・(t - m))
+    target = result["target"]
+    command = result["command"]
+    n_batch, n_times, n_dims = command.shape
+    mean = target.mean(axis=0)
+    target = target - mean
+    n_lags = min(int(round(max_lag / t_intv)), n_times - 2)
+    # command[b, lag:]の二乗和は、後ろからの累積和のn_times - lag - 1番目
+    sq_command = np.empty((n_batch, n_times))
+    for b in range(n_batch):
+        sq = np.sum((command[b] - mean) ** 2, axis=1)
+        np.cumsum(sq[::-1], out=sq_command[b])
+    sq_target = np.cumsum(np.sum(target ** 2, axis=1))
+    sum_target = np.cumsum(target @ mean)
+    errors = np.empty((n_batch, n_lags + 1))
+    for lag in range(n_lags + 1):
+        n = n_times - lag
+        cross = (command[:, lag:].reshape(n_batch, -1) @
+                 target[:n].reshape(-1)) - sum_target[n - 1]
+        errors[:, lag] = (
+            sq_command[:, n - 1] + sq_target[n - 1] - 2 * cross) / (n * n_dims)
+    return np.argmin(errors, axis=1) * t_intv
+
+
+def estimate_jitter(
+    result: Dict[str, np.ndarray],
+    t_intv: float = T_INTV,
+) -> np.ndarray:
+    """
+    ロボットに送った位置の細かい揺れの大きさ (deg/s^2) をメンバーごとに推定する。
+    2階差分 (加速度) の二乗平均平方根
+    """
+    command = result["command"]
+    # バッチ全体の大きさの一時配列を作らないようメンバーごとに計算する
+    jitter = np.empty(len(command))
+    for b in range(len(command)):
+        accel = np.diff(command[b], n=2, axis=0) / t_intv ** 2
+        jitter[b] = np.sqrt(np.mean(accel ** 2))
+    return jitter
+
+
+def summarize(result: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    バッチのメンバーごとの評価値を返す。制御値はロボットに送った位置 (command)
+    - rmse: 目標値と制御値の差の二乗平均平方根 (deg)
+    - max_abs_error: 目標値と制御値の差の絶対値の最大 (deg)
+    - speed_limited: フィルタ後の速度制限がかかった周期の割合
+    - accel_limited: フィルタ後の加速度制限がかかった周期の割合
+    - jerk_limited: ロボットに送った差分が加加速度制限を超えた周期の割合
+    - lag: 制御値の目標値からの遅れ (s)
+    - jitter: 制御値の加速度の二乗平均平方根 (deg/s^2)
+    """
+    command = result["command"]
+    target = result["target"]
+    rmse = np.empty(len(command))
+    max_abs_error = np.empty(len(command))
+    for b in range(len(command)):
+        err = command[b] - target
+        rmse[b] = np.sqrt(np.mean(err ** 2))
+        max_abs_error[b] = np.max(np.abs(err))
+    return dict(
+        rmse=rmse,
+        max_abs_error=max_abs_error,
+        speed_limited=np.mean(result["max_ratio"][:, 1:] > 1, axis=1),
+        accel_limited=np.mean(result["accel_max_ratio"][:, 1:] > 1, axis=1),
+        jerk_limited=np.mean(result["jerk_max_ratio"][:, 1:] > 1, axis=1),
+        lag=estimate_lag(result),
+        jitter=estimate_jitter(result),
+    )
+
+
+def replay_grid(
+    ts: np.ndarray,
+    targets_raw: np.ndarray,
+    grid: Dict[str, Sequence[Any]],
+    **kwargs,
+) -> Tuple[List[Dict[str, Any]], Dict[str, np.ndarray]]:
+    """
+    パラメータの探索の入口。gridの値の直積を1つのバッチとして
+    1回のreplayで計算し、パラメータの組のリストと組ごとの評価値 (summarize) を返す。
+    grid: BATCH_PARAMSの引数名から候補の値のリスト
+    kwargs: すべての組に共通のreplayの引数 (filter_kind, use_jerk_limitなど)
+    """
+    unknown = set(grid) - set(BATCH_PARAMS)
+    if unknown:
+        raise ValueError(f"Parameters that cannot be batched: {unknown}")
+    names = list(grid)
+    combos = [
+        dict(zip(names, values))
+        for values in itertools.product(*(grid[name] for name in names))]
+    batch = {
+        name: np.array([combo[name] for combo in combos]) for name in names}
+    result = replay(ts, targets_raw, **batch, **kwargs)
+    return combos, summarize(result)
+
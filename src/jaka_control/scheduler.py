@@ -0,0 +1,99 @@
+import time
+
+
+class PeriodicScheduler:
+    """
+    絶対時刻の締め切りで起床する固定周期スケジューラ。
+
+    締め切りは開始時刻 + k * 周期の格子上に置くので、
+    処理時間やsleepの誤差が積み重ならず、位相がずれない。
+    締め切りに間に合わなかった場合 (オーバーラン) は、
+    過ぎた締め切りをまとめて読み飛ばして次の格子点に合わせ、
+    遅れを取り戻すための連続実行は行わない。
+    時刻はすべてtime.perf_counter (単調増加) の秒。
+    """
+    def __init__(
+        self,
+        period: float,
+        spin: float = 0.0002,
+    ) -> None:
+        """
+        period: 周期 (秒)
+        spin: 締め切り直前にsleepせずに待つ時間 (秒)。
+        sleepの起床遅れを吸収するため。0でsleepのみ
+        """
+        self.period = period
+        self.spin = spin
+        self.reset()
+
+    def reset(self, t: float | None = None) -> None:
+        """tを最初の締め切りとして格子を置き直す"""
+        if t is None:
+            t = time.perf_counter()
+        self.t_start = t
+        self.k = 0
+        # 直近の締め切り
+        self.deadline = t
+        # 直近の起床で進んだ時間 (周期の整数倍)
+        self.dt = self.period
+        # 起床が締め切りから遅れた時間
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        # 実行した周期 (起床) の数、オーバーランした回数と読み飛ばした周期の数。
+        # kは読み飛ばした周期も含む格子点の番号なので実行した数とは異なる
+        self.n_cycles = 0
+        self.n_overruns = 0
+        self.n_skipped = 0
+
+    def restart(self) -> float:
+        """
+        格子を現在の時刻から置き直し、その時刻を締め切りとして返す。
+        通知などで起きた直後に、次の締め切りを待たずに周期を始める場合に使う
+        """
+        self.reset()
+        self.n_cycles = 1
+        return self.deadline
+
+    def wait(self) -> float:
+        """
+        次の締め切りまで待ち、その締め切りの時刻を返す。
+        制御値の計算にはこの返り値 (実際の起床時刻ではない) を使うと
+        周期が厳密にperiodの整数倍になる。
+        """
+        now = time.perf_counter()
+        k_next = self.k + 1
+        deadline = self.t_start + k_next * self.period
+        if now > deadline + self.period:
+            # 1周期以上遅れた場合は過ぎた締め切りを読み飛ばし、
+            # 直近に過ぎた締め切りの周期としてすぐに実行する
+            k_late = int((now - self.t_start) / self.period)
+            self.n_overruns += 1
+            self.n_skipped += k_late - k_next
+            k_next = k_late
+            deadline = self.t_start + k_next * self.period
+        elif now > deadline:
+            # 1周期以内の遅れはそのまま実行し、次の締め切りで取り戻す
+            self.n_overruns += 1
+        else:
+            t_sleep = deadline - now - self.spin
+            if t_sleep > 0:
+                time.sleep(t_sleep)
+            while time.perf_counter() < deadline:
+                pass
+        self.lateness = max(time.perf_counter() - deadline, 0.0)
+        if self.lateness > self.max_lateness:
+            self.max_lateness = self.lateness
+        self.dt = (k_next - self.k) * self.period
+        self.k = k_next
+        self.n_cycles += 1
+        self.deadline = deadline
+        return deadline
+
+    def stats(self) -> dict:
+        return dict(
+            period=self.period,
+            cycles=self.n_cycles,
+            overruns=self.n_overruns,
+            skipped=self.n_skipped,
+            max_lateness=self.max_lateness,
+        )
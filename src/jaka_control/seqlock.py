@@ -0,0 +1,120 @@
+"""
+共有メモリのposeの関節の値のまとまり (状態値、目標値、制御値) を
+seqlockで守る。書き込むプロセスはまとまりごとに1つとする。
+
+書き込み側は世代を奇数にしてから値を書き、書き終えたら偶数にする。
+読み出し側は世代が偶数で、値をコピーした前後で世代が変わっていなければ
+一貫した値とする。読み出し側は待たずに決まった回数だけやり直し、
+それでも一貫した値が読めなければ前回の値のままにする
+(read_spinでは決まった時間まで読み直す)。
+値と一緒に書き込んだ時刻 (time.monotonic_ns) も守るので、
+読み出し側は値がいつ書かれたか (何回目の書き込みか) がわかる。
+制御用のPC (x86) ではストアの順序が保たれることを前提にしている。
+"""
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+# まとまりごとの世代と書き込み時刻を置くposeのフィールド
+POSE_GROUPS: Dict[str, Tuple[str, str]] = {
+    "state": ("state_seq", "state_time"),
+    "target": ("target_seq", "target_time"),
+    "control": ("control_seq", "control_time"),
+}
+
+
+class SeqLock:
+    def __init__(
+        self,
+        data: np.ndarray,
+        seq: np.ndarray,
+        stamp: np.ndarray,
+        max_retries: int = 4,
+    ) -> None:
+        """
+        data: 守る値の配列 (共有メモリのビュー)
+        seq: 世代を置く0次元のint64の配列 (共有メモリのビュー)
+        stamp: 書き込み時刻 (ns) を置く0次元のint64の配列 (共有メモリのビュー)
+        """
+        self.data = data
+        self.seq = seq
+        self.stamp = stamp
+        self.max_retries = max_retries
+        self._buf = np.zeros(len(self.data))
+        # 書き込む値を確かめるための作業領域
+        self._wbuf = np.zeros(self.data.shape, dtype=self.data.dtype)
+        # 最後に読めた値の世代と書き込み時刻 (ns)。まだ書かれていなければ0
+        self.generation = -1
+        self.time_ns = 0
+        # 書き込み中で読み直した回数と、読めずに前回の値を使った回数
+        self.n_retries = 0
+        self.n_failures = 0
+
+    @property
+    def count(self) -> int:
+        """最後に読めた値が何回目の書き込みか (1から数える)"""
+        return self.generation // 2
+
+    def write(self, values, t_ns: int | None = None) -> None:
+        """
+        t_ns: 値を得た時刻 (time.monotonic_ns)。Noneで現在の時刻
+        valuesの形や型が合わなければ世代を変えずに例外を送出する
+        """
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        # 世代を奇数にしてから例外になると読み出し側が以後読めなくなるので、
+        # 変換は先に作業領域で行う
+        np.copyto(self._wbuf, values)
+        t_ns = int(t_ns)
+        seq = self.seq
+        s = int(seq)
+        seq[...] = s + 1
+        self.data[:] = self._wbuf
+        self.stamp[...] = t_ns
+        seq[...] = s + 2
+
+    def read(self, out: np.ndarray) -> bool:
+        """
+        一貫した値をoutにコピーしてTrueを返す。
+        max_retries回やり直しても読めなければoutは変えずにFalseを返す
+        """
+        seq = self.seq
+        for _ in range(self.max_retries):
+            s = int(seq)
+            if s % 2 == 0:
+                np.copyto(self._buf, self.data)
+                t_ns = int(self.stamp)
+                if int(seq) == s:
+                    np.copyto(out, self._buf)
+                    self.generation = s
+                    self.time_ns = t_ns
+                    return True
+            self.n_retries += 1
+        self.n_failures += 1
+        return False
+
+    def read_spin(self, out: np.ndarray, timeout: float) -> bool:
+        """
+        readで読めなければtimeout秒まで他のスレッドに譲りながら読み直す。
+        書き込み中の値は書き込みが終わればすぐ読めるので、書き込みの通知を
+        待たずに済ませたいとき (最初の読み出しなど) に使う
+        """
+        t_end = time.perf_counter() + timeout
+        while not self.read(out):
+            if time.perf_counter() >= t_end:
+                return False
+            time.sleep(0)
+        return True
+
+
+class PoseSeqLocks:
+    """poseのまとまりごとのSeqLock"""
+    def __init__(self, pose: np.void, max_retries: int = 4) -> None:
+        """pose: 共有メモリの構造化配列の要素"""
+        # 要素のスカラーのフィールドはコピーになるので元の配列のビューを使う
+        ar = pose.base
+        for name, (seq, stamp) in POSE_GROUPS.items():
+            setattr(self, name, SeqLock(
+                ar[name], ar[seq], ar[stamp], max_retries))
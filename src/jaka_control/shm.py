@@ -0,0 +1,98 @@
+"""
+config.pyの構造化dtypeで形式を決めた共有メモリの作成と接続。
+共有メモリは構造化配列の要素 (np.void) として扱い、フィールド名で読み書きする。
+スカラーのフィールドは読むとコピー、配列のフィールドは共有メモリのビューになる。
+接続時にヘッダのバージョンとサイズを確認し、形式が異なれば例外を送出する。
+"""
+import multiprocessing as mp
+import multiprocessing.shared_memory
+from typing import Tuple
+
+import numpy as np
+
+from .config import (
+    HISTORY_SHM_DTYPE, HISTORY_SHM_NAME, HISTORY_SHM_VERSION,
+    MOCK_SHM_DTYPE, MOCK_SHM_NAME, MOCK_SHM_VERSION, SHM_DTYPE,
+    SHM_HEADER_FIELDS, SHM_NAME, SHM_VERSION, SNAPSHOT_SHM_DTYPE,
+    SNAPSHOT_SHM_NAME, SNAPSHOT_SHM_VERSION
+)
+
+
+HEADER_DTYPE = np.dtype(SHM_HEADER_FIELDS, align=True)
+
+
+class ShmSchemaError(RuntimeError):
+    pass
+
+
+def create_shm(
+    name: str = SHM_NAME,
+    dtype: np.dtype = SHM_DTYPE,
+    version: int = SHM_VERSION,
+) -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    """共有メモリを作成 (既にあれば初期化) し、ヘッダを書き込む"""
+    sz = dtype.itemsize
+    try:
+        sm = mp.shared_memory.SharedMemory(create=True, size=sz, name=name)
+    except FileExistsError:
+        sm = mp.shared_memory.SharedMemory(name=name)
+        if sm.size < sz:
+            # 以前の形式の小さい共有メモリが残っている場合は作り直す
+            sm.close()
+            sm.unlink()
+            sm = mp.shared_memory.SharedMemory(
+                create=True, size=sz, name=name)
+    sm.buf[:sz] = bytes(sz)
+    ar = np.ndarray((), dtype=dtype, buffer=sm.buf)
+    ar["version"] = version
+    ar["size"] = sz
+    return sm, ar[()]
+
+
+def attach_shm(
+    name: str = SHM_NAME,
+    dtype: np.dtype = SHM_DTYPE,
+    version: int = SHM_VERSION,
+) -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    """既存の共有メモリに接続する。形式が異なればShmSchemaErrorを送出する"""
+    sm = mp.shared_memory.SharedMemory(name=name)
+    header = None
+    if sm.size >= HEADER_DTYPE.itemsize:
+        header = np.ndarray((), dtype=HEADER_DTYPE, buffer=sm.buf).copy()
+    if (header is None or
+            header["version"] != version or
+            header["size"] != dtype.itemsize or
+            sm.size < dtype.itemsize):
+        found = "no header" if header is None else (
+            f"version {header['version']}, size {header['size']}")
+        sm.close()
+        raise ShmSchemaError(
+            f"Shared memory {name!r} has {found}, "
+            f"expected version {version}, size {dtype.itemsize}")
+    return sm, np.ndarray((), dtype=dtype, buffer=sm.buf)[()]
+
+
+def create_mock_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return create_shm(MOCK_SHM_NAME, MOCK_SHM_DTYPE, MOCK_SHM_VERSION)
+
+
+def attach_mock_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return attach_shm(MOCK_SHM_NAME, MOCK_SHM_DTYPE, MOCK_SHM_VERSION)
+
+
+def create_snapshot_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return create_shm(
+        SNAPSHOT_SHM_NAME, SNAPSHOT_SHM_DTYPE, SNAPSHOT_SHM_VERSION)
+
+
+def attach_snapshot_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return attach_shm(
+        SNAPSHOT_SHM_NAME, SNAPSHOT_SHM_DTYPE, SNAPSHOT_SHM_VERSION)
+
+
+def create_history_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return create_shm(HISTORY_SHM_NAME, HISTORY_SHM_DTYPE, HISTORY_SHM_VERSION)
+
+
+def attach_history_shm() -> Tuple[mp.shared_memory.SharedMemory, np.void]:
+    return attach_shm(HISTORY_SHM_NAME, HISTORY_SHM_DTYPE, HISTORY_SHM_VERSION)
@@ -0,0 +1,116 @@
+"""
+GUIに表示する最新のメッセージを、Managerの辞書の代わりに共有メモリに置く。
+書き込み側 (MQTTの受信スレッド、モニタプロセス) はサーバーとの往復や
+pickleなしに、メッセージのバイト列をそのままコピーする。
+読み出し側 (GUI) は世代が変わったときだけJSONを読んで辞書にする。
+形式はconfig.SNAPSHOT_SLOT_DTYPEを参照。
+"""
+import json
+import threading
+from typing import Any, Dict
+
+import numpy as np
+
+from .control_message import control_message_to_dict, is_control_message
+from .shm import attach_snapshot_shm, create_snapshot_shm
+
+
+class SnapshotSlot:
+    """
+    最新のメッセージ1件分の置き場所。書き込むプロセスは1つとする。
+    そのプロセスの複数のスレッド (MQTTの受信スレッドと取り込みのスレッドなど) が
+    書く場合はロックで順に書く。
+    seqlockと同じく、書き込み側は世代を奇数にしてから書き、書き終えたら偶数にする
+    """
+    def __init__(self, slot: np.ndarray, max_retries: int = 10) -> None:
+        """slot: SNAPSHOT_SLOT_DTYPEの0次元の配列 (共有メモリのビュー)"""
+        self._seq = slot["seq"]
+        self._topic_type = slot["topic_type"]
+        self._topic = slot["topic"]
+        self._length = slot["length"]
+        self._payload = memoryview(slot["payload"])
+        self.capacity = len(self._payload)
+        self.max_retries = max_retries
+        # 最後に読めたメッセージの世代。まだ書かれていなければ0
+        self.generation = 0
+        # 大きすぎて書けなかったメッセージの数
+        self.n_oversize = 0
+        # 同じプロセスの書き込み側のスレッドの間のロック
+        self._write_lock = threading.Lock()
+
+    def write(self, topic_type: str, topic: str, payload: bytes) -> bool:
+        """
+        payload: JSONのオブジェクトか、バイナリの制御メッセージ (control_message) のバイト列。
+        capacityより大きければ書かずにFalseを返す
+        """
+        n = len(payload)
+        if n > self.capacity:
+            self.n_oversize += 1
+            return False
+        topic_type = topic_type.encode()
+        topic = topic.encode()
+        seq = self._seq
+        with self._write_lock:
+            s = int(seq)
+            seq[...] = s + 1
+            self._topic_type[...] = topic_type
+            self._topic[...] = topic
+            self._length[...] = n
+            self._payload[:n] = payload
+            seq[...] = s + 2
+        return True
+
+    def read(self) -> Dict[str, Any] | None:
+        """
+        前回読んだ後に書かれたメッセージがあれば、topic_typeとtopicを加えた辞書で返す。
+        なければ (書き込み中で読めなかった場合も) Noneを返す
+        """
+        seq = self._seq
+        for _ in range(self.max_retries):
+            s = int(seq)
+            if s == self.generation:
+                return None
+            if s % 2 == 1:
+                continue
+            topic_type = self._topic_type[()]
+            topic = self._topic[()]
+            n = int(self._length)
+            payload = bytes(self._payload[:n])
+            if int(seq) == s:
+                break
+        else:
+            return None
+        self.generation = s
+        if is_control_message(payload):
+            # MQTT_FORMAT="Jaka-Control-Binary"の制御メッセージ
+            js = control_message_to_dict(payload)
+        else:
+            js = json.loads(payload)
+        js["topic_type"] = topic_type.decode()
+        js["topic"] = topic.decode()
+        return js
+
+    def release(self) -> None:
+        self._payload.release()
+        self._seq = self._topic_type = self._topic = self._length = None
+
+
+class Snapshots:
+    """モニタプロセスとMQTTの受信プロセスの最新のメッセージ"""
+    def __init__(self, create: bool = False) -> None:
+        if create:
+            self.sm, record = create_snapshot_shm()
+        else:
+            self.sm, record = attach_snapshot_shm()
+        ar = record.base
+        self.monitor = SnapshotSlot(ar["monitor"])
+        self.mqtt_control = SnapshotSlot(ar["mqtt_control"])
+
+    def close(self) -> None:
+        # 共有メモリのビューを先に手放す
+        self.monitor.release()
+        self.mqtt_control.release()
+        self.sm.close()
+
+    def unlink(self) -> None:
+        self.sm.unlink()
@@ -0,0 +1,137 @@
+"""
+共有メモリの状態値、目標値、制御値に書き込まれた時刻 (time.monotonic_ns) を使った
+制御ループでの計測。
+- StaleWatch: 状態値 (フィードバック) や目標値 (VR) の流れが途切れたことの検出
+- MotionLatency: 静止から動き出すときの、VRの目標値の受信 → servo_jの送信 →
+  フィードバックの状態値が動くまでの遅延
+時刻はすべてtime.monotonic_nsで、別のプロセスで得た時刻とも比較できる。
+"""
+import logging
+from typing import Tuple
+
+import numpy as np
+
+
+class StaleWatch:
+    """書き込み時刻が古くなった (流れが途切れた) ときと再開したときだけログを出す"""
+    def __init__(
+        self, name: str, timeout: float, logger: logging.Logger,
+    ) -> None:
+        """timeout: この秒数より古ければ途切れたとする"""
+        self.name = name
+        self.timeout_ns = int(timeout * 1e9)
+        self.logger = logger
+        self.stale = False
+        # 途切れた回数と、再開するまでの最長の時間 (ns)
+        self.n_stale = 0
+        self.max_gap_ns = 0
+        self._last_stamp_ns = 0
+
+    def update(self, now_ns: int, stamp_ns: int) -> bool:
+        """stamp_ns: 最後に読めた値の書き込み時刻。途切れていればTrueを返す"""
+        if now_ns - stamp_ns > self.timeout_ns:
+            if not self.stale:
+                self.stale = True
+                self.n_stale += 1
+                self._last_stamp_ns = stamp_ns
+                self.logger.warning(
+                    f"No new {self.name} for "
+                    f"{(now_ns - stamp_ns) / 1e9:.3f} seconds")
+        elif self.stale:
+            self.stale = False
+            gap_ns = stamp_ns - self._last_stamp_ns
+            self.max_gap_ns = max(self.max_gap_ns, gap_ns)
+            self.logger.info(
+                f"{self.name.capitalize()} resumed after "
+                f"{gap_ns / 1e9:.3f} seconds")
+        return self.stale
+
+
+class MotionLatency:
+    """
+    静止していた目標値が動き出してから、その動きがservo_jで送られ、
+    フィードバックの状態値に現れるまでの遅延を測る。
+    動いている間は前の動きの影響と区別できないので、静止からの動き出しだけを測る。
+
+    IDLE: 目標値がsettle秒以上静止した後に動けば、その受信時刻を記録しSENDへ
+    SEND: 0でない差分を送れば、その送信時刻を記録しMOTIONへ
+    MOTION: 送信より後に受信した状態値が動き出しの時点から動いていれば完了
+    timeout秒以内に完了しなければIDLEに戻る
+    """
+    IDLE, SEND, MOTION = range(3)
+
+    def __init__(
+        self,
+        eps: float = 0.01,
+        settle: float = 0.5,
+        timeout: float = 2.0,
+        n_dims: int = 6,
+    ) -> None:
+        """eps: 動いたとみなす関節の角度の変化 (deg)"""
+        self.eps = eps
+        self.settle_ns = int(settle * 1e9)
+        self.timeout_ns = int(timeout * 1e9)
+        self.phase = self.IDLE
+        self.n_timeouts = 0
+        self._last_target = None
+        self._target = np.zeros(n_dims)
+        self._state0 = np.zeros(n_dims)
+        self._diff = np.zeros(n_dims)
+        self._moved = np.zeros(n_dims, dtype=bool)
+        # 目標値が最後に動いた時刻と、動き出しの各時刻 (ns)
+        self._target_moved_ns = 0
+        self._t_target_ns = 0
+        self._t_send_ns = 0
+
+    def _differs(self, a: np.ndarray, b: np.ndarray) -> bool:
+        np.subtract(a, b, out=self._diff)
+        np.abs(self._diff, out=self._diff)
+        np.greater(self._diff, self.eps, out=self._moved)
+        return np.count_nonzero(self._moved) > 0
+
+    def on_target(
+        self, target: np.ndarray, stamp_ns: int, state: np.ndarray,
+    ) -> None:
+        """新しい目標値 (受信時刻stamp_ns) を読んだとき"""
+        if self._last_target is None:
+            # 最初の目標値は動きとしない
+            self._last_target = self._target
+            np.copyto(self._last_target, target)
+            self._target_moved_ns = stamp_ns
+            return
+        if not self._differs(target, self._last_target):
+            return
+        np.copyto(self._last_target, target)
+        if (self.phase == self.IDLE and
+                stamp_ns - self._target_moved_ns >= self.settle_ns):
+            self.phase = self.SEND
+            self._t_target_ns = stamp_ns
+            np.copyto(self._state0, state)
+        self._target_moved_ns = stamp_ns
+
+    def on_send(self, command_diff: np.ndarray, send_ns: int) -> None:
+        """servo_jで差分を送ったとき"""
+        if (self.phase == self.SEND and
+                np.count_nonzero(command_diff) > 0):
+            self.phase = self.MOTION
+            self._t_send_ns = send_ns
+
+    def on_state(
+        self, state: np.ndarray, stamp_ns: int, now_ns: int,
+    ) -> Tuple[int, int] | None:
+        """
+        新しい状態値 (受信時刻stamp_ns) を読んだとき。
+        完了すれば (受信から送信まで, 送信から状態値が動くまで) の時間 (ns) を返す
+        """
+        if self.phase == self.IDLE:
+            return None
+        if now_ns - self._t_target_ns > self.timeout_ns:
+            self.phase = self.IDLE
+            self.n_timeouts += 1
+            return None
+        if (self.phase == self.MOTION and stamp_ns > self._t_send_ns and
+                self._differs(state, self._state0)):
+            self.phase = self.IDLE
+            return (self._t_send_ns - self._t_target_ns,
+                    stamp_ns - self._t_send_ns)
+        return None
@@ -38,6 +38,11 @@ class LogLoader:
         with open(path) as f:
             for line in f:
                 js = json.loads(line)
+                # 以前のログには状態値以外の行 (kind="e2e"など) や
+                # 関節角度が取れなかった行が混ざっているので除く
+                if js.get("kind") != "state" or \
+                        js.get("joint") is None or js.get("pose") is None:
+                    continue
                 data = {}
                 data["time"] = js["time"]
                 data["kind"] = js["kind"]
@@ -71,6 +76,7 @@ class LogLoader:
                     data[f"J{i+1}"] = js["joint"][i]
                 data["max_ratio"] = js.get("max_ratio", None)
                 data["accel_max_ratio"] = js.get("accel_max_ratio", None)
+                data["jerk_max_ratio"] = js.get("jerk_max_ratio", None)
                 records.append(data)
         df = pd.DataFrame(records)
         ret = {}
@@ -118,6 +118,11 @@ class MQTTWin:
                        command=self.DemoPutDownBox, state="disabled")
         # self.button_DemoPutDownBox.grid(row=row,column=4,padx=2,pady=2,sticky="ew", columnspan=2)
 
+        self.button_DumpLatency = \
+            tk.Button(self.root, text="DumpLatency", padx=5,
+                      command=self.DumpLatency, state="disabled")
+        self.button_DumpLatency.grid(row=row,column=4,padx=2,pady=2,sticky="ew", columnspan=2)
+
         row += 1
 
         self.button_EnableRobot = \
@@ -457,6 +462,25 @@ class MQTTWin:
 
         row += 1
 
+        frame_latency = tk.Frame(self.root)
+        frame_latency.grid(
+            row=row, column=0, padx=2, pady=2, sticky="ew", columnspan=8)
+        label_latency = tk.Label(
+            frame_latency, text="Control Latency p50/p99 (us)")
+        label_latency.pack(side="left", padx=2)
+        self.string_var_latency = tk.StringVar()
+        text_box_latency = tk.Label(
+            frame_latency,
+            textvariable=self.string_var_latency,
+            bg="white",
+            relief="solid",
+            bd=1,
+            anchor="w",
+        )
+        text_box_latency.pack(side="left", padx=2, expand=True, fill="x")
+
+        row += 1
+
         tk.Label(self.root, text="Log Monitor").grid(
             row=row, column=0, padx=2, pady=2, sticky="w", columnspan=8)
         self.log_monitor = scrolledtext.ScrolledText(
@@ -533,6 +557,7 @@ class MQTTWin:
         self.button_TidyPose.config(state="normal")
         self.button_ToolChange.config(state="disabled")
         self.button_ChangeLogFile.config(state="normal")
+        self.button_DumpLatency.config(state="normal")
         if self.pm.state_recv_mqtt:
             self.button_StartMQTTControl.config(state="normal")
             self.button_StopMQTTControl.config(state="normal")
@@ -634,19 +659,27 @@ class MQTTWin:
         if getattr(self, "listener", None) is not None:
             self.listener.stop()
         logging_dir = self.get_logging_dir()
+        self.logging_dir = logging_dir
         self.pm.change_log_file(logging_dir)
         # ここでのロガーメッセージが古いファイルか新しいファイルに記録されるかは
         # タイミングによって異なることがある
         self.logger.info(f"Change log directory to {logging_dir}")
         self.logger.info("Change log file")
         # サブプロセスの制御値、状態値のファイルの保存先の変更完了を待つ
+        # 完了したプロセスが通知するので、周期的に確認せずに待つ
         while True:
-            if self.pm.ar[33] == 0 and self.pm.ar[34] == 0:
+            if self.pm.ar["change_log_control"] == 0 and self.pm.ar["change_log_monitor"] == 0:
                 break
-            time.sleep(0.1)
+            self.pm.notifiers.main.wait(1)
         self.setup_logging(
             log_queue=self.pm.log_queue, logging_dir=logging_dir)
 
+    def DumpLatency(self):
+        if not self.pm.state_control:
+            return
+        path = self.pm.dump_latency_histograms(self.logging_dir)
+        self.logger.info(f"Dump control latency histograms to {path}")
+
     def update_gui_log(self):
         while True:
             msg = self.gui_log_queue.get(block=True, timeout=None)
@@ -720,10 +753,22 @@ class MQTTWin:
             else:
                 self.string_var_targets["grip"].set("")
         
-        # 共有メモリの情報
-        sm = self.pm.ar.copy()
-        sm_str = ",".join(str(int(round(x))) for x in sm)
+        # 共有メモリの情報 (ヘッダとseqlockの世代、書き込み時刻は除く)
+        sm = self.pm.ar.base.copy()
+        values = []
+        for name in sm.dtype.names:
+            if name in ["version", "size"] or name.endswith(("_seq", "_time")):
+                continue
+            values.extend(sm[name].reshape(-1).tolist())
+        sm_str = ",".join(str(int(round(x))) for x in values)
         self.string_var_sm.set(sm_str)
+
+        # 制御ループの処理時間
+        summary = self.pm.get_latency_summary()
+        latency_str = ", ".join(
+            f"{phase} {s['p50_us']:.0f}/{s['p99_us']:.0f}"
+            for phase, s in summary.items() if s["count"] > 0)
+        self.string_var_latency.set(latency_str)
         self.root.after(100, self.update_monitor)  # 100ms間隔で表示を更新
 
     def update_topic(self, msg: str, box: scrolledtext.ScrolledText) -> None: